@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Stand-in for `marian evaluate`: reads TSV lines from stdin and writes one deterministic score per line.
+
+Scores are a hash of the input line, so they are reproducible across runs.
+Speed is set with FAKE_MARIAN_LPS env var (lines per second; 0 or unset is as fast as possible).
+Use `install()` to create a `marian` executable and a dummy model dir for `evaluate.marian.marian_score`.
+"""
+import os
+import sys
+import time
+import zlib
+import argparse
+from pathlib import Path
+
+SPEED_ENV = 'FAKE_MARIAN_LPS'
+
+
+def install(work_dir: Path):
+    """Create work_dir/bin/marian and a dummy model dir.
+
+    :return: (bin_dir, model_dir); prepend bin_dir to PATH to use the fake marian
+    """
+    bin_dir = Path(work_dir) / 'bin'
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    exe = bin_dir / 'marian'
+    exe.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{Path(__file__).resolve()}" "$@"\n')
+    exe.chmod(0o755)
+    model_dir = Path(work_dir) / 'fake-model'
+    model_dir.mkdir(parents=True, exist_ok=True)
+    for name in ['model.npz.best-ce-mean.npz', 'vocab.spm']:
+        (model_dir / name).touch()
+    return bin_dir, model_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('command', choices=['evaluate'])
+    parser.add_argument('-w', '--width', type=int, default=4)
+    parser.add_argument('--mini-batch', type=int, default=16)
+    args, _ = parser.parse_known_args()   # other marian options are accepted and ignored
+
+    lines_per_sec = float(os.environ.get(SPEED_ENV) or 0)
+    start = time.perf_counter()
+    out = sys.stdout
+    for i, line in enumerate(sys.stdin.buffer, start=1):
+        score = zlib.crc32(line) / 2**32
+        out.write(f'{score:.{args.width}f}\n')
+        if lines_per_sec and i % args.mini_batch == 0:
+            delay = i / lines_per_sec - (time.perf_counter() - start)
+            if delay > 0:
+                out.flush()
+                time.sleep(delay)
+    out.flush()
+
+
+if __name__ == '__main__':
+    main()
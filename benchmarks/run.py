@@ -0,0 +1,270 @@
+"""Offline benchmark of the evaluation pipeline on a synthetic testset, using a fake marian.
+
+Times flatten (get_flat_file), score (score_dataset via marian_score), split (flat_to_splits), ReadScoreFile,
+EvalSet loading, and `flatten`/`validate`/`report` CLI end to end (in a subprocess, so import time is included).
+Stages that need mt_metrics_eval are skipped when it is not installed.
+The `import` stage checks that `evaluate.main` imports within a time budget and without heavy modules;
+the exit code is 1 when a check fails.
+Results are written as JSON, to be compared between commits with `--baseline`.
+
+    python -m benchmarks -o before.json
+    git checkout <other-commit>
+    python -m benchmarks -o after.json --baseline before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import importlib.util
+import contextlib
+import logging as log
+from datetime import datetime
+from pathlib import Path
+
+from . import fake_marian
+from .synth import DEF_LPS, make_testset
+
+log.basicConfig(level=log.INFO)
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DEF_SCENARIO = 'wmt23.mqm(de;he;zh)'
+STAGES = ['import', 'flatten', 'cli.flatten', 'score', 'split', 'read_score_file', 'load_eval_sets', 'validate',
+          'report', 'report.cached']
+MTME_STAGES = {'read_score_file', 'load_eval_sets', 'validate', 'report', 'report.cached'}
+# modules that must not be loaded by `import evaluate.main`, so that e.g. `flatten` starts quickly
+HEAVY_MODULES = ['numpy', 'pandas', 'scipy', 'mt_metrics_eval', 'tqdm']
+IMPORT_BUDGET_SEC = 0.15
+IMPORT_CODE = f"""
+import sys, time
+start = time.perf_counter()
+import evaluate.main
+print(time.perf_counter() - start, *[m for m in {HEAVY_MODULES!r} if m in sys.modules])
+"""
+
+
+def has_mtme() -> bool:
+    return importlib.util.find_spec('mt_metrics_eval') is not None
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, text=True,
+                                       stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def bench(fn, repeat: int, setup=None, warmup=False, rows=None) -> dict:
+    """Time fn() `repeat` times, calling setup() before each run (untimed)"""
+    if warmup:
+        setup and setup()
+        fn()
+    runs = []
+    for _ in range(repeat):
+        setup and setup()
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    result = dict(runs=runs, min=min(runs), median=statistics.median(runs), mean=statistics.mean(runs))
+    if rows:
+        result['rows'] = rows
+        result['rows_per_sec'] = rows / result['min']
+    return result
+
+
+def _unlink(*paths):
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+
+
+def _env() -> dict:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(REPO_ROOT), env.get('PYTHONPATH')]))
+    return env
+
+
+def _cli(*args):
+    """Run `python -m evaluate <args>` in a subprocess, with this repo on PYTHONPATH"""
+    subprocess.run([sys.executable, '-m', 'evaluate', *map(str, args)], check=True, env=_env(), cwd=REPO_ROOT,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def bench_import(repeat: int, budget=IMPORT_BUDGET_SEC) -> dict:
+    """Time `import evaluate.main` in fresh interpreters, and check it against budget and HEAVY_MODULES"""
+    runs, heavy = [], set()
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', IMPORT_CODE], env=_env(), cwd=REPO_ROOT, text=True)
+        secs, *modules = out.split()
+        runs.append(float(secs))
+        heavy.update(modules)
+    result = dict(runs=runs, min=min(runs), median=statistics.median(runs), mean=statistics.mean(runs),
+                  budget=budget, heavy_modules=sorted(heavy))
+    result['ok'] = result['median'] <= budget and not heavy
+    if not result['ok']:
+        log.error(f'import evaluate.main: median {result["median"]:.3f}s (budget {budget}s); heavy modules: {sorted(heavy)}')
+    return result
+
+
+def run_benchmarks(work_dir: Path, stages=STAGES, repeat=3, testset='wmt23', lps=DEF_LPS, n_segs=500,
+                   n_systems=10, n_metrics=8, scenario=DEF_SCENARIO, marian_speed=0,
+                   import_budget=IMPORT_BUDGET_SEC) -> dict:
+    """Generate a synthetic testset under work_dir and run the benchmark stages.
+
+    :return: dict with `meta`, `results` (stage -> timings) and `skipped` (stage -> reason)
+    """
+    from evaluate import Config
+    from evaluate.score import count_lines, flat_to_splits, get_flat_file, score_dataset
+
+    Config.PBAR_ENABLED = False
+
+    base_dir, user_dir = work_dir / 'mt-metrics-eval', work_dir / 'user-metrics'
+    params = dict(testset=testset, lps=lps, segs=n_segs, systems=n_systems, metrics=n_metrics,
+                  scenario=scenario, marian_speed=marian_speed, repeat=repeat)
+    meta = dict(commit=git_commit(), time=datetime.now().isoformat(timespec='seconds'), python=platform.python_version(),
+                platform=platform.platform(), cpus=os.cpu_count(), params=params)
+    results, skipped = {}, {}
+
+    start = time.perf_counter()
+    testset_path = make_testset(base_dir, testset=testset, lps=lps, n_segs=n_segs, n_systems=n_systems,
+                                n_metrics=n_metrics)
+    meta['synth_sec'] = time.perf_counter() - start
+    bin_dir, model_dir = fake_marian.install(work_dir)
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ[fake_marian.SPEED_ENV] = str(marian_speed)
+
+    data_file = get_flat_file(testset_path)
+    n_rows = count_lines(data_file)
+    scores_file = user_dir / f'{data_file.name}.fake-marian.seg.score'
+    split_dir = user_dir / testset
+    meta['rows'] = n_rows
+
+    def stage_flatten():
+        return bench(lambda: get_flat_file(testset_path), repeat, rows=n_rows,
+                     setup=lambda: _unlink(data_file, data_file.with_suffix('._OK')))
+
+    def stage_cli_flatten():   # flat file exists; measures startup and path resolution
+        get_flat_file(testset_path)
+        return bench(lambda: _cli('-b', base_dir, '-t', testset, 'flatten'), repeat)
+
+    def stage_score():
+        scores_file.parent.mkdir(parents=True, exist_ok=True)
+        return bench(lambda: score_dataset(data_file, scores_file, model_dir), repeat, rows=n_rows,
+                     setup=lambda: _unlink(scores_file, scores_file.with_suffix('._OK')))
+
+    def stage_split():
+        if not scores_file.exists():
+            score_dataset(data_file, scores_file, model_dir)
+        return bench(lambda: flat_to_splits(data_file, scores_file, split_dir, 'fake-marian'), repeat, rows=n_rows,
+                     setup=lambda: _unlink(split_dir, split_dir / (scores_file.name + '._SPLIT_OK')))
+
+    def stage_read_score_file():
+        from evaluate.mtme_data import ReadScoreFile
+        path = max(testset_path.glob('metric-scores/*/*.seg.score'), key=lambda p: p.stat().st_size)
+        return bench(lambda: ReadScoreFile(str(path)), repeat, rows=count_lines(path))
+
+    def stage_load_eval_sets():
+        from evaluate.evaluate import load_eval_sets
+        return bench(lambda: load_eval_sets(paths=[str(base_dir), str(user_dir)], scenairo_name=scenario), repeat)
+
+    def stage_validate():
+        if not scores_file.exists():
+            score_dataset(data_file, scores_file, model_dir)
+        return bench(lambda: _cli('-b', base_dir, '-t', testset, 'validate', scores_file, '-sc', scenario), repeat)
+
+    def stage_report(cache=False):
+        report_file = work_dir / 'results.csv'
+        args = ['-b', base_dir, '-t', testset, 'report', '-u', user_dir, '-o', report_file,
+                '--cache' if cache else '--no-cache']
+        return bench(lambda: _cli(*args), repeat, warmup=cache)
+
+    stage_fns = {'import': lambda: bench_import(repeat, budget=import_budget),
+                 'flatten': stage_flatten, 'cli.flatten': stage_cli_flatten, 'score': stage_score, 'split': stage_split,
+                 'read_score_file': stage_read_score_file, 'load_eval_sets': stage_load_eval_sets,
+                 'validate': stage_validate, 'report': stage_report,
+                 'report.cached': lambda: stage_report(cache=True)}
+    mtme = has_mtme()
+    for stage in stages:
+        if stage in MTME_STAGES and not mtme:
+            skipped[stage] = 'mt_metrics_eval is not installed'
+            log.warning(f'Skip {stage}: {skipped[stage]}')
+            continue
+        log.info(f'Benchmark {stage}')
+        results[stage] = stage_fns[stage]()
+        log.info(f"{stage}: median {results[stage]['median']:.3f}s")
+    return dict(meta=meta, results=results, skipped=skipped)
+
+
+def compare(baseline: dict, current: dict) -> str:
+    """Table of median times of current vs baseline results"""
+    header = f"{'stage':<18} {'baseline_s':>11} {'current_s':>11} {'ratio':>7}"
+    lines = [f"baseline={baseline['meta']['commit']} current={current['meta']['commit']}", header, '-' * len(header)]
+    for stage, res in current['results'].items():
+        base = baseline['results'].get(stage)
+        if base is None:
+            lines.append(f"{stage:<18} {'-':>11} {res['median']:>11.3f} {'-':>7}")
+        else:
+            lines.append(f"{stage:<18} {base['median']:>11.3f} {res['median']:>11.3f} {res['median'] / base['median']:>7.2f}")
+    return '\n'.join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='benchmarks', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--out', type=Path, default=None, help='Results JSON file. Default: stdout')
+    parser.add_argument('-w', '--work-dir', type=Path, default=None,
+                        help='Dir for synthetic data and outputs; kept after run. Default: a temporary dir')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timed runs per stage')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run')
+    parser.add_argument('-t', '--testset', default='wmt23', help='Testset name; must be known to mt_metrics_eval')
+    parser.add_argument('-l', '--lps', nargs='+', default=DEF_LPS, help='Language pairs')
+    parser.add_argument('-s', '--segs', type=int, default=500, help='Segments per language pair')
+    parser.add_argument('-y', '--systems', type=int, default=10, help='Systems per language pair')
+    parser.add_argument('-m', '--metrics', type=int, default=8, help='Stored metrics per language pair')
+    parser.add_argument('-sc', '--scenario', default=DEF_SCENARIO, help='Scenario for load_eval_sets and validate')
+    parser.add_argument('--marian-speed', type=float, default=0,
+                        help='Lines per second of fake marian; 0 is as fast as possible')
+    parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET_SEC,
+                        help='Max median seconds to import evaluate.main (the CLI)')
+    parser.add_argument('--baseline', type=Path, default=None, help='Results JSON of a previous run to compare with')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    kwargs = dict(stages=args.stages, repeat=args.repeat, testset=args.testset, lps=args.lps, n_segs=args.segs,
+                  n_systems=args.systems, n_metrics=args.metrics, scenario=args.scenario, marian_speed=args.marian_speed,
+                  import_budget=args.import_budget)
+    with contextlib.redirect_stdout(sys.stderr):   # keep stdout for results
+        if args.work_dir:
+            args.work_dir.mkdir(parents=True, exist_ok=True)
+            report = run_benchmarks(args.work_dir, **kwargs)
+        else:
+            with tempfile.TemporaryDirectory(prefix='mtme-bench-') as tmp_dir:
+                report = run_benchmarks(Path(tmp_dir), **kwargs)
+
+    text = json.dumps(report, indent=2)
+    if args.out:
+        args.out.write_text(text + '\n')
+        log.info(f'Wrote {args.out}')
+    else:
+        print(text)
+    if args.baseline:
+        log.info('\n' + compare(json.loads(args.baseline.read_text()), report))
+    failed = [stage for stage, res in report['results'].items() if not res.get('ok', True)]
+    if failed:
+        log.error(f'Failed checks: {failed}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
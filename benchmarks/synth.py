@@ -0,0 +1,125 @@
+"""Synthetic testsets in mt-metrics-eval layout, for benchmarking without the real download.
+
+Layout of `<root>/<testset>/`:
+    documents/<lp>.docs                     "domain docid" per segment
+    sources/<lp>.txt
+    references/<lp>.<ref>.txt               refA, refB
+    system-outputs/<lp>/<sys>.txt           synthetic systems, and the non-standard reference as human system
+    human-scores/<lp>.<gold>.{seg,sys}.score
+    metric-scores/<lp>/<metric>-<ref>.{seg,sys}.score
+
+Language pairs and testset name should be real (default: wmt23), since mt_metrics_eval.EvalSet looks them up in its meta_info.
+Scores are random but deterministic for a seed: metrics are noisy copies of gold, so that they have distinct accuracies.
+"""
+import argparse
+import logging as log
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+log.basicConfig(level=log.INFO)
+
+# language pairs of the wmt23 scenarios in evaluate.evaluate.all_scenarios
+DEF_LPS = ['en-de', 'he-en', 'zh-en', 'cs-uk', 'de-en', 'en-cs', 'en-ja', 'en-zh', 'ja-en']
+GOLD_NAMES = ['mqm', 'da-sqm']
+REF_NAMES = ['refA', 'refB']
+DOMAINS = ['news', 'social', 'speech', 'user_review']
+WORDS = ('the of and to in is was for on that with as by at from this be are it an or have not which one '
+         'had but were all their has been there can more other new some time would these two may first').split()
+
+
+def std_ref(testset: str, lp: str) -> str:
+    """Standard reference of lp from mt_metrics_eval's meta_info; refA if unknown"""
+    try:
+        from mt_metrics_eval import meta_info
+        return meta_info.DATA[testset][lp].std_ref
+    except (ImportError, KeyError, AttributeError):
+        return 'refA'
+
+
+def _sentences(rng: np.random.Generator, n: int, mean_len=20) -> List[str]:
+    lengths = rng.poisson(mean_len, size=n) + 1
+    words = rng.choice(WORDS, size=lengths.sum())
+    ends = np.cumsum(lengths)
+    return [' '.join(words[end - length:end]) for end, length in zip(ends, lengths)]
+
+
+def _write_lines(path: Path, lines):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        for line in lines:
+            f.write(f'{line}\n')
+
+
+def _write_scores(path: Path, seg_scores: dict, missing: float = 0.0, rng=None):
+    """Write <sys>\t<score> seg and sys files from sys -> seg score array. `missing` fraction of seg scores are None."""
+    seg_lines, sys_lines = [], []
+    for sys_name, scores in seg_scores.items():
+        mask = rng.random(len(scores)) < missing if missing else np.zeros(len(scores), dtype=bool)
+        seg_lines.extend(f'{sys_name}\t{"None" if m else f"{s:.6f}"}' for s, m in zip(scores, mask))
+        kept = scores[~mask]
+        sys_lines.append(f'{sys_name}\t{kept.mean() if len(kept) else "None"}')
+    _write_lines(path.with_name(path.name + '.seg.score'), seg_lines)
+    _write_lines(path.with_name(path.name + '.sys.score'), sys_lines)
+
+
+def make_testset(root: Path, testset='wmt23', lps=DEF_LPS, n_segs=500, n_systems=10, n_metrics=8,
+                 n_docs=20, seed=1) -> Path:
+    """Generate a synthetic testset.
+
+    :param root: mt-metrics-eval style root dir; testset is created at root/testset
+    :param testset: testset name; should be known to mt_metrics_eval.meta_info
+    :param lps: language pairs
+    :param n_segs: segments per language pair
+    :param n_systems: MT systems per language pair (a human system is added)
+    :param n_metrics: stored metrics per language pair; half of them are reference-free
+    :param n_docs: documents per language pair, assigned to domains round robin
+    :param seed: random seed
+    :return: path to testset dir
+    """
+    rng = np.random.default_rng(seed)
+    d = Path(root) / testset
+    for lp in lps:
+        std = std_ref(testset, lp)
+        doc_ids = np.sort(rng.integers(0, n_docs, size=n_segs))
+        _write_lines(d / f'documents/{lp}.docs', (f'{DOMAINS[i % len(DOMAINS)]} doc{i}' for i in doc_ids))
+        _write_lines(d / f'sources/{lp}.txt', _sentences(rng, n_segs))
+        refs = {ref: _sentences(rng, n_segs) for ref in REF_NAMES}
+        for ref, segs in refs.items():
+            _write_lines(d / f'references/{lp}.{ref}.txt', segs)
+
+        sys_names = [f'sys{i:02d}' for i in range(n_systems)] + [r for r in REF_NAMES if r != std]
+        for sys_name in sys_names:
+            segs = refs[sys_name] if sys_name in refs else _sentences(rng, n_segs)
+            _write_lines(d / f'system-outputs/{lp}/{sys_name}.txt', segs)
+
+        quality = dict(zip(sys_names, rng.normal(0, 1, size=len(sys_names))))
+        gold = {s: quality[s] + rng.normal(0, 2, size=n_segs) for s in sys_names}
+        for gold_name in GOLD_NAMES:
+            _write_scores(d / f'human-scores/{lp}.{gold_name}', gold, missing=0.05, rng=rng)
+        for i in range(n_metrics):
+            ref = 'src' if i % 2 else std
+            noise = 0.5 + i
+            scores = {s: gold[s] + rng.normal(0, noise, size=n_segs) for s in sys_names if s != ref}
+            _write_scores(d / f'metric-scores/{lp}/synth{i:02d}-{ref}', scores)
+    log.info(f'Generated {testset} at {d}: {len(lps)} lps x {n_segs} segs x {n_systems + 1} systems, {n_metrics} metrics')
+    return d
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('root', type=Path, help='Root dir; testset is created at ROOT/TESTSET')
+    parser.add_argument('-t', '--testset', default='wmt23', help='Testset name')
+    parser.add_argument('-l', '--lps', nargs='+', default=DEF_LPS, help='Language pairs')
+    parser.add_argument('-s', '--segs', type=int, default=500, help='Segments per language pair')
+    parser.add_argument('-y', '--systems', type=int, default=10, help='Systems per language pair')
+    parser.add_argument('-m', '--metrics', type=int, default=8, help='Stored metrics per language pair')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed')
+    args = parser.parse_args()
+    make_testset(args.root, testset=args.testset, lps=args.lps, n_segs=args.segs, n_systems=args.systems,
+                 n_metrics=args.metrics, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
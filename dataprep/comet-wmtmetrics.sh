@@ -14,6 +14,8 @@ MODEL_NAME=$(basename $MODEL_ID)
 export NCCL_DEBUG=WARN
 
 DATA_DIR=/mnt/tg/projects/mt-metrics/2023-metric-distill/data/wmt-metrics/merged
+# export-refless: set LENGTHS=spm (or words) to also write rows with src, ref and hyp lengths
+LENGTHS=${LENGTHS:-}
 
 log() {
   echo -e "[$(date -Is)]{L$BASH_LINENO}:: $@" >&2
@@ -82,52 +84,29 @@ score-all(){
 }
 
 
-format-refless(){
+export-refless(){
+    # one pass over each merged TSV: join scores, format refless rows, drop rows having empty columns
+    # input: 1=year 2=langs 3=docid 4=sysname 5=src 6=ref 7=hyp; and score file
+    # output: 1=langs 2=docid 3=system 4=score 5=src 6=tgt
+    # with LENGTHS=spm|words, rows with 7=src_len 8=ref_len 9=hyp_len go to *.refless.clean.<LENGTHS>_len.tsv instead
+    local len_args=() suffix=refless.clean
+    if [[ -n $LENGTHS ]]; then
+        len_args=(--lengths $LENGTHS)
+        suffix=refless.clean.${LENGTHS}_len
+        if [[ $LENGTHS == spm ]]; then
+            spm_model=~/.cache/marian/metrics/comet20-da-src+ref/roberta.vocab.spm
+            [[ -f $spm_model ]] || {
+                log "ERROR: $spm_model not found"
+                exit 1
+            }
+            len_args+=(--spm-model $spm_model)
+        fi
+    fi
     for inp in $DATA_DIR/{wmt_sans22.shuf.{dev,train},wmt22}.tsv; do
         score=${inp%.tsv}.$MODEL_NAME.score
-        out=${inp%.tsv}.$MODEL_NAME.refless.tsv
-        [[ -f $inp && -f $inp._OK && -f $score && -f $score._OK ]] && { log "ERROR: $inp or $score is invalid"; continue; }
-        [[ -f $out && -f $out._OK ]] && { log "Skip $out"; continue; }
-
-        # check line count
-        [[ $(wc -l < $inp ) -eq $(wc -l < $score ) ]] || {
-            log "ERROR: $inp and $score have different line counts"
-            continue
-        }
-        log "Processing $inp $score -> $out"
-        rm -f $out $out._OK
-
-        # input: 1=year 2=langs 3=docid 4=sysname 5=src 6=ref 7=hyp 8=score
-        # output: 1=langs 2=docid 3=system 4=score 5=src 6=tgt
-        paste $inp $score | awk -F '\t' -v OFS='\t' '{print $1"|"$2, $3, $4, $8, $5, $7}' > $out && touch $out._OK
-        log "Done $out"
-    done
-}
-
-spm-length(){
-    spm_model=~/.cache/marian/metrics/comet20-da-src+ref/roberta.vocab.spm
-    [[ -f $spm_model ]] || {
-        log "ERROR: $spm_model not found"
-        exit 1
-    }
-    for inp in  $DATA_DIR/{wmt_sans22.shuf.{dev,train},wmt22}.tsv; do
-        out=${inp%.tsv}.roberta_spm.len
-        [[ -f $out && -f $out._OK ]] && { echo "Skip $out"; continue; }
-        cut -f5,6,7 $inp \
-            | tr '\t' '\n' \
-            | spm_encode --model  $spm_model \
-            | awk '{printf "%d%s", NF, NR % 3 == 0 ? "\n" : "\t"}' > $out && touch $out._OK
-    done
-}
-
-clean-refless(){
-    # remove rows having empty columns
-    for inp in  $DATA_DIR/{wmt_sans22.shuf.{dev,train},wmt22}.*.refless*.tsv; do
-        out=${inp%.tsv}.clean.tsv
-        [[ -f $out && -f $out._OK ]] && { echo "Skip $out"; continue; }
-        awk -F '\t' -v OFS='\t' -v ncols=6 '{ n=(NF>ncols)? NF: ncols; flag=0;
-            for(i=1; i<=n; i++){ if($i==""){ flag+=1 }}; if (flag ==0) {print}}'  < $inp > $out && touch $out._OK
-        wc -l $inp $out
+        out=${inp%.tsv}.$MODEL_NAME.$suffix.tsv
+        [[ -f $inp && -f $score && -f $score._OK ]] || { log "ERROR: $inp or $score is invalid"; continue; }
+        python -m evaluate export $inp --format merged --scores $score --out $out ${len_args[@]+"${len_args[@]}"} -j $(nproc)
     done
 }
 
@@ -135,9 +114,7 @@ clean-refless(){
     echo "Usage: $0 <command> [args]"
     echo "Commands:"
     echo "  score-all"
-    echo "  format-refless"
-    echo "  spm-length"
-    echo "  clean-refless"
+    echo "  export-refless      # LENGTHS=spm $0 export-refless   to add length columns, in another file"
     exit 1
 }
 
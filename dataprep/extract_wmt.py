@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""Extract src, ref and hyp segments of WMT news test sets (wmt09 to wmt22) from the downloaded submissions.
+
+Finds the input files of every (year, language pair) in <downloads>/<year>-submissions, in the same layouts
+as get-wmt.sh did, and parses them with parse_wmt_xml.py on a process pool, in one interpreter.
+Output of a year goes to <extracts>/<year>.<name>/<pair>/, and <extracts>/._OK_<year> is created once
+all of its pairs are extracted; years with this flag are skipped.
+"""
+import os
+import glob
+import argparse
+import logging as log
+from pathlib import Path
+from dataclasses import dataclass
+from typing import List
+from concurrent.futures import ProcessPoolExecutor
+
+from parse_wmt_xml import main as parse_wmt_xml
+
+log.basicConfig(level=log.INFO)
+
+YEARS = [f'wmt{yy:02d}' for yy in range(9, 23)]
+
+
+@dataclass
+class Job:
+    year: str
+    pair: str
+    inp: List[Path]
+    out: Path
+
+    def run(self):
+        src, tgt = self.pair.split('-', 1)
+        log.info(f'===={self.year} {self.pair} :: {self.out}====')
+        parse_wmt_xml(inp=self.inp, out=self.out, year=self.year, langs=[src, tgt], origlang=None)
+
+
+def _subdirs(path: Path) -> List[str]:
+    return sorted(p.name for p in path.glob('*/') if p.is_dir())
+
+
+def _glob(*patterns) -> List[Path]:
+    """Files matching patterns; like `echo pattern` in bash, a pattern without matches is kept as is"""
+    paths = []
+    for pattern in patterns:
+        paths += sorted(glob.glob(str(pattern))) or [pattern]
+    return [Path(p) for p in paths]
+
+
+def find_jobs(year: str, inp_dir: Path, out_dir: Path) -> List[Job]:
+    """Parse jobs of a year; input layouts differ by year"""
+    if not inp_dir.is_dir():
+        raise Exception(f'{inp_dir} does not exist')
+    prefix = f'newstest20{year[3:]}'
+    out_subdir = out_dir / f'{year}.news'
+    jobs = []
+    if year in ('wmt21', 'wmt22'):
+        for inp in sorted(inp_dir.glob('xml/*.all.xml')):
+            name, pair = inp.name.split('.')[:2]   # name is like "newstest2021.en-de.all.xml"
+            name = name.replace('test2021', '', 1)
+            jobs.append(Job(year, pair, [inp], out_dir / f'{year}.{name}'))
+    elif year == 'wmt20':
+        inp_dir = inp_dir / prefix
+        for pair in _subdirs(inp_dir / 'sgm/system-outputs'):
+            src, tgt = pair.split('-', 1)
+            src_file = inp_dir / f'sgm/sources/{prefix}-{src}{tgt}-src.{src}.sgm'
+            ref_file = inp_dir / f'sgm/references/{prefix}-{src}{tgt}-ref.{tgt}.sgm'
+            hyp_files = _glob(inp_dir / f'sgm/system-outputs/{pair}/{prefix}.{pair}.*.sgm')
+            jobs.append(Job(year, pair, [src_file, ref_file, *hyp_files], out_subdir))
+    elif year in ('wmt14', 'wmt15', 'wmt16', 'wmt17', 'wmt18', 'wmt19'):
+        for pair in _subdirs(inp_dir / f'sgm/system-outputs/{prefix}'):
+            src, tgt = pair.split('-', 1)
+            src_file = inp_dir / f'sgm/sources/{prefix}-{src}{tgt}-src.{src}.sgm'
+            ref_file = inp_dir / f'sgm/references/{prefix}-{src}{tgt}-ref.{tgt}.sgm'
+            hyp_files = _glob(inp_dir / f'sgm/system-outputs/{prefix}/{pair}/{prefix}.*.{pair}.sgm')
+            if not src_file.exists():
+                log.warning(f'Source file {src_file} does not exist... skipping')
+                continue
+            jobs.append(Job(year, pair, [src_file, ref_file, *hyp_files], out_subdir))
+    elif year in ('wmt11', 'wmt12', 'wmt13'):
+        for pair in _subdirs(inp_dir / f'sgm/system-outputs/{prefix}'):
+            src, tgt = pair.split('-', 1)
+            src_file = inp_dir / f'sgm/sources/{prefix}-src.{src}.sgm'
+            ref_file = inp_dir / f'sgm/references/{prefix}-ref.{tgt}.sgm'
+            hyp_files = _glob(inp_dir / f'sgm/system-outputs/{prefix}/{pair}/{prefix}.{pair}.*.sgm')
+            jobs.append(Job(year, pair, [src_file, ref_file, *hyp_files], out_subdir))
+    elif year == 'wmt10':
+        prefix = 'newssyscombtest2010'
+        for pair in _subdirs(inp_dir / 'xml/tst-primary'):
+            src, tgt = pair.split('-', 1)
+            src_file = inp_dir / f'xml/src/{prefix}.{src}.src.xml'
+            ref_file = inp_dir / f'xml/ref/{prefix}.{pair}.ref.xml'
+            hyp_files = _glob(*[inp_dir / f'xml/tst-{kind}/{pair}/{prefix}.{pair}.*.xml'
+                                for kind in ('primary', 'secondary')])
+            jobs.append(Job(year, pair, [src_file, ref_file, *hyp_files], out_subdir))
+            break   # as in get-wmt.sh, only the first pair of wmt10 is extracted
+    elif year == 'wmt09':
+        for pair in _subdirs(inp_dir / 'submissions-xml'):
+            src, tgt = pair.split('-', 1)
+            src_file = inp_dir / f'source+ref-xml/{prefix}-src.{src}.xml'
+            if not src_file.exists():
+                log.warning(f'{src_file} not found. skipping')
+                continue
+            ref_file = inp_dir / f'source+ref-xml/{prefix}-ref.{tgt}.xml'
+            hyp_files = sorted(inp_dir.glob(f'submissions-xml/{pair}/{pair}.{prefix}.*.xml'))
+            if not hyp_files:
+                log.warning(f'{pair} hyp files not found')
+                continue
+            jobs.append(Job(year, pair, [src_file, ref_file, *hyp_files], out_subdir))
+    else:
+        raise Exception(f'ERROR {year} not supported yet')
+    return jobs
+
+
+def count_lines(path: Path) -> int:
+    with open(path, 'rb') as f:
+        return sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+
+
+def sanity_check(src_file: Path) -> int:
+    """Check that all files of a pair have as many lines as its .src.txt file; return number of mismatches"""
+    n1 = count_lines(src_file)
+    prefix = str(src_file)[:str(src_file).rindex('.', 0, -len('.src.txt'))]
+    n_errs = 0
+    for path in sorted(glob.glob(f'{glob.escape(prefix)}.*')):
+        n2 = count_lines(Path(path))
+        if n1 != n2:
+            log.error(f'ERROR: {prefix} {src_file.name} and {Path(path).name} have different number of lines: {n1} != {n2}')
+            n_errs += 1
+    log.info(f'{prefix} : {n_errs} errors')
+    return n_errs
+
+
+def extract_all(downloads: Path, out_dir: Path, years=YEARS, jobs: int = None, check=False) -> List[str]:
+    """Extract years in parallel; return the years that failed"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    failed = []
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = {}
+        for year in years:
+            flag = out_dir / f'._OK_{year}'
+            if flag.exists():
+                log.info(f'{flag} exists... skipping...')
+                continue
+            try:
+                year_jobs = find_jobs(year, downloads / f'{year}-submissions', out_dir)
+            except Exception as e:
+                log.error(f'{year}: {e}')
+                failed.append(year)
+                continue
+            futures[year] = [(job, pool.submit(job.run)) for job in year_jobs]
+
+        for year, year_futures in futures.items():
+            ok = True
+            for job, future in year_futures:
+                try:
+                    future.result()
+                except Exception:
+                    log.exception(f'Failed {year} {job.pair}: {" ".join(map(str, job.inp))}')
+                    ok = False
+            if ok:
+                (out_dir / f'._OK_{year}').touch()
+            else:
+                failed.append(year)
+
+        if check:
+            src_files = sorted(out_dir.glob('*/*/*.src.txt'))
+            n_errs = sum(pool.map(sanity_check, src_files))
+            log.info(f'Sanity check: {len(src_files)} pairs; {n_errs} errors')
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--downloads', type=Path, required=True,
+                        help='dir having extracted <year>-submissions dirs')
+    parser.add_argument('-o', '--out', type=Path, required=True, help='output dir')
+    parser.add_argument('-y', '--years', nargs='+', default=YEARS, help='years to extract')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='parallel jobs')
+    parser.add_argument('-c', '--check', action='store_true',
+                        help='check that all files of each extracted pair have the same number of lines')
+    args = parser.parse_args()
+    failed = extract_all(args.downloads, args.out, years=args.years, jobs=args.jobs, check=args.check)
+    if failed:
+        raise SystemExit(f'Failed years: {" ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
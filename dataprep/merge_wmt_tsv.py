@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Merge extracted WMT files (see parse_wmt_xml.py) into one TSV with a row per (segment, ref, hyp):
+
+    year <TAB> pair <TAB> docid <TAB> "refname hypname" <TAB> src <TAB> ref <TAB> hyp
+
+Rows with <<MISSING>> segments are written to <out>._ERRORS instead of <out>.
+Language pairs are merged in parallel, each into its own part file, and the parts are concatenated in input order.
+Output is the same as that of the former merge_dataset_as_tsv shell function in get-wmt.sh piped through
+`grep -v '<<MISSING>>'`, with ref and hyp files taken in byte order (as bash globs with LC_ALL=C).
+"""
+import os
+import glob
+import shutil
+import argparse
+import logging as log
+from pathlib import Path
+from typing import List, Tuple
+from concurrent.futures import ProcessPoolExecutor
+
+log.basicConfig(level=log.INFO)
+
+MISSING_SEG = b'<<MISSING>>'
+BUF_SIZE = 1 << 20
+
+
+def read_lines(path: str) -> List[bytes]:
+    with open(path, 'rb') as f:
+        return f.read().split(b'\n')[:-1]   # files end with a newline
+
+
+def merge_pair(src_file: str, out_file: Path, err_file: Path) -> Tuple[int, int]:
+    """Merge the files of one language pair, given its .src.txt file.
+
+    :return: (rows written to out_file, rows written to err_file)
+    """
+    src_lines = read_lines(src_file)
+    n1 = len(src_lines)
+    prefix = src_file[:src_file.rindex('.', 0, -len('.src.txt'))]   # shortest match of .*.src.txt
+    pair = os.path.basename(prefix)
+    tgt = pair.split('-', 1)[1] if '-' in pair else ''
+    meta_file = f'{prefix}.meta.tsv'
+    meta_lines = read_lines(meta_file)
+    if len(meta_lines) != n1:
+        raise Exception(f'ERROR: {src_file} and {meta_file} have different number of lines')
+    meta_cols = [b'\t'.join(line.split(b'\t')[:3]) + b'\t' for line in meta_lines]
+    hyp_files = sorted(glob.glob(f'{glob.escape(prefix)}.*.hyp.txt'))
+
+    n_out = n_err = 0
+    with open(out_file, 'wb', buffering=BUF_SIZE) as out, open(err_file, 'wb', buffering=BUF_SIZE) as err:
+        for ref_file in sorted(glob.glob(f'{glob.escape(prefix)}.*.ref.txt')):
+            ref_lines = read_lines(ref_file)
+            if len(ref_lines) != n1:
+                log.error(f'ERROR: {src_file} and {ref_file} have different number of lines')
+                continue
+            ref_name = ref_file.replace(f'{prefix}.{tgt}.', '', 1).replace('.ref.txt', '', 1)
+            if 're' not in ref_name:   # as `[[ $ref_name =~ ref* ]]` in bash
+                ref_name = 'ref'
+            mids = [b'\t' + s + b'\t' + r + b'\t' for s, r in zip(src_lines, ref_lines)]
+            for hyp_file in hyp_files:
+                hyp_lines = read_lines(hyp_file)
+                if len(hyp_lines) != n1:
+                    log.warning(f'Skip {hyp_file}: {n1} != {len(hyp_lines)}')
+                    continue
+                hyp_name = hyp_file.replace(f'{prefix}.{tgt}.', '', 1).replace('.hyp.txt', '', 1)
+                label = f'{ref_name} {hyp_name}'.encode('utf8')
+                for meta, mid, hyp in zip(meta_cols, mids, hyp_lines):
+                    row = meta + label + mid + hyp + b'\n'
+                    if MISSING_SEG in row:
+                        err.write(row)
+                        n_err += 1
+                    else:
+                        out.write(row)
+                        n_out += 1
+    return n_out, n_err
+
+
+def merge_dataset_as_tsv(src_files: List[str], out_file: Path, jobs: int = None):
+    """Merge language pairs of src_files (.src.txt files) into out_file and out_file._ERRORS"""
+    for src_file in src_files:
+        if not os.path.isfile(src_file):
+            raise Exception(f'ERROR: {src_file} not found')
+    out_file = Path(out_file)
+    err_file = out_file.with_name(out_file.name + '._ERRORS')
+    parts_dir = out_file.with_name(f'.{out_file.name}.parts')
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    parts = [(parts_dir / f'{i}.tsv', parts_dir / f'{i}.err') for i in range(len(src_files))]
+    try:
+        with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            futures = [pool.submit(merge_pair, src_file, out_part, err_part)
+                       for src_file, (out_part, err_part) in zip(src_files, parts)]
+            n_out = n_err = 0
+            for src_file, future in zip(src_files, futures):
+                n1, n2 = future.result()
+                log.info(f'{src_file}: {n1} rows, {n2} rows with missing segments')
+                n_out, n_err = n_out + n1, n_err + n2
+        for dest, idx in [(out_file, 0), (err_file, 1)]:
+            with open(dest, 'wb') as out:
+                for part in parts:
+                    with open(part[idx], 'rb') as inp:
+                        shutil.copyfileobj(inp, out, BUF_SIZE)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    log.info(f'Wrote {n_out} rows to {out_file} and {n_err} to {err_file}')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('src_files', nargs='+', help='.src.txt files of extracted language pairs')
+    parser.add_argument('-o', '--out', type=Path, required=True, help='output TSV file')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='parallel jobs')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    merge_dataset_as_tsv(args.src_files, args.out, jobs=args.jobs)
+
+
+if __name__ == '__main__':
+    main()
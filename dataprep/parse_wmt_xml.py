@@ -4,7 +4,7 @@ import argparse
 import logging as log
 from pathlib import Path
 from xml.etree import ElementTree as ET
-from typing import Iterator, Tuple, List, Dict
+from typing import Iterator, Iterable, Tuple, List, Dict, Set
 from dataclasses import dataclass
 from html import unescape
 from collections import defaultdict
@@ -63,42 +63,68 @@ class WmtDocTrans:
 
 
 def parse_wmt21_xml(data: Path) -> Iterator[WmtDoc]:
-    with open(data, encoding='utf8') as data:
-        root = ET.parse(data)
-        count = 0
-        for doc in root.findall('.//doc'):
-            # Get the attributes of the doc element
-            docid = doc.get('id')
-            srcs = doc.findall('.//src')
-            assert len(srcs) == 1, f'single source expected but found {len(srcs)}'
-            src_segs = extract_segs(srcs[0])
-            result = WmtDoc(id=docid, lang=doc.get('origlang'), src=src_segs, refs=[], hyps=[])
-
-            ref_docs = doc.findall('.//ref') or []
-            hyp_docs = doc.findall('.//hyp') or []
-            if not ref_docs or not hyp_docs:
-                log.warning(f'doc {docid} has {len(ref_docs)} refs and {len(hyp_docs)} hyps')
-
-            for ref_doc in ref_docs:
-                tgt_doc = WmtDocTrans(id=docid, lang=ref_doc.get('lang'),
-                                    by=ref_doc.get('translator'), is_human=True,
-                                    segs=extract_segs(ref_doc))
-                result.refs.append(tgt_doc)
-            for hyp_doc in hyp_docs:
-                tgt_doc = WmtDocTrans(id=docid, lang=hyp_doc.get('lang'),
-                                    by=hyp_doc.get('system'), is_human=False,
-                                    segs=extract_segs(hyp_doc))
-                result.hyps.append(tgt_doc)
-            yield result
-            count += 1
-        log.info(f"read {count} docs from {data.name.split('/')[-1]}")
+    """Stream docs of a WMT21+ XML file; each <doc> element is removed from its parent once it has been yielded,
+    so memory is bounded by the largest doc rather than the whole file."""
+    count = 0
+    stack = []   # open elements; the parent of an ended element is the last one
+    for event, doc in ET.iterparse(data, events=('start', 'end')):
+        if event == 'start':
+            stack.append(doc)
+            continue
+        stack.pop()
+        if doc.tag != 'doc':
+            continue
+        # Get the attributes of the doc element
+        docid = doc.get('id')
+        srcs = doc.findall('.//src')
+        assert len(srcs) == 1, f'single source expected but found {len(srcs)}'
+        src_segs = extract_segs(srcs[0])
+        result = WmtDoc(id=docid, lang=doc.get('origlang'), src=src_segs, refs=[], hyps=[])
+
+        ref_docs = doc.findall('.//ref') or []
+        hyp_docs = doc.findall('.//hyp') or []
+        if not ref_docs or not hyp_docs:
+            log.warning(f'doc {docid} has {len(ref_docs)} refs and {len(hyp_docs)} hyps')
+
+        for ref_doc in ref_docs:
+            tgt_doc = WmtDocTrans(id=docid, lang=ref_doc.get('lang'),
+                                by=ref_doc.get('translator'), is_human=True,
+                                segs=extract_segs(ref_doc))
+            result.refs.append(tgt_doc)
+        for hyp_doc in hyp_docs:
+            tgt_doc = WmtDocTrans(id=docid, lang=hyp_doc.get('lang'),
+                                by=hyp_doc.get('system'), is_human=False,
+                                segs=extract_segs(hyp_doc))
+            result.hyps.append(tgt_doc)
+        yield result
+        if stack:
+            stack[-1].remove(doc)   # a cleared doc would stay attached to its parent (e.g. <collection>)
+        count += 1
+    log.info(f"read {count} docs from {Path(data).name}")
 
 
-def read_sgm_docs(src: Path, ref: Path, *hyps: List[Path], year: int=None) -> Iterator[WmtDoc]:
-    parser = read_sgm_xml
-    if year == 2010:
-        parser = read_wmt10_xml
+def wmt21_ref_names(data: Path) -> Set[str]:
+    """Translator names of all refs in a WMT21+ XML file; a cheap pass that keeps no segments in memory"""
+    names = set()
+    stack = []
+    for event, elem in ET.iterparse(data, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag == 'ref':
+                names.add(elem.get('translator'))
+            continue
+        stack.pop()
+        if elem.tag == 'doc' and stack:
+            stack[-1].remove(elem)
+    return names
+
 
+def sgm_parser(year: int=None):
+    return read_wmt10_xml if year == 2010 else read_sgm_xml
+
+
+def read_sgm_docs(src: Path, ref: Path, *hyps: List[Path], year: int=None) -> Iterator[WmtDoc]:
+    parser = sgm_parser(year)
     src_doc = parser(src)
     ref_doc = parser(ref)
     hyp_docs = [parser(hyp) for hyp in hyps]
@@ -137,8 +163,8 @@ def read_sgm_xml(path: Path) -> Iterator[str]:
     return result
 
 
-def read_wmt10_xml(path: Path, year=2010):
-    root = parse_xml_tree(path, year=year)
+def read_wmt10_xml(path: Path):
+    root = parse_xml_tree(path)
     result = {}
     set_el = root.xpath('//mteval/*[1]')[0]
     lang, sysid = '', ''
@@ -159,30 +185,19 @@ def read_wmt10_xml(path: Path, year=2010):
                             is_human=sysid.startswith('reference') or sysid == '_ref')
     return result
 
-def parse_xml_tree(path: Path, year=None) -> etree.ElementTree:
-    # some files arent XML/HTML escaped. so we read it as string and escape
+def parse_xml_tree(path: Path) -> etree.ElementTree:
+    # some files arent XML/HTML escaped or valid utf8; lxml with recover=True handles them
     if not path.exists():
         raise Exception(f'{path} not found')
-    encoding_trials = ['utf8', 'latin1']
-    data = None
-    for encoding in encoding_trials:
-        try:
-            with open(path, encoding=encoding, errors='replace') as stream:
-                data = stream.read()
-                if encoding != 'utf8':
-                    data = data.encode(encoding, errors='replace').decode('utf8')
-                break
-        except:
-            log.warning(f'Unable to read file {path} using {encoding}')
-    if not data:
-        raise Exception(f'Unable to read file {path} using any of the encodings {encoding_trials}')
-    data = data.replace('<DOC ', '<doc ') # some files have <DOC> instead of <doc>
-    if year in (2010, 'wmt10'):
-        # these files got <?xml encoding="UTF-8"> which requires byte array input
-        data = data.encode('utf-8')  # to bytes
+    data = path.read_bytes()
+    try:
+        data.decode('utf8')
+    except UnicodeDecodeError:
+        log.warning(f'{path} is not valid utf8; replacing invalid bytes')
+        data = data.decode('utf8', errors='replace').encode('utf8')
+    data = data.replace(b'<DOC ', b'<doc ') # some files have <DOC> instead of <doc>
     try:
-        #data = data.replace('&', '&amp;')
-        #root = ET.fromstring(data)
+        # bytes input, as some files have <?xml encoding="UTF-8"> which lxml rejects for str input
         parser = etree.XMLParser(recover=True, encoding='utf-8')
         root = etree.fromstring(data, parser=parser)
         return root
@@ -191,11 +206,27 @@ def parse_xml_tree(path: Path, year=None) -> etree.ElementTree:
         raise
 
 
-def write_out_multifile(docs: List[WmtDoc], out_dir: Path, langs:Tuple[str, str], year):
+# WMT21 onwards not all trabslations have translated  all docs
+MISSING_SEG='<<MISSING>>'
+UNKNOWN_NAME='__UNKNOWN__'
 
+def norm_name(name):
+    if not name:
+        name = UNKNOWN_NAME
+    return name.replace('.', '_')
+
+def out_prefix(out_dir: Path, langs:Tuple[str, str]) -> Tuple[str, str, str]:
     src_lang, tgt_lang = lang2code(langs[0], stdize=True), lang2code(langs[1], stdize=True)
     pref = f'{out_dir}/{src_lang}-{tgt_lang}/{src_lang}-{tgt_lang}'
     Path(pref).parent.mkdir(parents=True, exist_ok=True)
+    return pref, src_lang, tgt_lang
+
+
+def write_out_multifile(docs: Iterable[WmtDoc], out_dir: Path, langs:Tuple[str, str], year, ref_names: Set[str]=None):
+    """Write docs as line-aligned src, meta, ref and hyp files. Docs are written as they arrive;
+    ref_names (all ref translators) are needed upfront to pad missing refs. If not given, docs are buffered to find them."""
+
+    pref, src_lang, tgt_lang = out_prefix(out_dir, langs)
     src_file = f'{pref}.{src_lang}.src.txt'
     meta_file = f'{pref}.meta.tsv'
 
@@ -205,17 +236,11 @@ def write_out_multifile(docs: List[WmtDoc], out_dir: Path, langs:Tuple[str, str]
             fopen_cache[path] = open(path, mode=mode, encoding='utf-8', errors='replace')
         return fopen_cache[path]
 
-    # WMT21 onwards not all trabslations have translated  all docs
-    MISSING_SEG='<<MISSING>>'
-    UNKNOWN_NAME='__UNKNOWN__'
-
-    def norm_name(name):
-        if not name:
-            name = UNKNOWN_NAME
-        return name.replace('.', '_')
-
     try:
-        all_ref_names = {norm_name(ht_doc.by) for doc in docs for ht_doc in doc.refs }
+        if ref_names is None:
+            docs = list(docs)  # buffer in memory
+            ref_names = {ht_doc.by for doc in docs for ht_doc in doc.refs}
+        all_ref_names = {norm_name(name) for name in ref_names}
 
         for doc in docs:
             order = []
@@ -255,28 +280,78 @@ def write_out_multifile(docs: List[WmtDoc], out_dir: Path, langs:Tuple[str, str]
         for f in fopen_cache.values():
             f.close()
 
+
+def write_out_sgm(src: Path, ref: Path, hyps: List[Path], out_dir: Path, langs:Tuple[str, str], year):
+    """Write SGM/XML src, ref and hyp files in the layout of write_out_multifile, one hyp file at a time.
+
+    Source and reference are parsed once and written first; then each hyp file is parsed and its .hyp.txt is
+    written in source doc order, so only one system's docs are in memory at any time.
+    Docs are skipped as in read_sgm_docs: src docs whose ref segment count differs are dropped,
+    and hyp docs that are missing or whose segment count differs are left out of that hyp file.
+    """
+    parser = sgm_parser(year)
+    kept = []   # [(docid, [seg ids])] of written src docs
+    def track(docs):
+        for doc in docs:
+            kept.append((doc.id, [id for id, _ in doc.src]))
+            yield doc
+    write_out_multifile(track(read_sgm_docs(src, ref, year=year)), out_dir, langs=langs, year=year)
+
+    pref, _, tgt_lang = out_prefix(out_dir, langs)
+    written = set()
+    for hyp_file in hyps:
+        hyp_docs = parser(hyp_file)
+        fopen_cache = {}
+        try:
+            for docid, order in kept:
+                if docid not in hyp_docs:
+                    log.warning(f'doc {docid} not found in {hyp_file.name}')
+                    continue
+                hdoc = hyp_docs[docid]
+                if len(order) != len(hdoc['segs']):
+                    log.warning(f'number of segments in src and hyp do not match  {len(order)} != {len(hdoc["segs"])}')
+                    continue
+                if hdoc['by'] == 'ref':
+                    log.warning(f'found a hyp that claims to be a ref skipping it')
+                    continue
+                hyp_path = f'{pref}.{tgt_lang}.{norm_name(hdoc["by"])}.hyp.txt'
+                if hyp_path not in fopen_cache:
+                    # another hyp file of the same system is appended to, rather than overwritten
+                    mode = 'a' if hyp_path in written else 'w'
+                    fopen_cache[hyp_path] = open(hyp_path, mode=mode, encoding='utf-8', errors='replace')
+                    written.add(hyp_path)
+                hyp_out = fopen_cache[hyp_path]
+                lookup = {k: v for k, v in hdoc['segs']}
+                for seg_id in order:
+                    hyp_out.write(f'{lookup.get(seg_id, MISSING_SEG)}\n')
+        finally:
+            for f in fopen_cache.values():
+                f.close()
+        del hyp_docs
+
+
 def main(**args):
     year = args['year']
     if year.startswith('wmt'):
         year = int(year[3:])
         if year < 100:
             year += 2000
+    ref_names = None
     if year >= 2021:
         assert len(args['inp']) == 1, 'only one input file expected for wmt21'
+        ref_names = wmt21_ref_names(args['inp'][0])
         docs = parse_wmt21_xml(args['inp'][0])
-    elif 2009 == year or 2011 <= year <= 2020:
-        assert len(args['inp']) >= 3, 'At least three input files expected for wmt11-20'
-        docs = read_sgm_docs(*args['inp'])
-    elif year == 2010:
-        assert len(args['inp']) >= 3, 'At least three input files expected for wmt11-20'
-        docs = read_sgm_docs(*args['inp'], year=year)
+    elif 2009 <= year <= 2020:
+        assert len(args['inp']) >= 3, 'At least three input files expected for wmt09-20'
+        src, ref, *hyps = args['inp']
+        write_out_sgm(src, ref, hyps, args['out'], year=year, langs=args['langs'])
+        return
     elif 2008 == year:
         raise Exception('WMT 2008 system XML files are malformed XML. They forgot to close </doc> tags for some. So I am skipping them for now :(')
     else:
         raise Exception(f'year {args["year"]} not supported yet')
 
-    docs = list(docs)  # buffer in memory
-    write_out_multifile(docs, args['out'], year=year, langs=args['langs'])
+    write_out_multifile(docs, args['out'], year=year, langs=args['langs'], ref_names=ref_names)
 
 
 def parse_args():
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Shuffle the rows of a merged TSV (see merge_wmt_tsv.py) at document level, keeping the rows of a doc together.
+
+A doc is the set of rows with the same first K columns (default: year, pair, docid), wherever they are in the input.
+Memory is bounded by external bucketing: rows are first spread over bucket files on disk by a seeded hash of their
+doc key, then buckets are read back one at a time in random order, and their docs are shuffled in memory.
+So input is read once and buckets once, and only one bucket (about 1/BUCKETS of the input) is in memory at a time.
+Output is deterministic for a seed.
+
+Shuffled rows go to stdout (or -o), or are split into --dev (the first docs, up to --dev-size rows) and --train.
+Splits are at doc boundaries, so no doc is in both.
+"""
+import sys
+import zlib
+import random
+import argparse
+import tempfile
+import logging as log
+from pathlib import Path
+from typing import Iterator, List
+
+log.basicConfig(level=log.INFO)
+
+BUF_SIZE = 1 << 20
+
+
+def doc_key(row: bytes, k: int) -> bytes:
+    return b'\t'.join(row.split(b'\t', k)[:k])
+
+
+def bucketize(inp, tmp_dir: Path, n_buckets: int, k: int, seed: int) -> List[Path]:
+    """Spread rows over bucket files by a seeded hash of their doc key"""
+    paths = [tmp_dir / f'{i}.tsv' for i in range(n_buckets)]
+    outs = [open(path, 'wb', buffering=BUF_SIZE // 16) for path in paths]
+    try:
+        count = 0
+        for row in inp:
+            if not row.endswith(b'\n'):
+                row += b'\n'
+            outs[zlib.crc32(doc_key(row, k), seed) % n_buckets].write(row)
+            count += 1
+    finally:
+        for out in outs:
+            out.close()
+    log.info(f'Spread {count} rows over {n_buckets} buckets')
+    return paths
+
+
+def shuffle_docs(inp, n_buckets=256, k=3, seed=1, tmp_dir=None) -> Iterator[List[bytes]]:
+    """Read rows from binary stream inp and yield docs (lists of rows, in input order) in random order"""
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory(prefix='shuffledocs.', dir=tmp_dir) as tmp:
+        paths = bucketize(inp, Path(tmp), n_buckets=n_buckets, k=k, seed=seed)
+        rng.shuffle(paths)
+        for path in paths:
+            docs = {}
+            with open(path, 'rb') as f:
+                for row in f:
+                    docs.setdefault(doc_key(row, k), []).append(row)
+            path.unlink()
+            keys = list(docs)
+            rng.shuffle(keys)
+            for key in keys:
+                yield docs.pop(key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-i', '--inp', type=Path, help='input TSV file; default: stdin')
+    parser.add_argument('-o', '--out', type=Path, help='output TSV file, when not splitting; default: stdout')
+    parser.add_argument('-k', '--key', type=int, default=3, help='number of leading columns that identify a doc')
+    parser.add_argument('-s', '--seed', type=int, default=1, help='random seed')
+    parser.add_argument('-b', '--buckets', type=int, default=256,
+                        help='number of buckets; increase it for inputs larger than 256 x available memory')
+    parser.add_argument('-t', '--tmp', type=Path, help='dir for bucket files; default: system temp dir')
+    parser.add_argument('--dev', type=Path, help='dev split output; requires --dev-size and --train')
+    parser.add_argument('--dev-size', type=int, help='rows in dev split; rounded up to a doc boundary')
+    parser.add_argument('--train', type=Path, help='train split output (rows not in dev)')
+    args = parser.parse_args()
+    split = bool(args.dev or args.train)
+    if split and not (args.dev and args.train and args.dev_size is not None):
+        parser.error('--dev, --dev-size and --train are required together')
+
+    inp = open(args.inp, 'rb', buffering=BUF_SIZE) if args.inp else sys.stdin.buffer
+    if split:
+        outs = [open(args.dev, 'wb', buffering=BUF_SIZE), open(args.train, 'wb', buffering=BUF_SIZE)]
+    else:
+        outs = [open(args.out, 'wb', buffering=BUF_SIZE) if args.out else sys.stdout.buffer]
+    try:
+        counts = [0] * len(outs)
+        idx = 0
+        for doc in shuffle_docs(inp, n_buckets=args.buckets, k=args.key, seed=args.seed, tmp_dir=args.tmp):
+            if split and idx == 0 and counts[0] >= args.dev_size:
+                idx = 1
+            outs[idx].writelines(doc)
+            counts[idx] += len(doc)
+        if split:
+            log.info(f'Wrote {counts[0]} rows to {args.dev} and {counts[1]} rows to {args.train}')
+    finally:
+        for out in outs:
+            out.close()
+        inp.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+"""Vectorized system-level pairwise accuracy.
+
+Accuracy is computed as in Kocmi et al. (2021) and mt_metrics_eval's global accuracy:
+a pair of systems agrees when sign(gold[a] - gold[b]) == sign(metric[a] - metric[b]),
+and global accuracy is the total agreement over the total number of pairs across language pairs.
+Missing scores (NaN) drop the affected pairs, like None values in mt_metrics_eval.
+"""
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from . import log
+from .score import read_tsv
+
+
+def pairwise_agreement(gold: np.ndarray, scores: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Count pairwise agreement of many metrics with gold scores.
+
+    :param gold: gold scores of systems, shape [n_sys]; NaN for missing
+    :param scores: metric scores of systems, shape [n_metrics, n_sys]; NaN for missing
+    :return: (agree, num_pairs), both of shape [n_metrics]
+    """
+    scores = np.atleast_2d(scores)
+    left, right = np.triu_indices(len(gold), k=1)
+    gold_diff = np.sign(gold[left] - gold[right])
+    metric_diff = np.sign(scores[:, left] - scores[:, right])
+    valid = ~np.isnan(gold_diff) & ~np.isnan(metric_diff)
+    agree = (gold_diff == metric_diff) & valid
+    return agree.sum(axis=1), valid.sum(axis=1)
+
+
+def _to_array(values) -> np.ndarray:
+    return np.array([np.nan if x is None else x for x in values], dtype=np.float64)
+
+
+def _score_matrix(scores, sys_names: List[str], n_items: int) -> np.ndarray:
+    """[n_sys x n_items] array of a sys -> scores map; NaN for missing systems and scores"""
+    if hasattr(scores, 'matrix'):  # mtme_data.ScoreArray
+        return scores.matrix(sys_names)
+    missing = [None] * n_items
+    return np.array([_to_array(scores.get(s, missing)) for s in sys_names]).reshape(len(sys_names), n_items)
+
+
+def select_systems(evs, gold_name: str, include_human: bool, include_outliers: bool = False,
+                   main_refs=None, close_refs=frozenset(), level='sys') -> Tuple[List[str], np.ndarray]:
+    """Select systems that participate in evaluation of an EvalSet.
+
+    Mirrors the system selection of `mt_metrics_eval.data.GetCorrelations`: systems having gold scores,
+    without the references in use, and optionally without human and outlier systems.
+    :param level: 'sys' or 'seg'
+    :return: (sys_names, gold_scores)  where gold_scores is an array aligned with sys_names;
+        shape [n_sys] for sys level and [n_sys, n_segs] for seg level, with NaN for missing scores
+    """
+    main_refs = {evs.std_ref} if main_refs is None else set(main_refs)
+    gold = evs.Scores(level, gold_name)
+    if gold is None:
+        raise ValueError(f'No {level}-level scores for {gold_name} in {evs.lp}')
+    sys_names = set(gold) - main_refs - set(close_refs)
+    if not include_human:
+        sys_names -= evs.human_sys_names
+    if not include_outliers:
+        sys_names -= evs.outlier_sys_names
+    sys_names = sorted(sys_names)
+    if level == 'sys':
+        gold_scores = _score_matrix(gold, sys_names, 1)[:, 0]
+        keep = ~np.isnan(gold_scores)
+        return [s for s, k in zip(sys_names, keep) if k], gold_scores[keep]
+    return sys_names, _score_matrix(gold, sys_names, len(evs.src))
+
+
+def global_accuracy(sys_scores: Dict[str, Dict[str, np.ndarray]], eval_sets: Dict, gold_name: str,
+                    include_human: bool) -> np.ndarray:
+    """Compute global accuracy of many candidates across language pairs at once.
+
+    :param sys_scores: lp -> sys_name -> array of shape [n_candidates]
+    :param eval_sets: lp -> EvalSet
+    :param gold_name: name of human scores to use as gold
+    :param include_human: include human translations as systems
+    :return: accuracy per candidate, shape [n_candidates]
+    """
+    total_agree, total_pairs = 0, 0
+    for lp, evs in eval_sets.items():
+        sys_names, gold = select_systems(evs, gold_name=gold_name, include_human=include_human)
+        lp_scores = sys_scores[lp]
+        n_cands = len(next(iter(lp_scores.values())))
+        missing = np.full(n_cands, np.nan)
+        scores = np.stack([lp_scores.get(s, missing) for s in sys_names], axis=1)
+        agree, num_pairs = pairwise_agreement(gold, scores)
+        total_agree = total_agree + agree
+        total_pairs = total_pairs + num_pairs
+    return total_agree / np.maximum(total_pairs, 1)
+
+
+def metric_matrix(evs, sys_names: List[str], main_refs, primary_metrics=False, level='sys') -> Tuple[List[str], np.ndarray]:
+    """Stack scores of the stored metrics of an EvalSet into a matrix.
+
+    Only metrics whose references are a subset of main_refs are used, as in `mt_metrics_eval.data.GetCorrelations`.
+    :param evs: EvalSet
+    :param sys_names: systems (columns of the matrix)
+    :param main_refs: references in use
+    :param primary_metrics: use only primary metrics
+    :param level: 'sys' or 'seg'
+    :return: (metric_names, scores) where scores has shape [n_metrics, n_sys] for sys level
+        and [n_metrics, n_sys, n_segs] for seg level; NaN for missing scores
+    """
+    metric_names = evs.primary_metrics if primary_metrics else evs.metric_names
+    n_segs = 1 if level == 'sys' else len(evs.src)
+    names, rows = [], []
+    for name in sorted(metric_names):
+        if not evs.ReferencesUsed(name).issubset(main_refs):
+            continue
+        scores = evs.Scores(level, name)
+        if scores is None:
+            continue
+        names.append(name)
+        rows.append(_score_matrix(scores, sys_names, n_segs))
+    shape = (len(names), len(sys_names)) if level == 'sys' else (len(names), len(sys_names), n_segs)
+    return names, np.array(rows, dtype=np.float64).reshape(shape)
+
+
+def compare_metrics_with_global_accuracy(evs_list, main_refs_list, close_refs_list, include_human: bool,
+                                         include_outliers: bool, gold_name: str, primary_metrics: bool):
+    """Native replacement of `mt_metrics_eval.data.CompareMetricsWithGlobalAccuracy` for k=0 (no significance tests).
+
+    System scores of each language pair are stacked into a [metrics x systems] matrix, and agreement
+    with gold is computed for all metrics and all system pairs at once.
+    Metrics are identified by display names and must be available in all language pairs.
+
+    :return: (metrics, sig_matrix) where metrics is an ordered map of metric -> (accuracy, rank), sorted by accuracy.
+      Since significance is not tested, sig_matrix has p-value 1 for every pair and all metrics share rank 1.
+    """
+    total_agree, total_pairs = {}, {}
+    for evs, main_refs, close_refs in zip(evs_list, main_refs_list, close_refs_list):
+        gold = evs.StdHumanScoreName('sys') if gold_name == 'std' else gold_name
+        sys_names, gold_scores = select_systems(evs, gold_name=gold, include_human=include_human,
+                                                include_outliers=include_outliers,
+                                                main_refs=main_refs, close_refs=close_refs)
+        names, scores = metric_matrix(evs, sys_names, main_refs=main_refs, primary_metrics=primary_metrics)
+        agree, num_pairs = pairwise_agreement(gold_scores, scores)
+        for name, a, n in zip(names, agree, num_pairs):
+            name = evs.DisplayName(name)
+            total_agree.setdefault(name, []).append(a)
+            total_pairs.setdefault(name, []).append(n)
+
+    n_lps = len(evs_list)
+    incomplete = [name for name, vals in total_agree.items() if len(vals) != n_lps]
+    if incomplete:
+        log.warning(f'Skipping {len(incomplete)} metrics that are not available in all {n_lps} language pairs: {incomplete}')
+    accs = {name: sum(total_agree[name]) / max(sum(total_pairs[name]), 1)
+            for name in total_agree if name not in incomplete}
+    accs = dict(sorted(accs.items(), key=lambda x: x[1], reverse=True))
+    metrics = {name: (float(acc), 1) for name, acc in accs.items()}
+    sig_matrix = np.ones((len(metrics), len(metrics)))
+    return metrics, sig_matrix
+
+
+def read_score_matrix(paths: List[Path], matrix=False) -> Tuple[List[str], np.ndarray]:
+    """Read candidate scores aligned with the rows of flat file.
+
+    :param paths: score files having one score per line. If matrix=True, a single file with one column per candidate
+    :param matrix: read paths[0] as a matrix of whitespace separated columns, with an optional header of names
+    :return: (names, scores) where scores has shape [n_rows, n_candidates]
+    """
+    if not matrix:
+        cols = []
+        for path in paths:
+            with open(path) as f:
+                cols.append(np.array(f.read().split(), dtype=np.float64))
+        n_rows = {len(col) for col in cols}
+        assert len(n_rows) == 1, f'Score files have different number of lines: {dict(zip(paths, map(len, cols)))}'
+        return [str(p) for p in paths], np.stack(cols, axis=1)
+
+    assert len(paths) == 1, 'Only one matrix file is expected'
+    with open(paths[0]) as f:
+        rows = [line.split() for line in f]
+    try:
+        float(rows[0][0])
+        names = [f'col{i+1}' for i in range(len(rows[0]))]
+    except ValueError:
+        names, rows = rows[0], rows[1:]
+    assert all(len(row) == len(names) for row in rows), f'Expected {len(names)} columns in every row of {paths[0]}'
+    return names, np.array(rows, dtype=np.float64)
+
+
+def flat_row_groups(rows) -> Tuple[np.ndarray, Dict[Tuple[str, str, str], int]]:
+    """Group flat file rows by (lp, ref_name, sys_name).
+
+    :param rows: flat file rows
+    :return: (group id per row, map of (lp, ref_name, sys_name) -> group id)
+    """
+    group_ids = []
+    groups = {}
+    for lp, ref, sys_name, *_ in rows:
+        group_ids.append(groups.setdefault((lp, ref, sys_name), len(groups)))
+    return np.array(group_ids), groups
+
+
+def flat_sys_scores(data_file: Path, seg_scores: np.ndarray, ref_name=None,
+                    row_groups=None) -> Dict[str, Dict[str, np.ndarray]]:
+    """Average segment scores of flat file rows into system scores, for many candidates at once.
+
+    :param data_file: flat file whose rows are aligned with seg_scores
+    :param seg_scores: array of shape [n_rows, n_candidates]
+    :param ref_name: lp -> reference name (or a single name for all lps) to keep. None keeps 'src' (i.e., reference-free)
+    :param row_groups: `flat_row_groups` of data_file, to skip reading it again
+    :return: lp -> sys_name -> mean scores of shape [n_candidates]
+    """
+    group_ids, groups = row_groups or flat_row_groups(read_tsv(data_file))
+    assert len(group_ids) == len(seg_scores), \
+        f"Number of scores does not match number of rows. {len(seg_scores)} != {len(group_ids)}"
+    sums = np.zeros((len(groups), seg_scores.shape[1]))
+    np.add.at(sums, group_ids, seg_scores)
+    counts = np.bincount(group_ids, minlength=len(groups))
+    means = sums / counts[:, None]
+    log.info(f'Averaged {len(group_ids):,} rows into {len(groups):,} systems for {seg_scores.shape[1]} candidates')
+    return group_sys_scores(groups, means, ref_name=ref_name)
+
+
+def group_sys_scores(groups: Dict[Tuple[str, str, str], int], means: np.ndarray,
+                     ref_name=None) -> Dict[str, Dict[str, np.ndarray]]:
+    """Map mean scores of flat file row groups to systems of the reference in use.
+
+    :param groups: (lp, ref_name, sys_name) -> group id, from `flat_row_groups`
+    :param means: array of shape [n_groups, n_candidates]
+    :param ref_name: as in `flat_sys_scores`
+    :return: lp -> sys_name -> mean scores of shape [n_candidates]
+    """
+    result = {}
+    for (lp, ref, sys_name), idx in groups.items():
+        if ref != wanted_ref(lp, ref_name):
+            continue
+        result.setdefault(lp, {})[sys_name] = means[idx]
+    return result
+
+
+def wanted_ref(lp: str, ref_name=None) -> str:
+    """Reference name of lp to keep; see `flat_sys_scores`"""
+    return 'src' if ref_name is None else ref_name.get(lp) if isinstance(ref_name, dict) else ref_name
@@ -0,0 +1,117 @@
+"""Per-metric result cache for the report mode.
+
+Results are stored per (scenario, scorer) and keyed by a fingerprint of the scorer's score files
+and of the human scores used as gold, so that only new or changed metrics need to be recomputed.
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+from collections import defaultdict
+from typing import Dict, List
+
+from . import log
+from .catalog import get_catalog
+
+CACHE_FILE_NAME = 'report-cache.json'
+
+
+def hash_files(paths: List[Path], salt: str = '') -> str:
+    """Fingerprint the contents of files (order insensitive)"""
+    digest = hashlib.sha1(salt.encode())
+    for path in sorted(paths, key=lambda p: (p.name, str(p))):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def find_metric_files(paths: List, testset: str, lps: List[str], levels: List[str]) -> Dict[str, List[Path]]:
+    """Find the stored metric score files used by a scenario.
+
+    :param paths: mt-metrics-eval style root dirs (e.g. base dir and user dir)
+    :param testset: testset name, e.g. wmt23
+    :param lps: language pairs of the scenario
+    :param levels: score levels of interest, e.g. ['sys']
+    :return: map of scorer name (e.g. `COMET-22-refA`) to its score files
+    """
+    files = defaultdict(list)
+    for root in paths:
+        catalog = get_catalog(Path(root) / testset)
+        for lp in lps:
+            for level in levels:
+                for path in catalog.metric_score_files(lp, f'*.{level}.score'):
+                    scorer = path.name.rsplit('.', 2)[0]
+                    files[scorer].append(path)
+    return files
+
+
+def find_stored_metrics(paths: List, testset: str, lps: List[str], levels: List[str]) -> Dict[str, List[str]]:
+    """Find the metric scores of a scenario in score stores (see store.py) of paths.
+
+    :return: map of scorer name to digests of its stored scores
+    """
+    from .store import open_store
+    digests = defaultdict(list)
+    for root in paths:
+        store = open_store(root)
+        if store is None:
+            continue
+        for lp in lps:
+            for _, metric, ref, level, digest in store.entries(testset, lp, levels=levels):
+                digests[f'{metric}-{ref}'].append(digest)
+        store.close()
+    return digests
+
+
+def find_human_files(base_dir, testset: str, lps: List[str], gold_name: str, levels: List[str]) -> List[Path]:
+    """Find the human score files that are used as gold by a scenario"""
+    catalog = get_catalog(Path(base_dir) / testset)
+    files = []
+    for lp in lps:
+        for level in levels:
+            rel_path = f'human-scores/{lp}.{gold_name}.{level}.score'
+            if catalog.exists(rel_path):
+                files.append(catalog.root / rel_path)
+    return files
+
+
+class ResultCache:
+    """JSON backed store of scenario -> scorer -> {key, name, score}"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.data = {}
+        self.dirty = False
+        if self.path.exists():
+            try:
+                self.data = json.loads(self.path.read_text())
+            except ValueError:
+                log.warning(f"Ignoring corrupt result cache {self.path}")
+
+    def get(self, scenario: str, scorer: str, key: str):
+        """Get a cached entry; None if missing or if its key is outdated"""
+        entry = self.data.get(scenario, {}).get(scorer)
+        if entry is None or entry['key'] != key:
+            return None
+        return entry
+
+    def put(self, scenario: str, scorer: str, key: str, name: str, score: float):
+        """Store result of scorer. name=None means the scorer does not participate in the scenario"""
+        self.data.setdefault(scenario, {})[scorer] = dict(key=key, name=name, score=score)
+        self.dirty = True
+
+    def prune(self, scenario: str, scorers):
+        """Drop entries of scorers that no longer exist on disk"""
+        entries = self.data.get(scenario, {})
+        for scorer in set(entries) - set(scorers):
+            del entries[scorer]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+        tmp_path.write_text(json.dumps(self.data, indent=1, sort_keys=True))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,162 @@
+"""Catalog of the files of a testset in mt-metrics-eval layout, to avoid globbing the dataset tree repeatedly.
+
+The catalog of `<root>/<testset>` is stored at `<root>/<testset>.catalog.json`. It lists the files
+(with size, mtime and line count) of documents/, sources/, references/, human-scores/, system-outputs/<lp>/ and
+metric-scores/<lp>/. On each use, only directory mtimes are checked, and only changed directories are listed again.
+Line counts are computed on first request and kept until a file's size or mtime changes.
+Files are listed in directory order, as glob does, so that readers produce rows in the same order as before.
+
+Note: rewriting an existing file in place does not change its directory's mtime; use `refresh(deep=True)`
+(or `python -m evaluate catalog --rebuild`) after such edits.
+"""
+import os
+import json
+import time
+import fnmatch
+from pathlib import Path
+from typing import Dict, List
+
+from . import log
+
+CATALOG_VERSION = 1
+TOP_DIRS = ['documents', 'sources', 'references', 'human-scores', 'system-outputs', 'metric-scores']
+NESTED_DIRS = {'system-outputs', 'metric-scores'}   # have one subdir per language pair
+# dirs modified this recently may change again within their mtime resolution (e.g. 1s on some network filesystems)
+RACY_SEC = 2
+
+_catalogs: Dict[Path, 'Catalog'] = {}
+
+
+def catalog_path(dataset_path: Path) -> Path:
+    dataset_path = Path(dataset_path)
+    return dataset_path.parent / f'{dataset_path.name}.catalog.json'
+
+
+class Catalog:
+    """Files of a testset dir; see module doc"""
+
+    def __init__(self, dataset_path: Path):
+        self.root = Path(dataset_path)
+        self.path = catalog_path(self.root)
+        self.dirs = {}   # relative dir -> {mtime_ns, files: {name: [size, mtime_ns, lines]}, subdirs: [names]}
+        self.dirty = False
+        if self.path.exists():
+            try:
+                data = json.loads(self.path.read_text())
+                if data.get('version') == CATALOG_VERSION:
+                    self.dirs = data['dirs']
+            except ValueError:
+                log.warning(f"Ignoring corrupt catalog {self.path}")
+        self.refresh()
+
+    def refresh(self, deep=False):
+        """Update listing of changed directories. deep=True also checks every file for in-place changes."""
+        for rel in TOP_DIRS:
+            self._scan(rel, deep=deep)
+        self.save()
+
+    def _scan(self, rel: str, deep=False):
+        path = self.root / rel
+        try:
+            mtime_ns = path.stat().st_mtime_ns
+        except FileNotFoundError:
+            self._drop(rel)
+            return
+        entry = self.dirs.get(rel)
+        if entry is None or entry['mtime_ns'] != mtime_ns or deep:
+            old_files = entry['files'] if entry else {}
+            files, subdirs = {}, []
+            with os.scandir(path) as it:
+                for item in it:
+                    if item.is_dir():
+                        subdirs.append(item.name)
+                        continue
+                    stat = item.stat()
+                    old = old_files.get(item.name)
+                    lines = old[2] if old and old[:2] == [stat.st_size, stat.st_mtime_ns] else None
+                    files[item.name] = [stat.st_size, stat.st_mtime_ns, lines]
+            if entry is not None:
+                for sub in set(entry['subdirs']) - set(subdirs):
+                    self._drop(f'{rel}/{sub}')
+            if time.time_ns() - mtime_ns < RACY_SEC * 1e9:
+                mtime_ns = 0   # list again next time
+            new_entry = dict(mtime_ns=mtime_ns, files=files, subdirs=subdirs)
+            if new_entry != entry:
+                self.dirs[rel] = new_entry
+                self.dirty = True
+            entry = new_entry
+        if rel in NESTED_DIRS:
+            for sub in entry['subdirs']:
+                self._scan(f'{rel}/{sub}', deep=deep)
+
+    def _drop(self, rel: str):
+        for key in [k for k in self.dirs if k == rel or k.startswith(rel + '/')]:
+            del self.dirs[key]
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty or not self.root.exists():
+            return
+        tmp_path = self.path.with_name(f'.{self.path.name}.{os.getpid()}.tmp')
+        try:
+            tmp_path.write_text(json.dumps(dict(version=CATALOG_VERSION, dirs=self.dirs)))
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+        except OSError as e:   # e.g. read-only dataset dir; catalog is still used in memory
+            log.debug(f"Could not save catalog {self.path}: {e}")
+
+    def names(self, rel: str, pattern='*') -> List[str]:
+        """Names of files in dir (relative to testset) that match glob pattern"""
+        files = self.dirs.get(rel, {}).get('files', {})
+        if pattern == '*':
+            return list(files)
+        return [name for name in files if fnmatch.fnmatchcase(name, pattern)]
+
+    def subdirs(self, rel: str) -> List[str]:
+        return list(self.dirs.get(rel, {}).get('subdirs', []))
+
+    def paths(self, rel: str, pattern='*') -> List[Path]:
+        return [self.root / rel / name for name in self.names(rel, pattern)]
+
+    def exists(self, rel_path: str) -> bool:
+        rel, _, name = rel_path.rpartition('/')
+        return name in self.dirs.get(rel, {}).get('files', {})
+
+    def lines(self, rel_path: str) -> int:
+        """Number of lines in file; counted once and cached until file's size or mtime changes"""
+        rel, _, name = rel_path.rpartition('/')
+        info = self.dirs[rel]['files'][name]
+        stat = (self.root / rel_path).stat()
+        if info[:2] != [stat.st_size, stat.st_mtime_ns]:
+            info[:] = [stat.st_size, stat.st_mtime_ns, None]
+        if info[2] is None:
+            with open(self.root / rel_path, 'rb') as f:
+                info[2] = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1 << 20), b''))
+            self.dirty = True
+        return info[2]
+
+    def lps(self) -> List[str]:
+        return [name[:-len('.txt')] for name in self.names('sources', '*.txt')]
+
+    def ref_names(self, lp: str) -> List[str]:
+        return [name.split('.')[-2] for name in self.names('references', f'{lp}.*.txt')]
+
+    def sys_names(self, lp: str) -> List[str]:
+        return [name[:-len('.txt')] for name in self.names(f'system-outputs/{lp}', '*.txt')]
+
+    def human_score_files(self, lp: str) -> List[Path]:
+        return self.paths('human-scores', f'{lp}.*.score')
+
+    def metric_score_files(self, lp: str, pattern='*.score') -> List[Path]:
+        return self.paths(f'metric-scores/{lp}', pattern)
+
+
+def get_catalog(dataset_path: Path) -> Catalog:
+    """Catalog of testset dir, loaded once per process and refreshed on every call"""
+    key = Path(dataset_path).absolute()
+    catalog = _catalogs.get(key)
+    if catalog is None:
+        catalog = _catalogs[key] = Catalog(key)
+    else:
+        catalog.refresh()
+    return catalog
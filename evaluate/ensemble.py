@@ -0,0 +1,265 @@
+"""Search for linear combinations of metrics (and of checkpoint scores) that maximize system-level accuracy.
+
+The table of all metrics (`flatten --table`) is read once, keeping rows of the scenario's language pairs
+and references. Segment scores are averaged into system scores with a sparse group-by matrix, so that a
+combination of metrics is scored at system level: the mean of weighted seg scores is the weighted sum of means.
+Features are z-normalized per language pair across systems, so that weights are comparable across metrics.
+The accuracy of a batch of weight vectors is computed at once: [groups x features] @ [features x candidates]
+gives system scores of all candidates, which `accuracy.global_accuracy` compares with gold in a single pass.
+
+Two searches are run on the scenario's data (weights are fitted, not validated, on it):
+  * grid: all weights on a simplex grid over the most accurate features
+  * coordinate ascent: from the best grid point, the best of all single-weight moves is taken in each round,
+    and the step is halved when no move improves accuracy
+"""
+import fnmatch
+import warnings
+import itertools
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from . import log
+from .trace import span
+from .accuracy import global_accuracy, group_sys_scores, select_systems, wanted_ref
+from .score import TABLE_HUMAN_NAMES, read_tsv
+
+TABLE_ID_COLUMNS = 6   # lp, ref_name, sys_name, src_seg, ref_seg, hyp_seg
+
+
+def read_table(table_file: Path, ref_names: Dict[str, str], patterns: List[str] = None, noref_only=False
+               ) -> Tuple[List[str], np.ndarray, np.ndarray, Dict[Tuple[str, str, str], int]]:
+    """Read metric columns of the rows of (lp, ref) in ref_names from a table of all metrics.
+
+    :param ref_names: lp -> reference name; rows of other lps and references are skipped
+    :param patterns: fnmatch patterns of metric names to keep (noref metrics are named `<metric>[noref]`);
+        None keeps all metrics
+    :param noref_only: keep reference-free metrics only
+    :return: (metric_names, group_ids, seg_scores, groups) where seg_scores has shape [n_rows, n_metrics]
+        with NaN for NA, and groups is (lp, ref_name, sys_name) -> group id; see `accuracy.flat_row_groups`
+    """
+    rows = read_tsv(table_file)
+    header = next(rows)
+    cols = [i for i, name in enumerate(header) if i >= TABLE_ID_COLUMNS and name not in TABLE_HUMAN_NAMES
+            and (not noref_only or name.endswith('[noref]'))
+            and (not patterns or any(fnmatch.fnmatchcase(name, p) for p in patterns))]
+    assert cols, f'No metric in {table_file} matches {patterns}'
+    group_ids, groups, values = [], {}, []
+    for row in rows:
+        lp, ref, sys_name = row[:3]
+        if ref != ref_names.get(lp):
+            continue
+        group_ids.append(groups.setdefault((lp, ref, sys_name), len(groups)))
+        values.append(['nan' if row[i] == 'NA' else row[i] for i in cols])
+    seg_scores = np.array(values, dtype=np.float64).reshape(len(values), len(cols))
+    return [header[i] for i in cols], np.array(group_ids), seg_scores, groups
+
+
+def group_means(group_ids: np.ndarray, seg_scores: np.ndarray, n_groups: int) -> np.ndarray:
+    """Mean of seg scores of each group, ignoring NaN, as a product with a sparse [groups x rows] matrix.
+    :return: array of shape [n_groups, n_columns]; NaN where a group has no score
+    """
+    from scipy.sparse import csr_matrix
+    n_rows = len(group_ids)
+    membership = csr_matrix((np.ones(n_rows), (group_ids, np.arange(n_rows))), shape=(n_groups, n_rows))
+    valid = ~np.isnan(seg_scores)
+    sums = membership @ np.where(valid, seg_scores, 0)
+    counts = membership @ valid.astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def normalize_per_lp(features: np.ndarray, lps: np.ndarray) -> np.ndarray:
+    """z-normalize features across the systems of each lp, ignoring NaN"""
+    result = np.full_like(features, np.nan)
+    for lp in np.unique(lps):
+        rows = lps == lp
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)   # features without scores in lp
+            mean = np.nanmean(features[rows], axis=0)
+            std = np.nanstd(features[rows], axis=0)
+        std = np.where(np.isnan(std) | (std == 0), 1, std)
+        result[rows] = (features[rows] - mean) / std
+    return result
+
+
+def simplex_grid(n_features: int, steps: int) -> np.ndarray:
+    """Non-negative weights in multiples of 1/steps that sum to 1; shape [C(steps + n - 1, n - 1), n]"""
+    n_bars = steps + n_features - 1
+    combos = list(itertools.combinations(range(n_bars), n_features - 1))
+    bars = np.array(combos, dtype=np.int64).reshape(len(combos), n_features - 1)
+    edges = np.concatenate([np.full((len(bars), 1), -1), bars, np.full((len(bars), 1), n_bars)], axis=1)
+    return (np.diff(edges, axis=1) - 1) / steps
+
+
+def format_weights(names: List[str], weights: np.ndarray, width=3) -> str:
+    return ' + '.join(f'{w:.{width}f}*{name}' for name, w in zip(names, weights) if w != 0)
+
+
+class EnsembleSearch:
+    """System scores of features of a scenario, and batched accuracy of their linear combinations.
+
+    Features that lack the score of a system used by the scenario are dropped (with a warning), as global accuracy
+    skips metrics that are not available in all language pairs: all candidates are then compared on the same
+    system pairs. (Systems without any feature lack the scores of all candidates alike.)
+
+    :param names: feature names
+    :param features: system-level features, shape [n_groups, n_features]; NaN for missing
+    :param groups: (lp, ref_name, sys_name) -> row of features
+    :param eval_sets: lp -> EvalSet of the scenario
+    :param ref_name: lp -> reference name of groups; see `accuracy.flat_sys_scores`
+    :param normalize: 'z' to z-normalize features per lp, or 'none'
+    :param batch_size: candidates per batch, to bound memory
+    """
+
+    def __init__(self, names: List[str], features: np.ndarray, groups: Dict[Tuple[str, str, str], int],
+                 eval_sets: Dict, gold_name: str, include_human: bool, ref_name=None, normalize='z', batch_size=4096):
+        assert features.shape == (len(groups), len(names))
+        self.groups, self.eval_sets = groups, eval_sets
+        self.gold_name, self.include_human, self.ref_name = gold_name, include_human, ref_name
+        self.batch_size = batch_size
+        complete = self.complete_features(features)
+        if not complete.all():
+            log.warning(f'Skipping {(~complete).sum()} features that lack scores of systems of the scenario: '
+                        f'{[name for name, keep in zip(names, complete) if not keep]}')
+            assert complete.any(), 'No feature has scores of all systems of the scenario'
+            names, features = [name for name, keep in zip(names, complete) if keep], features[:, complete]
+        self.names = names
+        if normalize == 'z':
+            lps = np.empty(len(groups), dtype=object)
+            for (lp, _, _), idx in groups.items():
+                lps[idx] = lp
+            features = normalize_per_lp(features, lps)
+        self.missing = np.isnan(features)
+        self.features = np.where(self.missing, 0, features)
+        self.n_evaluated = 0
+
+    def complete_features(self, features: np.ndarray) -> np.ndarray:
+        """Mask of features having scores of all systems that global accuracy uses, among systems having any feature"""
+        rows = np.zeros(len(self.groups), dtype=bool)
+        for lp, evs in self.eval_sets.items():
+            sys_names = set(select_systems(evs, gold_name=self.gold_name, include_human=self.include_human)[0])
+            ref = wanted_ref(lp, self.ref_name)
+            for sys_name in sys_names:
+                idx = self.groups.get((lp, ref, sys_name))
+                if idx is not None:
+                    rows[idx] = True
+        used = features[rows]
+        used = used[~np.isnan(used).all(axis=1)]
+        return ~np.isnan(used).any(axis=0)
+
+    def accuracy(self, weights: np.ndarray) -> np.ndarray:
+        """Accuracy of candidates of shape [n_candidates, n_features]; a system lacks the score of a candidate
+        when it lacks a feature of non-zero weight (only systems that global accuracy skips may lack features)."""
+        weights = np.atleast_2d(weights)
+        accs = np.empty(len(weights))
+        for begin in range(0, len(weights), self.batch_size):
+            batch = weights[begin: begin + self.batch_size]
+            sys_scores = self.features @ batch.T
+            sys_scores[(self.missing.astype(np.float64) @ (batch != 0).T) > 0] = np.nan
+            sys_scores = group_sys_scores(self.groups, sys_scores, ref_name=self.ref_name)
+            accs[begin: begin + len(batch)] = global_accuracy(sys_scores, self.eval_sets, gold_name=self.gold_name,
+                                                              include_human=self.include_human)
+        self.n_evaluated += len(weights)
+        return accs
+
+    def grid(self, features: List[int], steps=10) -> Tuple[np.ndarray, np.ndarray]:
+        """Accuracy of all weights on a simplex grid over the given features
+        :return: (weights, accuracy) of shapes [n_candidates, n_features] and [n_candidates]
+        """
+        points = simplex_grid(len(features), steps)
+        weights = np.zeros((len(points), len(self.names)))
+        weights[:, features] = points
+        with span('ensemble.grid', candidates=len(weights)):
+            return weights, self.accuracy(weights)
+
+    def coordinate_ascent(self, weights: np.ndarray, step=0.5, min_step=0.01, max_rounds=100,
+                          moves=(-1, -0.5, 0.5, 1)) -> Tuple[np.ndarray, float]:
+        """Improve weights by single-weight moves of size step * moves; all moves of a round are one batch.
+        Weights are rescaled to unit L1 norm after each move, since accuracy is invariant to positive scaling.
+        :return: (weights, accuracy)
+        """
+        weights = weights / np.abs(weights).sum()
+        best = float(self.accuracy(weights)[0])
+        deltas = step * np.asarray(moves)
+        n_feats = len(self.names)
+        for round_ in range(max_rounds):
+            if step < min_step:
+                break
+            candidates = np.repeat(weights[None], n_feats * len(deltas), axis=0)
+            candidates[np.arange(len(candidates)), np.repeat(np.arange(n_feats), len(deltas))] += np.tile(deltas, n_feats)
+            keep = np.abs(candidates).sum(axis=1) > 0
+            candidates = candidates[keep]
+            with span('ensemble.ascent', round=round_, candidates=len(candidates)):
+                accs = self.accuracy(candidates)
+            i = int(np.argmax(accs))
+            if accs[i] > best:
+                weights, best = candidates[i] / np.abs(candidates[i]).sum(), float(accs[i])
+                log.info(f'Round {round_}: {best:.4f} {format_weights(self.names, weights)}')
+            else:
+                step /= 2
+                deltas = deltas / 2
+        return weights, best
+
+
+def load_features(table_file: Path, eval_sets: Dict, reference_based=False, patterns: List[str] = None,
+                  data_file: Path = None, score_names: List[str] = None, seg_scores: np.ndarray = None
+                  ) -> Tuple[List[str], np.ndarray, Dict[Tuple[str, str, str], int], Dict[str, str]]:
+    """System-level features: metrics of the table, and optionally candidates' seg scores of a flat file.
+
+    :param reference_based: use all metrics, with the standard reference of each lp; else, reference-free metrics only
+        (their scores are the same in rows of all references)
+    :param data_file: flat file aligned with seg_scores, of shape [n_rows, n_candidates]
+    :return: (names, features, groups, ref_names); see `EnsembleSearch`
+    """
+    from .accuracy import flat_sys_scores
+    ref_names = {lp: evs.std_ref for lp, evs in eval_sets.items()}
+    with span('ensemble.load', file=table_file.name) as sp:
+        names, group_ids, table_scores, groups = read_table(table_file, ref_names, patterns=patterns,
+                                                            noref_only=not reference_based)
+        sp.set_rows(len(group_ids))
+    with span('ensemble.sys_scores', rows=len(group_ids), metrics=len(names)):
+        features = group_means(group_ids, table_scores, len(groups))
+    log.info(f'Averaged {len(group_ids):,} rows into {len(groups):,} systems for {len(names)} metrics of {table_file.name}')
+    if seg_scores is not None:
+        flat_ref = ref_names if reference_based else None
+        sys_scores = flat_sys_scores(data_file, seg_scores, ref_name=flat_ref)
+        extra = np.full((len(groups), seg_scores.shape[1]), np.nan)
+        for (lp, _, sys_name), idx in groups.items():
+            if sys_name in sys_scores.get(lp, {}):
+                extra[idx] = sys_scores[lp][sys_name]
+        for name, col in zip(score_names, extra.T):
+            if np.isnan(col).all():
+                log.warning(f'{name} has no scores of the systems of the table; is it aligned with {data_file}?')
+        names, features = names + list(score_names), np.concatenate([features, extra], axis=1)
+    return names, features, groups, ref_names
+
+
+def run_search(search: EnsembleSearch, grid_features=4, grid_steps=10, max_rounds=100, top=10) -> dict:
+    """Individual accuracies, grid search over the `grid_features` most accurate features, and coordinate ascent
+    from the best grid point; prints ranked tables and returns the best combination"""
+    names = search.names
+    with span('ensemble.individual', candidates=len(names)):
+        single = search.accuracy(np.eye(len(names)))
+    order = np.argsort(-single, kind='stable')
+    print(f'# individual: {len(names)} features')
+    for rank, i in enumerate(order[:top], start=1):
+        print(f'{rank}\t{single[i]:.4f}\t{names[i]}')
+
+    best_weights, best = np.eye(len(names))[order[0]], float(single[order[0]])
+    k = min(grid_features, len(names))
+    if k > 1:
+        weights, accs = search.grid(list(order[:k]), steps=grid_steps)
+        ranked = np.argsort(-accs, kind='stable')
+        print(f'# grid: {len(weights)} combinations of {k} features in steps of {1 / grid_steps:g}')
+        for rank, i in enumerate(ranked[:top], start=1):
+            print(f'{rank}\t{accs[i]:.4f}\t{format_weights(names, weights[i])}')
+        if accs[ranked[0]] > best:
+            best_weights, best = weights[ranked[0]], float(accs[ranked[0]])
+    if max_rounds:
+        best_weights, best = search.coordinate_ascent(best_weights, max_rounds=max_rounds)
+        print(f'# coordinate ascent over {len(names)} features')
+    print(f'best\t{best:.4f}\t{format_weights(names, best_weights)}')
+    log.info(f'Evaluated {search.n_evaluated:,} candidates')
+    return dict(accuracy=best, weights={name: float(w) for name, w in zip(names, best_weights) if w != 0})
@@ -1,52 +1,19 @@
 #!/usr/bin/env python3
 
+import json
+import numpy as np
 import pandas as pd
 import scipy.stats
 from pathlib import Path
 from mt_metrics_eval import data
 
 from . import log, Config
-
-
-all_scenarios = {
-    # comparable with Table 11
-    "wmt22.mqm_tab11": {
-        "testset": "wmt22",
-        "focus_lps": ['en-de', 'en-ru', 'zh-en'],
-        "gold_name": "mqm",
-        "use_humans": False
-    },
-    #"wmt22.dasqm_tab11": {"testset": "wmt22",
-    #                      "focus_lps": ['en-de', 'en-ru', 'zh-en'],
-    #                      "gold_name": "wmt-appraise",
-    #                      "use_humans": False},
-    # comparable with Table 8
-    "wmt22.da_sqm_tab8": {
-        "testset": "wmt22",
-        "focus_lps": ["en-de", "zh-en", "en-ru", 'cs-uk', 'en-hr', 'en-ja', 'en-liv', 'en-uk', 'en-zh', 'sah-ru', 'uk-cs', 'en-cs'],
-        "gold_name": "wmt-appraise",
-        "use_humans": True
-    },
-    "wmt23.mqm(de;he;zh)": {
-        "testset": "wmt23",
-        "focus_lps": ['en-de', 'he-en', 'zh-en'],
-        "gold_name": "mqm",
-        "use_humans": False
-    },
-    "wmt23.dasqm(de;zh)": {
-        "testset": "wmt23",
-        "focus_lps": ['en-de', 'zh-en'],
-        "gold_name": "da-sqm",
-        "use_humans": True
-    },
-    "wmt23.dasqm(all)": {
-        "testset": "wmt23",
-        "focus_lps": ["cs-uk", "de-en", "en-cs", "en-de", "en-ja", "en-zh", "ja-en", "zh-en"],
-        "gold_name": "da-sqm",
-        "use_humans": True
-    }
-}
-all_scenarios = {k:v for k,v in all_scenarios.items() if v['testset'] == 'wmt23'}  # only wmt23 for now
+from .mtme_data import EvalSet
+from .cache import CACHE_FILE_NAME, ResultCache, find_human_files, find_metric_files, find_stored_metrics, hash_files
+from .accuracy import compare_metrics_with_global_accuracy
+from .segcorr import compare_metrics_seg_kendall, seg_inputs, seg_kendall_metrics
+from .trace import span
+from .scenarios import ENGINES, all_scenarios
 
 
 def reformat(results):
@@ -61,7 +28,8 @@ def reformat(results):
 
 def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
                  include_domains=True, seg_level_no_avg=False,
-                 include_human_with_acc=False, do_reformat=True, testset_name="wmt22", quiet=False):
+                 include_human_with_acc=False, do_reformat=True, testset_name="wmt22", quiet=False,
+                 engine='mtme'):
     """Evaluate all metrics for eval sets, across multiple task settings.
 
     Args:
@@ -79,6 +47,10 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
         level correlations
       include_human_with_acc: If True, include human outputs in accuracy tasks.
       do_reformat: If True, reformat results to match mtme's format.
+      engine: 'mtme' or 'native'. The native engine computes global accuracy and
+        segment-level Kendall tau with vectorized numpy; it has no significance tests,
+        so mtme is used when k > 0. Its ranks and sig_matrix are placeholders: every
+        metric has rank 1 and every pair has p-value 1 (no metric is significantly better).
 
     Returns:
       Map from task names to metric -> (rank, corr, sig_string) stats.
@@ -101,11 +73,18 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
                 main_refs, close_refs, False, primary_only)
             if not quiet:
                 log.info(taskname)
-            result = data.CompareMetricsWithGlobalAccuracy(
-                evs_list, main_refs, close_refs, include_human=human,
-                include_outliers=False, gold_name=gold,
-                primary_metrics=primary_only,
-                domain=None, k=k, pval=0.05)
+            with span('compare.accuracy', engine=engine, k=k, lps=len(langs)):
+                if engine == 'native' and k == 0:
+                    result = compare_metrics_with_global_accuracy(
+                        evs_list, main_refs, close_refs, include_human=human,
+                        include_outliers=False, gold_name=gold,
+                        primary_metrics=primary_only)
+                else:
+                    result = data.CompareMetricsWithGlobalAccuracy(
+                        evs_list, main_refs, close_refs, include_human=human,
+                        include_outliers=False, gold_name=gold,
+                        primary_metrics=primary_only,
+                        domain=None, k=k, pval=0.05)
             metrics, sig_matrix = result[:2]   
             if do_reformat:
                 results[taskname] = reformat((metrics, sig_matrix))
@@ -117,6 +96,9 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
         evs = eval_sets[lp]
         main_refs = {evs.std_ref}
         close_refs = set()
+        # correlation inputs are shared by all correlation functions and averaging modes;
+        # native score matrices are computed once per (level, human) and sliced per domain
+        mtme_inputs, native_inputs = {}, {}
         for domain in [None] + (list(evs.domain_names) if include_domains else []):
             for level in levels:
                 gold = evs.StdHumanScoreName(level) if gold_name == 'std' else gold_name
@@ -132,52 +114,220 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
                                 main_refs, close_refs, False, primary=primary_only)
                             if not quiet:
                                 log.info(taskname)
-                            corrs = data.GetCorrelations(
-                                evs=evs, level=level, main_refs={evs.std_ref},
-                                close_refs=close_refs, include_human=human,
-                                include_outliers=False, gold_name=gold_name,
-                                primary_metrics=primary_only, domain=domain)
-                            result = data.CompareMetrics(
-                                corrs, corr_fcn, average_by=avg, k=k, pval=0.05)
-                            # Make compatible with accuracy results.
-                            metrics, sig_matrix  = result[:2]
-                            metrics = {evs.DisplayName(m): v for m, v in metrics.items()}
+                            if engine == 'native' and k == 0 and level == 'seg' and corr == 'kendall':
+                                if (level, human) not in native_inputs:
+                                    with span('compare.inputs', lp=lp, level=level, engine=engine):
+                                        native_inputs[(level, human)] = seg_inputs(
+                                            evs, main_refs={evs.std_ref}, close_refs=close_refs,
+                                            include_human=human, include_outliers=False, gold_name=gold,
+                                            primary_metrics=primary_only)
+                                with span('compare.corr', lp=lp, level=level, corr=corr, engine=engine):
+                                    metrics, sig_matrix = seg_kendall_metrics(
+                                        evs, native_inputs[(level, human)], average_by=avg, domain=domain)
+                            else:
+                                if (domain, level, human) not in mtme_inputs:
+                                    with span('compare.inputs', lp=lp, level=level, engine='mtme'):
+                                        mtme_inputs[(domain, level, human)] = data.GetCorrelations(
+                                            evs=evs, level=level, main_refs={evs.std_ref},
+                                            close_refs=close_refs, include_human=human,
+                                            include_outliers=False, gold_name=gold_name,
+                                            primary_metrics=primary_only, domain=domain)
+                                corrs = mtme_inputs[(domain, level, human)]
+                                with span('compare.corr', lp=lp, level=level, corr=corr, engine='mtme'):
+                                    result = data.CompareMetrics(
+                                        corrs, corr_fcn, average_by=avg, k=k, pval=0.05)
+                                # Make compatible with accuracy results.
+                                metrics, sig_matrix  = result[:2]
+                                metrics = {evs.DisplayName(m): v for m, v in metrics.items()}
                             if do_reformat:
                                 results[taskname] = reformat((metrics, sig_matrix))
                             else:
                                 results[taskname] = {name: (rank, corr) for name, (corr, rank) in metrics.items()}
     return results
 
-def eval_scenario(paths=Config.DEF_PATHS, quiet=True, scenairo_name='wmt22.da_sqm_tab8', do_reformat=False):
+def load_eval_sets(paths=Config.DEF_PATHS, scenairo_name='wmt22.da_sqm_tab8', metrics=None, read_metrics=True):
+    """Load EvalSets for the language pairs of a scenario.
+
+    Only the scenario's level and gold human scores are read.
+
+    Args:
+      paths: mt-metrics-eval dirs; the first one has the dataset, all of them are searched for metric scores.
+      scenairo_name: name of scenario in `all_scenarios`.
+      metrics: If given, read only these metrics; base names (e.g. `COMET-22`) or scorers (e.g. `COMET-22-refA`).
+      read_metrics: If False, skip stored metric scores and read only the dataset and human scores.
 
+    Returns:
+      Map from lang-pair to EvalSet objects.
+    """
     scenario = all_scenarios[scenairo_name]
     eval_sets = {}
     for lp in scenario['focus_lps']:
-        eval_sets[lp] = data.EvalSet(scenario['testset'], lp, True, path=paths)
+        with span('load_evalset', testset=scenario['testset'], lp=lp):
+            eval_sets[lp] = EvalSet(scenario['testset'], lp, read_metrics, path=paths, metrics=metrics,
+                                    levels=[scenario.get('level', 'sys')], human_names=[scenario['gold_name']])
+    return eval_sets
+
+
+def eval_scenario(paths=Config.DEF_PATHS, quiet=True, scenairo_name='wmt22.da_sqm_tab8', do_reformat=False,
+                  k=0, eval_sets=None, engine=None):
+
+    scenario = all_scenarios[scenairo_name]
+    engine = engine or scenario.get('engine', 'mtme')
+    assert engine in ENGINES, f'Unknown engine {engine}; expected one of {ENGINES}'
+    if eval_sets is None:
+        eval_sets = load_eval_sets(paths=paths, scenairo_name=scenairo_name)
+    if scenario.get('level', 'sys') == 'seg':
+        return eval_seg_scenario(eval_sets, scenario, do_reformat=do_reformat, engine=engine, quiet=quiet)
 
     appraise_results = eval_metrics(
-        eval_sets, scenario['focus_lps'], ['sys'], primary_only=False, k=0,
+        eval_sets, scenario['focus_lps'], ['sys'], primary_only=False, k=k,
         gold_name = scenario['gold_name'], include_domains=False, seg_level_no_avg=True,
         include_human_with_acc=scenario['use_humans'],
         do_reformat=do_reformat, testset_name=scenario['testset'],
-        quiet=quiet)
+        quiet=quiet, engine=engine)
     results = appraise_results[list(appraise_results.keys())[0]]
     return results
 
-def main(paths=Config.DEF_PATHS, out_file=None, testset_name=None):
+
+def eval_seg_scenario(eval_sets, scenario, do_reformat=False, engine='native', quiet=True):
+    """Segment-level Kendall tau of all metrics, averaged over the language pairs of a scenario.
+
+    Metrics must be available in all language pairs. There are no significance tests, so all metrics have rank 1.
+    """
+    average_by, human, gold = scenario['average_by'], scenario['use_humans'], scenario['gold_name']
+    lp_corrs = []
+    for lp in scenario['focus_lps']:
+        evs = eval_sets[lp]
+        if not quiet:
+            log.info(f"{scenario['testset']} {lp} seg-level kendall average_by={average_by} gold={gold}")
+        with span('compare.corr', lp=lp, level='seg', corr='kendall', engine=engine):
+            if engine == 'native':
+                metrics, _ = compare_metrics_seg_kendall(
+                    evs, main_refs={evs.std_ref}, close_refs=set(), include_human=human,
+                    include_outliers=False, gold_name=gold, primary_metrics=False, average_by=average_by)
+            else:
+                corrs = data.GetCorrelations(
+                    evs=evs, level='seg', main_refs={evs.std_ref}, close_refs=set(), include_human=human,
+                    include_outliers=False, gold_name=gold, primary_metrics=False)
+                metrics = data.CompareMetrics(corrs, scipy.stats.kendalltau, average_by=average_by, k=0, pval=0.05)[0]
+                metrics = {evs.DisplayName(m): v for m, v in metrics.items()}
+        lp_corrs.append({name: corr for name, (corr, rank) in metrics.items()})
+
+    names = set.intersection(*[set(corrs) for corrs in lp_corrs])
+    avg_corrs = {name: float(np.mean([corrs[name] for corrs in lp_corrs])) for name in names}
+    metrics = {name: (corr, 1) for name, corr in sorted(avg_corrs.items(), key=lambda x: x[1], reverse=True)}
+    if do_reformat:
+        return reformat((metrics, np.ones((len(metrics), len(metrics)))))
+    return {name: (rank, corr) for name, (corr, rank) in metrics.items()}
+
+
+def verify_engine(paths=Config.DEF_PATHS, scenairo_name='wmt22.da_sqm_tab8', tolerance=1e-9):
+    """Check that the native engine agrees with mt_metrics_eval on a scenario.
+
+    Only accuracies are compared: native ranks are placeholders (see `eval_metrics`).
+
+    Returns:
+      Map from metric display name to (mtme_accuracy, native_accuracy) for the metrics that disagree.
+    """
+    eval_sets = load_eval_sets(paths=paths, scenairo_name=scenairo_name)
+    expected = eval_scenario(scenairo_name=scenairo_name, eval_sets=eval_sets, engine='mtme')
+    got = eval_scenario(scenairo_name=scenairo_name, eval_sets=eval_sets, engine='native')
+    diffs = {}
+    for name in set(expected) | set(got):
+        exp_acc = expected[name][1] if name in expected else None
+        got_acc = got[name][1] if name in got else None
+        if exp_acc is None or got_acc is None or abs(exp_acc - got_acc) > tolerance:
+            diffs[name] = (exp_acc, got_acc)
+    log.info(f"{scenairo_name}: {len(expected)} metrics; {len(diffs)} differ between mtme and native engines")
+    for name, (exp_acc, got_acc) in sorted(diffs.items()):
+        log.warning(f"{name}\tmtme={exp_acc}\tnative={got_acc}")
+    return diffs
+
+
+def cached_eval_scenario(cache: ResultCache, paths=Config.DEF_PATHS, scenairo_name='wmt22.da_sqm_tab8', engine=None):
+    """Evaluate scenario, recomputing only the metrics whose scores (or gold scores) changed since last time.
+
+    Args:
+      cache: per-metric result cache.
+      paths: mt-metrics-eval dirs; the first one has the dataset, all of them are searched for metric scores.
+      scenairo_name: name of scenario in `all_scenarios`.
+      engine: 'mtme' or 'native'; see `eval_metrics`. Default is the scenario's engine, else mtme.
+
+    Returns:
+      Map from metric display name to accuracy.
+    """
+    scenario = all_scenarios[scenairo_name]
+    testset, lps, levels = scenario['testset'], scenario['focus_lps'], [scenario.get('level', 'sys')]
+    with span('cache.hash', scenario=scenairo_name) as sp:
+        gold_files = find_human_files(paths[0], testset, lps, scenario['gold_name'], levels)
+        gold_key = hash_files(gold_files, salt=json.dumps(scenario, sort_keys=True))
+        metric_files = find_metric_files(paths, testset, lps, levels)
+        stored = find_stored_metrics(paths, testset, lps, levels)
+        keys = {scorer: hash_files(metric_files.get(scorer, []), salt=gold_key + ''.join(sorted(stored.get(scorer, []))))
+                for scorer in set(metric_files) | set(stored)}
+        sp.set_rows(sum(len(files) for files in metric_files.values()) + len(gold_files))
+    cache.prune(scenairo_name, keys)
+
+    stale = {scorer for scorer, key in keys.items() if cache.get(scenairo_name, scorer, key) is None}
+    log.info(f"{scenairo_name}: {len(keys) - len(stale)} metrics cached; computing {len(stale)} new or changed metrics")
+    if stale:
+        eval_sets = load_eval_sets(paths=paths, scenairo_name=scenairo_name, metrics=stale)
+        display_names = {}
+        for evs in eval_sets.values():
+            display_names.update({evs.DisplayName(scorer): scorer for scorer in evs.metric_names})
+        results = eval_scenario(paths=paths, quiet=True, scenairo_name=scenairo_name, eval_sets=eval_sets,
+                                engine=engine)
+        found = {}
+        for name, (rank, score) in results.items():
+            found[display_names.get(name, name)] = (name, score)
+        for scorer in stale:
+            name, score = found.get(scorer, (None, None))
+            cache.put(scenairo_name, scorer, keys[scorer], name=name, score=score)
+
+    scores = {}
+    for scorer, key in keys.items():
+        entry = cache.get(scenairo_name, scorer, key)
+        if entry['name'] is not None:
+            scores[entry['name']] = entry['score']
+    return dict(sorted(scores.items(), key=lambda x: x[1], reverse=True))
+
+
+def main(paths=Config.DEF_PATHS, out_file=None, testset_name=None, k=0, use_cache=True, engine=None, scenario_name=None):
+    """Evaluate all metrics for all scenarios and produce a report.
+
+    Args:
+      paths: mt-metrics-eval dirs; the first one has the dataset, all of them are searched for metric scores.
+      out_file: path to CSV file for storing report. An XLSX file is also created next to it.
+      testset_name: If given, evaluate only the scenarios of this testset.
+      scenario_name: If given, evaluate only this scenario.
+      k: Number of boostrap draws for significance tests. If 0, no significance tests are run.
+      use_cache: Reuse the per-metric results cached in the last path (i.e., user dir).
+        Cache is bypassed when k > 0, since significance depends on all metrics.
+      engine: 'mtme' or 'native'; see `eval_metrics`. Default is the scenario's engine, else mtme.
+    """
     all_df = {}
     avail_schenarois = list(all_scenarios.keys())
     if testset_name is not None:
         avail_schenarois = [s for s in avail_schenarois if all_scenarios[s]['testset'] == testset_name]
+    if scenario_name is not None:
+        avail_schenarois = [s for s in avail_schenarois if s == scenario_name]
+    cache = None
+    if use_cache and k == 0:
+        cache = ResultCache(Path(paths[-1]) / CACHE_FILE_NAME)
     for scenario_name in avail_schenarois:
-        results = eval_scenario(paths=paths, quiet=False, scenairo_name=scenario_name, do_reformat=True)
+        with span('scenario', scenario=scenario_name) as sp:
+            if cache is not None:
+                scores = cached_eval_scenario(cache, paths=paths, scenairo_name=scenario_name, engine=engine)
+                cache.save()
+            else:
+                results = eval_scenario(paths=paths, quiet=False, scenairo_name=scenario_name, do_reformat=True, k=k,
+                                        engine=engine)
+                scores = {name: res[1] for name, res in results.items()}
+            sp.set_rows(len(scores))
         log.info(f"Accuracy for scenario {scenario_name}")
-        for key in results.keys():
-            log.info(f"{key}\t{results[key][1]:.3f}")
-
-        df = pd.DataFrame(results)
-        df = df.transpose().drop([0,2], axis=1)
-        all_df[scenario_name] = df[1]
+        for key, score in scores.items():
+            log.info(f"{key}\t{score:.3f}")
+        all_df[scenario_name] = pd.Series(scores, dtype=float)
 
     df = pd.DataFrame(all_df)
     if out_file is not None:
@@ -187,4 +337,3 @@ def main(paths=Config.DEF_PATHS, out_file=None, testset_name=None):
 
 if __name__ == '__main__':
     main(out_file="results.csv")
-    
@@ -0,0 +1,145 @@
+"""Export scored rows as refless training data, in one streaming pass.
+
+Input is a flat file (from `flatten`; 6 columns, or 7 with a score made with --human or --metric)
+or a merged TSV (from dataprep/merge_wmt_tsv.py; year, pair, docid, "ref sys", src, ref, hyp), joined line by line
+with a scores file. Output rows are:
+    langs <TAB> docid <TAB> system <TAB> score <TAB> src <TAB> hyp [<TAB> src_len <TAB> ref_len <TAB> hyp_len]
+Rows having empty columns are dropped (clean=True). Lengths are counted in words or sentencepiece pieces.
+
+Rows are read in chunks which are formatted in worker processes; output keeps input order.
+The output is written to a temp file and renamed, and `<out>._OK` is created when done; exports with the flag are skipped.
+"""
+import os
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List
+
+from . import log
+from .trace import span
+
+FORMATS = ['flat', 'merged']
+LENGTHS = ['words', 'spm']
+
+_spm_models = {}   # per worker process
+
+
+def _length_fn(lengths: str, spm_model: Path = None):
+    if lengths == 'words':
+        return lambda text: len(text.split())
+    assert spm_model, '--spm-model is required for spm lengths'
+    if spm_model not in _spm_models:
+        import sentencepiece as spm
+        _spm_models[spm_model] = spm.SentencePieceProcessor(model_file=str(spm_model))
+    model = _spm_models[spm_model]
+    return lambda text: len(model.encode(text))
+
+
+def refless_row(row: List[str], score: str, fmt='flat') -> List[str]:
+    """Refless row and (src, ref, hyp) of an input row"""
+    if fmt == 'flat':
+        # 0=langs, 1=ref_name, 2=sys_name 3=src_seg 4=ref_seg 5=hyp_seg [6=score]
+        return [row[0], '-', f'{row[1]} {row[2]}', score, row[3], row[5]], row[3:6]
+    # 0=year 1=langs 2=docid 3=sysname 4=src 5=ref 6=hyp
+    return [f'{row[0]}|{row[1]}', row[2], row[3], score, row[4], row[6]], row[4:7]
+
+
+def export_chunk(lines: List[str], scores: List[str], fmt='flat', width: int = None, clean=True,
+                 lengths: str = None, spm_model: Path = None, start=0):
+    """Format a chunk of input lines; scores is None when the score is the last column of lines.
+    :return: (output text, number of rows written)
+    """
+    n_cols = 7 if fmt == 'merged' or scores is None else 6
+    length = lengths and _length_fn(lengths, spm_model)
+    out, n_out = [], 0
+    for i, line in enumerate(lines):
+        row = line.rstrip('\n').split('\t')
+        if len(row) != n_cols:
+            raise ValueError(f'Expected {n_cols} columns, got {len(row)} at line {start + i + 1}: {line}')
+        score = row[-1] if scores is None else scores[i].rstrip('\n')
+        if width is not None:
+            score = f'{float(score):.{width}f}'
+        row2, segs = refless_row(row, score, fmt=fmt)
+        if clean and not all(row2):
+            continue
+        if length:
+            row2 += [str(length(seg)) for seg in segs]
+        out.append('\t'.join(row2) + '\n')
+        n_out += 1
+    return ''.join(out), n_out
+
+
+def export(inp: Path, out: Path, scores: Path = None, fmt='flat', width: int = None, clean=True,
+           lengths: str = None, spm_model: Path = None, jobs: int = None, chunk_size=20_000) -> Path:
+    """Export inp (joined with scores) as refless rows to out; see module doc.
+
+    :param inp: flat file or merged TSV
+    :param out: output file path
+    :param scores: scores file, one line per row of inp; if None, score is the last column of inp
+    :param fmt: format of inp: flat or merged
+    :param width: digits after decimal point of scores; None keeps scores as they are
+    :param clean: drop rows having empty columns
+    :param lengths: add lengths of src, ref and hyp: words or spm; None to skip
+    :param spm_model: sentencepiece model path, for spm lengths
+    :param jobs: worker processes; 1 runs in this process
+    :param chunk_size: rows per chunk
+    """
+    assert fmt in FORMATS, f'Unknown format {fmt}; expected one of {FORMATS}'
+    assert fmt == 'flat' or scores, f'scores file is required for {fmt} format'
+    assert lengths in LENGTHS + [None], f'Unknown lengths {lengths}; expected one of {LENGTHS}'
+    out = Path(out)
+    flag_file = out.with_suffix('._OK')
+    if out.exists() and flag_file.exists():
+        log.info(f'Skip export {out}')
+        return out
+    jobs = jobs or os.cpu_count()
+    kwargs = dict(fmt=fmt, width=width, clean=clean, lengths=lengths, spm_model=spm_model)
+    tmp_file = out.with_name(f'.{out.name}.{os.getpid()}.tmp')
+    log.info(f'Exporting {inp} {scores or ""} -> {out}')
+    n_in = n_out = 0
+    with span('export', file=out.name) as sp, open(inp, newline='\n') as inp_f, \
+            open(tmp_file, 'w') as out_f, open(scores or os.devnull, newline='\n') as scores_f:
+        def chunks():
+            nonlocal n_in
+            start = 0
+            while True:
+                lines = list(itertools.islice(inp_f, chunk_size))
+                score_lines = list(itertools.islice(scores_f, len(lines) or 1)) if scores else None
+                if scores and len(score_lines) != len(lines):
+                    raise ValueError(f'{inp} and {scores} have different line counts')
+                if not lines:
+                    return
+                yield lines, score_lines, start
+                start += len(lines)
+                n_in = start
+
+        try:
+            if jobs == 1:
+                results = (export_chunk(lines, score_lines, start=start, **kwargs)
+                           for lines, score_lines, start in chunks())
+                for text, n in results:
+                    out_f.write(text)
+                    n_out += n
+            else:
+                with ProcessPoolExecutor(max_workers=jobs) as pool:
+                    window = deque()   # futures in input order; bounded, to bound memory
+                    for lines, score_lines, start in chunks():
+                        window.append(pool.submit(export_chunk, lines, score_lines, start=start, **kwargs))
+                        if len(window) >= 2 * jobs:
+                            text, n = window.popleft().result()
+                            out_f.write(text)
+                            n_out += n
+                    while window:
+                        text, n = window.popleft().result()
+                        out_f.write(text)
+                        n_out += n
+        except BaseException:
+            out_f.close()
+            tmp_file.unlink()
+            raise
+        sp.set_rows(n_out)
+    os.replace(tmp_file, out)
+    flag_file.touch()
+    log.info(f'Exported {n_out} of {n_in} rows to {out}')
+    return out
@@ -0,0 +1,98 @@
+"""Inter-process locks and atomic writes for cache files shared by concurrent jobs, e.g. on a shared filesystem.
+
+Cache entries (flat files, scores, splits) are complete when their flag file (`._OK`, `._SPLIT_OK`) exists.
+To build one, a job takes the entry's lock, checks the flag again (another job may have built it meanwhile),
+writes to temp files that are renamed into place, and touches the flag before releasing the lock:
+
+    if not flag.exists():
+        with file_lock(out_path):
+            if not flag.exists():
+                with atomic_write(out_path) as tmp:
+                    ...  # write tmp
+                flag.touch()
+
+Jobs waiting for the lock then find the flag and reuse the entry. Locks are POSIX record locks (`fcntl.lockf`),
+which work across hosts on NFS; they are released when the holder exits, even if it crashes.
+Lock files are left in place, since removing them would let two jobs lock different files of the same name.
+"""
+import os
+import time
+import fcntl
+import errno
+import socket
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+
+from . import log
+
+
+def lock_path(path: Path) -> Path:
+    return Path(path).with_name(Path(path).name + '.lock')
+
+
+def tmp_path(path: Path) -> Path:
+    """Temp file next to path, unique across processes and hosts"""
+    path = Path(path)
+    return path.with_name(f'.{path.name}.{socket.gethostname()}.{os.getpid()}.tmp')
+
+
+def try_lock(fd: int) -> bool:
+    """Lock open file fd without blocking; False if another process holds the lock"""
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError as e:
+        if e.errno in (errno.EACCES, errno.EAGAIN):
+            return False
+        raise
+
+
+@contextmanager
+def file_lock(path: Path, timeout: float = None, poll=1.0) -> Iterator[Path]:
+    """Hold an exclusive lock on `<path>.lock` while in context.
+
+    :param path: path of the cache entry to lock
+    :param timeout: seconds to wait for the lock; None waits for ever. TimeoutError when exceeded
+    :param poll: seconds between attempts while waiting
+    """
+    lock_file = lock_path(path)
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        if not try_lock(fd):
+            log.info(f'Waiting for {lock_file}; held by another job')
+            start = time.monotonic()
+            while not try_lock(fd):
+                if timeout is not None and time.monotonic() - start > timeout:
+                    raise TimeoutError(f'Could not lock {lock_file} in {timeout}s')
+                time.sleep(poll)
+            log.info(f'Locked {lock_file} after {time.monotonic() - start:.1f}s')
+        yield lock_file
+    finally:
+        os.close(fd)   # releases the lock
+
+
+@contextmanager
+def try_file_lock(path: Path) -> Iterator[bool]:
+    """Like `file_lock` without waiting: yields True while holding the lock, or False if another process holds it"""
+    lock_file = lock_path(path)
+    lock_file.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_file, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        yield try_lock(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_write(path: Path) -> Iterator[Path]:
+    """Yield a temp path that is renamed to path on success, and removed on error"""
+    tmp = tmp_path(path)
+    try:
+        yield tmp
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    os.replace(tmp, path)
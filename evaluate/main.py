@@ -1,11 +1,13 @@
+import os
 import argparse
 from pathlib import Path
 import tempfile
 from collections import Counter
 
 from . import Config, log
-from .score import flat_to_splits, get_flat_file, score_dataset
-from .evaluate import eval_scenario, all_scenarios, main as eval_all
+from .score import flat_to_splits, get_flat_file, read_tsv, score_dataset
+from .trace import TRACER, span
+from .scenarios import ENGINES, all_scenarios
 
 
 def _add_flag(parser, name, default=False, dest=None, help=None):
@@ -19,17 +21,48 @@ def parse_args():
     parser = argparse.ArgumentParser(prog='evaluate', description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-b', '--base-dir', metavar='DIR', help='mt-metrics-eval dir', type=Path, default=Path(Config.METRICS_BASE_DIR))
     parser.add_argument('-t', '--testset', help='Testset name', type=str, default='wmt22')
+    parser.add_argument('--profile', metavar='FILE', type=Path, default=None,
+                        help='Record timing of flatten, score, split and evaluate stages; write Chrome trace JSON to FILE \
+                        (view in chrome://tracing or ui.perfetto.dev) and log a summary table.')
+    parser.add_argument('--profile-memory', action='store_true', default=False,
+                        help='With --profile, also record peak Python memory per stage using tracemalloc (slow).')
 
     subps = parser.add_subparsers(dest='subcmd', help='Sub-commands', required=True)
     validate_parser = subps.add_parser('validate', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                        help='Validation mode: scores file is given, print only single number (accuracy). \
                                        This is useful for hyperparameter tuning. The given scores are NOT cached.')
-    validate_parser.add_argument('scores', help='Scores file path', type=Path)
+    validate_parser.add_argument('scores', help='Scores file path(s). Multiple files are evaluated in a single pass and ranked.',
+                                 type=Path, nargs='*')
+    validate_parser.add_argument('--matrix', action='store_true', default=False,
+                                 help='Scores file is a matrix with one column per candidate (whitespace separated, optional header row of names). \
+                                 Candidates are evaluated in a single pass and ranked.')
     validate_parser.add_argument('-w', '--width', metavar='INT', help='Digits in float after decimal point', type=int, default=6)
     validate_parser.add_argument('--pbar', help='Show progress bar', action='store_true', default=False)
     scenarios = list(all_scenarios.keys()) # + ['all']
     validate_parser.add_argument('-sc', '--scenario', choices=scenarios, help='Evaluation Scneario', type=str, default='wmt22.da_sqm_tab8')
     _add_flag(validate_parser, 'ref', default=False, help='Reference-based metric. Default is reference-free.')
+    _add_flag(validate_parser, 'scope', default=False,
+              help='Scores are of the flat file pruned to the rows of --scenario (see flatten --scenario), instead of the full flat file.')
+    validate_parser.add_argument('-e', '--engine', choices=ENGINES, default=None,
+                                 help='Evaluation engine for single scores file; default is the scenario\'s engine (mtme, or native for seg-level). \
+                                 Batch validation always uses native.')
+    sample_grp = validate_parser.add_argument_group('Sampled validation', 'Estimate accuracy from a stratified sample of rows, \
+                                                    with bootstrap confidence intervals. See evaluate/sample.py')
+    sample_grp.add_argument('--sample', metavar='INT', type=int, default=None,
+                            help='Sample INT rows per system (and language pair); only sampled rows are scored')
+    sample_grp.add_argument('--sample-step', metavar='INT', type=int, default=0,
+                            help='Add INT rows per system in each round until the ranking is stable. 0 evaluates a single sample')
+    sample_grp.add_argument('--max-sample', metavar='INT', type=int, default=None, help='Stop growing the sample at INT rows per system')
+    sample_grp.add_argument('--stable-rounds', metavar='INT', type=int, default=2,
+                            help='Stop when the ranking is unchanged for INT rounds')
+    sample_grp.add_argument('--resamples', metavar='INT', type=int, default=1000, help='Bootstrap resamples')
+    sample_grp.add_argument('--confidence', metavar='FLOAT', type=float, default=0.95, help='Confidence level of intervals')
+    sample_grp.add_argument('--seed', metavar='INT', type=int, default=1, help='Seed of sample and resamples')
+    sample_grp.add_argument('-m', '--models', metavar='PATH', type=Path, nargs='+', default=None,
+                            help='Candidate models (checkpoints or model dirs) to score on the sample with marian, instead of scores files')
+    sample_grp.add_argument('-v', '--vocab', type=Path, default=None, help='Vocabulary file of --models. Default: vocab.spm next to model')
+    sample_grp.add_argument('-d', '--devices', nargs='*', type=int, default=None, help='GPU device IDs for --models')
+    sample_grp.add_argument('--mini-batch', metavar='INT', type=int, default=16, help='Marian mini-batch size for --models')
 
     full_parser = subps.add_parser('full', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                 help='Model evaluation (full) mode. Given a model dir (e.g. marian model), score all testset systems, evaluate and show ranking. \
@@ -47,16 +80,67 @@ def parse_args():
     full_parser.add_argument('-t', '--toolkit', 
                              help='Toolkit used for trainin the model. only valid if --model arg is given and ignored for --scores',
                              choices=['marian', 'unbabel'], default='marian')
+    _add_flag(full_parser, 'store', default=False,
+              help='Write seg and sys scores into the score store (<user-dir>/scores.sqlite) instead of score files.')
+    full_parser.add_argument('-sc', '--scenario', choices=scenarios, default=None,
+                             help='Score only the language pairs and systems that can affect accuracy of this scenario, \
+                             and report only this scenario. Other systems get None scores; scores go to \
+                             <user-dir>/scope.<scenario>, apart from complete scores.')
 
     report_parser = subps.add_parser('report', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
                                        help="Report mode: report results for all metrics cached in --base-dir and --user-dir.")
     report_parser.add_argument('-u', '--user-dir', metavar='DIR', help='Directory when your metrics are cached',
                             type=Path, default=Path(Config.METRICS_USER_DIR))
     report_parser.add_argument('-o', '--report-file', metavar='FILE', help='Output file path', type=Path, default='results.csv')
+    report_parser.add_argument('-k', '--bootstrap', metavar='INT', type=int, default=0,
+                               help='Number of bootstrap draws for significance tests. 0 disables significance tests. \
+                                Significance depends on all metrics, so k > 0 bypasses the result cache.')
+    _add_flag(report_parser, 'cache', default=True,
+              help='Reuse per-metric results cached under --user-dir; only new or changed metrics are recomputed.')
+    report_parser.add_argument('-e', '--engine', choices=ENGINES, default=None,
+                               help='Evaluation engine; default is the scenario\'s engine (mtme, or native for seg-level). \
+                               native is a vectorized reimplementation of mtme global accuracy and seg-level kendall, \
+                               without significance tests: all metrics get rank 1.')
+    report_parser.add_argument('-sc', '--scenario', choices=scenarios, default=None,
+                               help='Report only this scenario, e.g. with --user-dir of scores pruned to it (see full -sc)')
+    report_parser.add_argument('--verify-engine', action='store_true', default=False,
+                               help='Compare native engine against mtme on all scenarios, instead of producing report.')
+
+    pipeline_parser = subps.add_parser('pipeline', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                       help='Run flatten -> score -> split -> evaluate for all metrics and testsets of a manifest, \
+                                       in parallel within a CPU budget. Completed stages are skipped. See evaluate/pipeline.py for manifest format.')
+    pipeline_parser.add_argument('manifest', type=Path, help='Manifest JSON file of metrics (and testsets)')
+    pipeline_parser.add_argument('-u', '--user-dir', metavar='DIR',
+                                 help='Directory for caching your own metrics', type=Path, default=Path(Config.METRICS_USER_DIR))
+    pipeline_parser.add_argument('-j', '--cpus', metavar='INT', type=int, default=os.cpu_count(), help='CPU budget')
+    pipeline_parser.add_argument('-o', '--report-file', metavar='FILE', default='results.{testset}.csv',
+                                 help='Report file per testset; {testset} is replaced with testset name')
+    pipeline_parser.add_argument('-k', '--bootstrap', metavar='INT', type=int, default=0,
+                                 help='Number of bootstrap draws for significance tests in report')
+    _add_flag(pipeline_parser, 'cache', default=True, help='Reuse per-metric results cached under --user-dir in report.')
+    pipeline_parser.add_argument('-e', '--engine', choices=ENGINES, default=None, help='Evaluation engine for report')
+    pipeline_parser.add_argument('--dry-run', action='store_true', default=False, help='Only print the stages to run')
+    _add_flag(pipeline_parser, 'store', default=False,
+              help='Write seg and sys scores into the score store (<user-dir>/scores.sqlite) instead of score files.')
+
+    store_parser = subps.add_parser('store', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                    help='List metric scores of --testset in the score store of --user-dir, or export them as score files')
+    store_parser.add_argument('-u', '--user-dir', metavar='DIR',
+                              help='Directory for caching your own metrics', type=Path, default=Path(Config.METRICS_USER_DIR))
+    store_parser.add_argument('--export', metavar='DIR', type=Path, default=None,
+                              help='Write scores as mt-metrics-eval files under DIR/<testset>/metric-scores/')
+
+    catalog_parser = subps.add_parser('catalog', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                      help='Update the file catalog of testset (<base-dir>/<testset>.catalog.json) and print a summary')
+    catalog_parser.add_argument('--rebuild', action='store_true', default=False,
+                                help='Check every file, e.g. after editing files in place')
+    catalog_parser.add_argument('--lines', action='store_true', default=False, help='Count lines of all files')
 
     flatten_parser = subps.add_parser('flatten', formatter_class=argparse.RawDescriptionHelpFormatter,
                                        help="Flatten dataset into a TSV file")
     _add_flag(flatten_parser, 'ref', default=False, help='Reference-based metric. Default is reference-free.')
+    flatten_parser.add_argument('-sc', '--scenario', choices=scenarios, default=None,
+                                help='Keep only rows that can affect accuracy of this scenario (language pairs and systems having gold scores)')
     fpg = flatten_parser.add_mutually_exclusive_group()
     fpg.add_argument('--human', choices=['none', 'wmt-appraise', 'wmt-z', 'wmt', 'mqm'], default=None,
                      help='Include this human scores in the output file. default="none" to not include human score')
@@ -66,14 +150,103 @@ def parse_args():
     fpg.add_argument('--scores-only', help='File with scores only (no ID or segs). valid when --human or --metric', action='store_true')
     fpg.add_argument('--table', help='Table of all metrics for all segments ', action='store_true')
 
+    export_parser = subps.add_parser('export', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     help='Export flat file or merged TSV, joined with scores, as refless training data in one pass. \
+                                     See evaluate/export.py for columns.')
+    export_parser.add_argument('inp', type=Path, help='Flat file (from flatten) or merged TSV (from dataprep/merge_wmt_tsv.py)')
+    export_parser.add_argument('-s', '--scores', type=Path, default=None,
+                               help='Scores file with one score per row of INP. Default: last column of INP, \
+                               for flat files made with --human or --metric')
+    export_parser.add_argument('-o', '--out', type=Path, default=None,
+                               help='Output file. Default: SCORES (or INP) with .refless.tsv extension')
+    export_parser.add_argument('-f', '--format', choices=['flat', 'merged'], default='flat', help='Format of INP')
+    export_parser.add_argument('-w', '--width', metavar='INT', type=int, default=None,
+                               help='Digits after decimal point of scores. Default: scores are copied as they are')
+    _add_flag(export_parser, 'clean', default=True, help='Drop rows having empty columns')
+    export_parser.add_argument('-L', '--lengths', choices=['words', 'spm'], default=None,
+                               help='Add src, ref and hyp lengths columns, in words or sentencepiece pieces')
+    export_parser.add_argument('--spm-model', metavar='FILE', type=Path, default=None, help='Sentencepiece model for --lengths spm')
+    export_parser.add_argument('-j', '--jobs', metavar='INT', type=int, default=os.cpu_count(), help='Worker processes')
+
+    watch_parser = subps.add_parser('watch', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                    help='Watch a training run dir; score each new checkpoint with marian and append its accuracy \
+                                    to a results table. Scenario data is loaded once. See evaluate/watch.py')
+    watch_parser.add_argument('run_dir', type=Path, help='Training run dir, where checkpoints are saved')
+    watch_parser.add_argument('-p', '--pattern', default='model.iter*.npz', help='File name pattern of checkpoints')
+    watch_parser.add_argument('-sc', '--scenario', choices=scenarios, help='Evaluation Scneario (of --testset)', type=str, required=True)
+    watch_parser.add_argument('-r', '--results', type=Path, default=None,
+                              help='Results table (TSV); checkpoints in it are skipped. Default: RUN_DIR/watch.<scenario>.tsv')
+    watch_parser.add_argument('-v', '--vocab', type=Path, default=None, help='Vocabulary file. Default: RUN_DIR/vocab.spm')
+    watch_parser.add_argument('-d', '--devices', nargs='*', type=int, default=None, help='GPU device IDs')
+    watch_parser.add_argument('--mini-batch', metavar='INT', type=int, default=16, help='Marian mini-batch size')
+    watch_parser.add_argument('-i', '--interval', metavar='SECS', type=float, default=30,
+                              help='Seconds between checks for new checkpoints')
+    watch_parser.add_argument('--settle', metavar='SECS', type=float, default=10,
+                              help='Checkpoints modified in the last SECS seconds may be partially written, and are left for later')
+    _add_flag(watch_parser, 'cancel', default=True,
+              help='Cancel and skip (accuracy nan) a checkpoint when a newer one is saved while scoring it, \
+              and score the newest checkpoint first')
+    watch_parser.add_argument('--scores-dir', metavar='DIR', type=Path, default=None,
+                              help='Also save seg scores of each checkpoint in DIR')
+    watch_parser.add_argument('--once', action='store_true', default=False,
+                              help='Score pending checkpoints and exit, instead of waiting for more')
+
+    shards_parser = subps.add_parser('shards', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                     help='Score a large flat file (or merged TSV) in shards, by workers on any number of hosts \
+                                     sharing WORK_DIR. See evaluate/shards.py')
+    shards_parser.add_argument('action', choices=['init', 'work', 'status', 'merge'],
+                               help='init: create manifest; work: claim and score shards; status: count shards by state; \
+                               merge: verify and assemble the scores file')
+    shards_parser.add_argument('work_dir', type=Path, help='Work dir, on storage shared by all workers')
+    shards_parser.add_argument('--data', type=Path, default=None,
+                               help='init: data file. Default: flat file of --testset (reference-free)')
+    shards_parser.add_argument('-m', '--model', type=Path, default=None, help='init: model file or dir')
+    shards_parser.add_argument('-f', '--format', choices=['flat', 'merged'], default='flat', help='init: format of data file')
+    shards_parser.add_argument('-s', '--shard-size', metavar='ROWS', type=int, default=100_000, help='init: rows per shard')
+    shards_parser.add_argument('-o', '--out', type=Path, default=None,
+                               help='init, merge: scores file. Default: <data>.<model name>.score')
+    shards_parser.add_argument('-v', '--vocab', type=Path, default=None, help='init: vocabulary file. Default: vocab.spm next to model')
+    shards_parser.add_argument('--mini-batch', metavar='INT', type=int, default=16, help='init: marian mini-batch size')
+    shards_parser.add_argument('-d', '--devices', nargs='*', type=int, default=None,
+                               help='work: GPU device IDs; with -j, each local worker gets one of them')
+    shards_parser.add_argument('-j', '--workers', metavar='INT', type=int, default=1, help='work: local worker processes')
+    shards_parser.add_argument('--wait', action='store_true', default=False,
+                               help='work: wait for shards claimed by other workers, and take over those of workers that die')
+
+    ensemble_parser = subps.add_parser('ensemble', formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+                                       help='Search weights of a linear combination of metrics (of the table of flatten --table) \
+                                       and checkpoint scores that maximizes accuracy of a scenario. See evaluate/ensemble.py')
+    ensemble_parser.add_argument('-sc', '--scenario', choices=scenarios, help='Evaluation Scneario (of --testset)', type=str, required=True)
+    _add_flag(ensemble_parser, 'ref', default=False,
+              help='Combine all metrics, with the standard reference. Default is reference-free metrics only.')
+    ensemble_parser.add_argument('-M', '--metrics', metavar='PATTERN', nargs='*', default=None,
+                                 help='Metrics of the table to combine, as fnmatch patterns (e.g. "COMET*"). Default: all')
+    ensemble_parser.add_argument('-s', '--scores', metavar='FILE', nargs='*', type=Path, default=[],
+                                 help='Also combine these scores files, aligned with the rows of the flat file (as in validate)')
+    ensemble_parser.add_argument('--normalize', choices=['z', 'none'], default='z',
+                                 help='z-normalize system scores of each metric per language pair before combining')
+    ensemble_parser.add_argument('-k', '--grid-metrics', metavar='INT', type=int, default=4,
+                                 help='Grid search over weights of the INT most accurate metrics')
+    ensemble_parser.add_argument('--grid-steps', metavar='INT', type=int, default=10,
+                                 help='Grid weights are multiples of 1/INT that sum to 1')
+    ensemble_parser.add_argument('--rounds', metavar='INT', type=int, default=100,
+                                 help='Max rounds of coordinate ascent from the best grid point; 0 to skip')
+    ensemble_parser.add_argument('--top', metavar='INT', type=int, default=10, help='Print INT best candidates of each search')
+    ensemble_parser.add_argument('-o', '--out', type=Path, default=None, help='Write the best combination to this JSON file')
+
     args = vars(parser.parse_args())
     return args
 
 
 def validate(args):
     """Validation mode: scores file is given, print only single number (accuracy) for the given scenario."""
+    if args['sample']:
+        return sampled_validate(args)
+    assert args['scores'], 'Scores file(s) are required; --models is for --sample'
+    if len(args['scores']) > 1 or args['matrix']:
+        return batch_validate(args)
     scenario_name = args['scenario']
-    scores_file = args['scores']
+    scores_file = args['scores'][0]
     width = args['width']
     metric_name = 'my_metric'
     testset_name = args['testset']
@@ -82,30 +255,137 @@ def validate(args):
     Config.PBAR_ENABLED = args['pbar']
     reference_based = bool(args['ref'])
 
-    data_file = get_flat_file(testset_path, reference_based=reference_based)
+    scope_name = scenario_name if args['scope'] else None
+    data_file = get_flat_file(testset_path, reference_based=reference_based, scenario=scope_name)
+    scope = None
+    if scope_name:
+        from .score import scenario_scope
+        scope = scenario_scope(testset_path, scope_name, reference_based=reference_based)
     assert scores_file.exists(), f"Scores file {scores_file} does not exist"
     display_name = f'*{metric_name}' + ('' if reference_based else '[noref]')  # * => not primary metric
     with tempfile.TemporaryDirectory() as tmp_dir:
         out_folder = Path(tmp_dir) / testset_name
         log.info(f"Writing to {out_folder}")
-        flat_to_splits(data_file=data_file, scores_file=scores_file, output_folder=out_folder, metric_name=metric_name)
+        flat_to_splits(data_file=data_file, scores_file=scores_file, output_folder=out_folder, metric_name=metric_name,
+                       dataset_path=scope_name and testset_path, scope=scope)
         metrics_paths = [args['base_dir'], tmp_dir]
         if testset_name == 'toship_data':
             from .toship import main as toship_main
             res = toship_main(testset_path, metrics_paths, show_pbar=args['pbar'])
         else:
+            from .evaluate import eval_scenario, load_eval_sets
             log.info(f"Running evaluation scenario {scenario_name}")
-            res = eval_scenario(paths=metrics_paths, quiet=True, scenairo_name=scenario_name)  # name: (rank, score)
+            eval_sets = load_eval_sets(paths=metrics_paths, scenairo_name=scenario_name, metrics=[metric_name])
+            res = eval_scenario(paths=metrics_paths, quiet=True, scenairo_name=scenario_name, eval_sets=eval_sets,
+                                engine=args['engine'])  # name: (rank, score)
         score = res[display_name][1]
         print(f'{score:.{width}f}')
 
 
+def batch_validate(args):
+    """Validate many candidates: load scenario once, compute accuracy of all candidates and print a ranked table."""
+    from .accuracy import flat_sys_scores, global_accuracy, read_score_matrix
+    from .evaluate import load_eval_sets
+
+    scenario_name = args['scenario']
+    scenario = all_scenarios[scenario_name]
+    width = args['width']
+    testset_path = args['base_dir'] / args['testset']
+    Config.PBAR_ENABLED = args['pbar']
+    reference_based = bool(args['ref'])
+    assert scenario['testset'] == args['testset'], f"Scenario {scenario_name} is not for testset {args['testset']}"
+    assert scenario.get('level', 'sys') == 'sys', f"Batch validation supports system-level scenarios only"
+
+    data_file = get_flat_file(testset_path, reference_based=reference_based, scenario=args['scope'] and scenario_name or None)
+    for path in args['scores']:
+        assert path.exists(), f"Scores file {path} does not exist"
+    with span('validate.read', files=len(args['scores'])) as sp:
+        names, seg_scores = read_score_matrix(args['scores'], matrix=args['matrix'])
+        sp.set_rows(seg_scores.size)
+    log.info(f"Running evaluation scenario {scenario_name} for {len(names)} candidates")
+    eval_sets = load_eval_sets(paths=[args['base_dir']], scenairo_name=scenario_name, read_metrics=False)
+    ref_names = {lp: evs.std_ref for lp, evs in eval_sets.items()} if reference_based else None
+    with span('validate.sys_scores', rows=len(seg_scores)):
+        sys_scores = flat_sys_scores(data_file, seg_scores, ref_name=ref_names)
+    with span('compare.accuracy', engine='native', candidates=len(names)):
+        accs = global_accuracy(sys_scores, eval_sets, gold_name=scenario['gold_name'],
+                               include_human=scenario['use_humans'])
+    ranked = sorted(zip(names, accs), key=lambda x: x[1], reverse=True)
+    for rank, (name, acc) in enumerate(ranked, start=1):
+        print(f'{rank}\t{acc:.{width}f}\t{name}')
+
+
+def sampled_validate(args):
+    """Sampled validation: score a stratified sample of rows per system and print a ranked table with confidence intervals."""
+    from .accuracy import flat_row_groups, read_score_matrix
+    from .evaluate import load_eval_sets
+    from .sample import SampledValidation, file_scorer, model_scorer
+
+    scenario_name = args['scenario']
+    scenario = all_scenarios[scenario_name]
+    width = args['width']
+    Config.PBAR_ENABLED = args['pbar']
+    reference_based = bool(args['ref'])
+    assert scenario['testset'] == args['testset'], f"Scenario {scenario_name} is not for testset {args['testset']}"
+    assert scenario.get('level', 'sys') == 'sys', f"Sampled validation supports system-level scenarios only"
+    assert bool(args['scores']) != bool(args['models']), 'Either scores files or --models are required'
+    assert not (args['models'] and reference_based), 'Models are scored reference-free; --ref is for scores files'
+
+    data_file = get_flat_file(args['base_dir'] / args['testset'], reference_based=reference_based,
+                              scenario=args['scope'] and scenario_name or None)
+    rows = list(read_tsv(data_file))
+    group_ids, groups = flat_row_groups(rows)
+    if args['models']:
+        names = [str(m) for m in args['models']]
+        srcs, hyps = [row[3] for row in rows], [row[5] for row in rows]
+        scorers = [model_scorer(m, srcs, hyps, vocab=args['vocab'], devices=args['devices'], mini_batch=args['mini_batch'])
+                   for m in args['models']]
+    else:
+        names, seg_scores = read_score_matrix(args['scores'], matrix=args['matrix'])
+        assert len(seg_scores) == len(rows), f"Number of scores does not match number of rows. {len(seg_scores)} != {len(rows)}"
+        scorers = [file_scorer(seg_scores[:, i]) for i in range(len(names))]
+    del rows
+    eval_sets = load_eval_sets(paths=[args['base_dir']], scenairo_name=scenario_name, read_metrics=False)
+    ref_names = {lp: evs.std_ref for lp, evs in eval_sets.items()} if reference_based else None
+    log.info(f"Running sampled evaluation scenario {scenario_name} for {len(names)} candidates")
+    validation = SampledValidation(names, scorers, group_ids, groups, eval_sets, gold_name=scenario['gold_name'],
+                                   include_human=scenario['use_humans'], ref_name=ref_names, resamples=args['resamples'],
+                                   confidence=args['confidence'], seed=args['seed'])
+    accs, ci, n_rows = validation.run(args['sample'], step=args['sample_step'], max_size=args['max_sample'],
+                                      stable_rounds=args['stable_rounds'])
+    print(f'# {n_rows} of {len(group_ids)} rows; {validation.size} per system; {args["confidence"]:g} confidence intervals')
+    ranked = sorted(zip(names, accs, ci), key=lambda x: x[1], reverse=True)
+    for rank, (name, acc, (low, high)) in enumerate(ranked, start=1):
+        print(f'{rank}\t{acc:.{width}f}\t{low:.{width}f}\t{high:.{width}f}\t{name}')
+
+
 def report_only(args):
     """ Produce metrics report only"""
+    from .evaluate import verify_engine, main as eval_all
     report_file = str(args.get('report_file', 'results.csv'))
     metrics_paths = [args['base_dir'], args['user_dir']]
     testset_name = args['testset']
-    eval_all(paths=metrics_paths, out_file=report_file, testset_name=testset_name)
+    if args.get('verify_engine'):
+        names = [name for name, scenario in all_scenarios.items() if scenario['testset'] == testset_name]
+        if not names:
+            raise ValueError(f"No scenario for testset {testset_name}; nothing to verify")
+        diffs = {name: verify_engine(paths=metrics_paths, scenairo_name=name) for name in names}
+        assert not any(diffs.values()), f"native engine differs from mtme: {diffs}"
+        return
+    eval_all(paths=metrics_paths, out_file=report_file, testset_name=testset_name,
+             k=args.get('bootstrap', 0), use_cache=args.get('cache', True), engine=args.get('engine'),
+             scenario_name=args.get('scenario'))
+
+def pipeline(args):
+    """ Pipeline mode: score and evaluate all metrics of a manifest"""
+    from .pipeline import build_graph, read_manifest, run_graph
+    manifest = read_manifest(args['manifest'], testsets=[args['testset']])
+    nodes = build_graph(manifest, base_dir=args['base_dir'], user_dir=args['user_dir'], report_file=args['report_file'],
+                        bootstrap=args['bootstrap'], use_cache=args['cache'], engine=args['engine'], use_store=args['store'])
+    failed = run_graph(nodes, cpus=args['cpus'], dry_run=args['dry_run'])
+    if failed:
+        raise RuntimeError(f'{len(failed)} pipeline stages failed: {failed}')
+
 
 def full_eval(args):
     """ Full evaluation mode: score, evaluate and report"""
@@ -117,7 +397,8 @@ def full_eval(args):
     reference_based = bool(args['ref'])
     metric_name = args['metric_name']
 
-    data_file = get_flat_file(testset_path, reference_based=reference_based)
+    scenario_name = args['scenario']
+    data_file = get_flat_file(testset_path, reference_based=reference_based, scenario=scenario_name)
     if not scores_file:
         model_dir = args.get('model')
         toolkit = args['toolkit']
@@ -127,11 +408,52 @@ def full_eval(args):
         score_dataset(data_file=data_file, out_file=scores_file, model_path=model_dir,
                     reference_based=reference_based, toolkit=toolkit)
 
+    scope = None
+    if scenario_name:   # pruned scores are partial; keep them apart from complete scores of user dir
+        from .score import scenario_scope, scope_dir
+        scope = scenario_scope(testset_path, scenario_name, reference_based=reference_based)
+        metrics_user_dir = scope_dir(metrics_user_dir, scenario_name)
+        args = dict(args, user_dir=metrics_user_dir)
+        log.info(f"Scores of scenario {scenario_name} go to {metrics_user_dir}")
     out_folder = metrics_user_dir / testset_name
-    flat_to_splits(data_file=data_file, scores_file=scores_file, output_folder=out_folder, metric_name=metric_name)
+    flat_to_splits(data_file=data_file, scores_file=scores_file, output_folder=out_folder, metric_name=metric_name,
+                   use_store=args['store'], dataset_path=scenario_name and testset_path, scope=scope)
     report_only(args)
 
 
+def store_summary(args):
+    """ List scores of testset in score store, or export them as score files"""
+    from .store import open_store
+    store = open_store(args['user_dir'])
+    assert store is not None, f"No score store in {args['user_dir']}"
+    if args['export']:
+        paths = list(store.export(args['testset'], args['export']))
+        log.info(f"Exported {len(paths)} files to {args['export'] / args['testset']}")
+    else:
+        print('lp\tmetric\tref\tlevel')
+        for lp, metric, ref, level, _ in store.entries(args['testset']):
+            print(f'{lp}\t{metric}\t{ref}\t{level}')
+    store.close()
+
+
+def catalog_summary(args):
+    """ Update catalog of testset and print number of files per language pair"""
+    from .catalog import get_catalog
+    catalog = get_catalog(args['base_dir'] / args['testset'])
+    if args['rebuild']:
+        catalog.refresh(deep=True)
+    print('lp\tsegs\trefs\tsystems\thuman_files\tmetric_files')
+    for lp in catalog.lps():
+        segs = catalog.lines(f'sources/{lp}.txt') if args['lines'] else '-'
+        print(f"{lp}\t{segs}\t{len(catalog.ref_names(lp))}\t{len(catalog.sys_names(lp))}"
+              f"\t{len(catalog.human_score_files(lp))}\t{len(catalog.metric_score_files(lp))}")
+    if args['lines']:
+        for rel, entry in catalog.dirs.items():
+            for name in entry['files']:
+                catalog.lines(f'{rel}/{name}')
+    catalog.save()
+
+
 def flat_file(args):
     testset_path = args['base_dir'] / args['testset']
     human_name = args['human']
@@ -145,28 +467,104 @@ def flat_file(args):
         human_name = None
     data_file = get_flat_file(testset_path, reference_based=reference_based,
                               human_name=human_name, metric_name=metric_name,
-                              scores_only=scores_only, table_mode=table_mode)
+                              scores_only=scores_only, table_mode=table_mode, scenario=args['scenario'])
     print(data_file)
     if args.get('make_refless'):
         assert human_name or metric_name, "refless is valid only when --human or --metric is given"
-        width = 4
+        from .export import export
         refless_file = data_file.parent / f'{data_file.stem}.refless{data_file.suffix}'
-        flag_file = refless_file.with_suffix('._OK')
-        if not refless_file.exists() or not flag_file.exists():
-            log.info(f"Creating refless file {refless_file}")
-            with open(refless_file, 'w') as out, open(data_file) as inp:
-                for line in inp:
-                    row = line.rstrip().split('\t')
-                    assert len(row) == 7, f"Expected 7 columns, got {len(row)}: {line}"
-                    # input  :: 0=langs, 1=ref_name, 2=sys_name 3=src_seg 4=ref_seg 5=hyp_seg, 6=score
-                    # output ::  langs docid sysname score src_seg hyp_seg
-                    score = float(row[6])
-                    row2 = [row[0], "-", f"{row[1]} {row[2]}", f'{score:.{width}f}', row[3], row[5]]
-                    out.write("\t".join(row2) + '\n')
-            flag_file.touch()
+        export(data_file, refless_file, fmt='flat', width=4, clean=False)
+
+
+def watch_run(args):
+    """ Watch mode: evaluate checkpoints of a training run as they are saved"""
+    from .watch import Watcher
+    results = args['results'] or args['run_dir'] / f"watch.{args['scenario']}.tsv"
+    watcher = Watcher(args['run_dir'], base_dir=args['base_dir'], testset=args['testset'],
+                      scenario_name=args['scenario'], results_file=results, pattern=args['pattern'],
+                      vocab=args['vocab'], devices=args['devices'], mini_batch=args['mini_batch'],
+                      interval=args['interval'], settle=args['settle'], cancel=args['cancel'],
+                      scores_dir=args['scores_dir'])
+    watcher.run(once=args['once'])
+
+
+def shards_run(args):
+    """ Shards mode: distributed scoring of a data file by workers sharing a work dir"""
+    from . import shards
+    work_dir, action = args['work_dir'], args['action']
+    if action == 'init':
+        assert args['model'], '--model is required for init'
+        data_file = args['data'] or get_flat_file(args['base_dir'] / args['testset'])
+        manifest = shards.init(work_dir, data_file, args['model'], shard_size=args['shard_size'], fmt=args['format'],
+                               out=args['out'], vocab=args['vocab'], mini_batch=args['mini_batch'])
+        print(f"{len(manifest['shards'])} shards of {manifest['rows']} rows -> {manifest['out']}")
+    elif action == 'work':
+        shards.work_parallel(work_dir, args['workers'], devices=args['devices'], wait=args['wait'])
+    elif action == 'status':
+        for state, ids in shards.status(work_dir).items():
+            print(f'{state}\t{len(ids)}\t{" ".join(map(str, ids[:20]))}')
+    elif action == 'merge':
+        print(shards.merge(work_dir, out=args['out']))
+
+
+def ensemble_run(args):
+    """ Ensemble mode: search weights of a linear combination of metrics for a scenario"""
+    import json
+    from .accuracy import read_score_matrix
+    from .evaluate import load_eval_sets
+    from .ensemble import EnsembleSearch, load_features, run_search
+
+    scenario_name = args['scenario']
+    scenario = all_scenarios[scenario_name]
+    testset_path = args['base_dir'] / args['testset']
+    reference_based = bool(args['ref'])
+    assert scenario['testset'] == args['testset'], f"Scenario {scenario_name} is not for testset {args['testset']}"
+    assert scenario.get('level', 'sys') == 'sys', f"Ensemble search supports system-level scenarios only"
+
+    table_file = get_flat_file(testset_path, table_mode=True)
+    data_file, score_names, seg_scores = None, None, None
+    if args['scores']:
+        data_file = get_flat_file(testset_path, reference_based=reference_based)
+        score_names, seg_scores = read_score_matrix(args['scores'])
+    eval_sets = load_eval_sets(paths=[args['base_dir']], scenairo_name=scenario_name, read_metrics=False)
+    names, features, groups, ref_names = load_features(table_file, eval_sets, reference_based=reference_based,
+                                                       patterns=args['metrics'], data_file=data_file,
+                                                       score_names=score_names, seg_scores=seg_scores)
+    log.info(f"Searching ensembles of {len(names)} metrics for scenario {scenario_name}")
+    search = EnsembleSearch(names, features, groups, eval_sets, gold_name=scenario['gold_name'],
+                            include_human=scenario['use_humans'], ref_name=ref_names, normalize=args['normalize'])
+    best = run_search(search, grid_features=args['grid_metrics'], grid_steps=args['grid_steps'],
+                      max_rounds=args['rounds'], top=args['top'])
+    if args['out']:
+        best.update(scenario=scenario_name, normalize=args['normalize'], reference_based=reference_based)
+        args['out'].write_text(json.dumps(best, indent=1))
+        log.info(f"Wrote {args['out']}")
+
+
+def export_rows(args):
+    """ Export mode: flat file or merged TSV with scores -> refless training data"""
+    from .export import export
+    out = args['out'] or (args['scores'] or args['inp']).with_suffix('.refless.tsv')
+    export(args['inp'], out, scores=args['scores'], fmt=args['format'], width=args['width'], clean=args['clean'],
+           lengths=args['lengths'], spm_model=args['spm_model'], jobs=args['jobs'])
+    print(out)
+
 
 def main():
     args = parse_args()
+    profile_file = args.pop('profile')
+    profile_memory = args.pop('profile_memory')
+    if profile_file:
+        TRACER.enable(memory=profile_memory)
+    try:
+        with span(f"cli.{args['subcmd']}"):
+            run(args)
+    finally:
+        if profile_file:
+            TRACER.save(profile_file)
+
+
+def run(args):
     subcmd = args.pop('subcmd')
     if subcmd == 'report':  # report mode: report results for all models in <base-dir> and  <user-dir>
         report_only(args)
@@ -174,10 +572,25 @@ def main():
        full_eval(args)
     elif subcmd == 'validate':  # validation model: scores file is given, print only single number
         validate(args)
+    elif subcmd == 'pipeline':  # pipeline mode: many metrics and testsets from a manifest
+        pipeline(args)
+    elif subcmd == 'catalog':
+        catalog_summary(args)
+    elif subcmd == 'export':
+        export_rows(args)
+    elif subcmd == 'watch':
+        watch_run(args)
+    elif subcmd == 'shards':
+        shards_run(args)
+    elif subcmd == 'ensemble':
+        ensemble_run(args)
+    elif subcmd == 'store':
+        store_summary(args)
     elif subcmd == 'flatten':
         if args.get('metric') == "?":
-            p = Path(args['base_dir']) / args['testset']
-            names = (p.name.replace('.seg.score', '') for p in p.glob('metric-scores/*/*.seg.score'))
+            from .catalog import get_catalog
+            from .score import catalog_metric_names
+            names = catalog_metric_names(get_catalog(Path(args['base_dir']) / args['testset']))
             names = set('-'.join(n.split('-')[:-1]) for n in names)
             print('\n'.join(sorted(names)))
             return
@@ -10,6 +10,8 @@ import itertools
 from typing import Iterator, Optional, List, Union, Tuple
 import shutil
 
+from .trace import span
+
 
 log.basicConfig(level=log.INFO)
 DEBUG_MODE=False
@@ -103,35 +105,39 @@ def marian_score(model: Path, src_data: Union[Path, Iterator[str]], mt_data: Uni
         cmd_line.append('--quiet')
 
     proc = None
-    try:
-        proc = subprocess.Popen(cmd_line, shell=False, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-                                stderr=sys.stderr, text=True, encoding='utf8', errors='replace')
-        log.info(f'Running command: {" ".join(cmd_line)}')
-        if isinstance(src_data, Path):
-            copy_thread = threading.Thread(target=copy_files_to_stdin, args=(proc, src_data, mt_data))
-        else:
-            copy_thread = threading.Thread(target=copy_stream_to_stdin, args=(proc, src_data, mt_data))
-
-        copy_thread.start()
-        # read output and yield scores
-        for line in proc.stdout:
-            line = line.rstrip()
-            if ' ' in line:
-                yield tuple(float(x) for x in line.split(' '))
+    n_lines = 0
+    with span('marian_score', model=model_file.name, mini_batch=mini_batch) as sp:
+        try:
+            proc = subprocess.Popen(cmd_line, shell=False, stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+                                    stderr=sys.stderr, text=True, encoding='utf8', errors='replace')
+            log.info(f'Running command: {" ".join(cmd_line)}')
+            if isinstance(src_data, Path):
+                copy_thread = threading.Thread(target=copy_files_to_stdin, args=(proc, src_data, mt_data))
             else:
-                yield float(line)
-
-        # wait for copy thread to finish
-        copy_thread.join()
-        #proc.stdin.close()
-
-        returncode = proc.wait()
-        if returncode != 0:
-            raise RuntimeError(f'Process exited with code {returncode}')
-    finally:
-        if proc is not None and proc.returncode is None:
-            log.warning(f'Killing process {proc.pid}')
-            proc.kill()
+                copy_thread = threading.Thread(target=copy_stream_to_stdin, args=(proc, src_data, mt_data))
+
+            copy_thread.start()
+            # read output and yield scores
+            for line in proc.stdout:
+                line = line.rstrip()
+                if ' ' in line:
+                    yield tuple(float(x) for x in line.split(' '))
+                else:
+                    yield float(line)
+                n_lines += 1
+
+            # wait for copy thread to finish
+            copy_thread.join()
+            #proc.stdin.close()
+
+            returncode = proc.wait()
+            sp.set_rows(n_lines)
+            if returncode != 0:
+                raise RuntimeError(f'Process exited with code {returncode}')
+        finally:
+            if proc is not None and proc.returncode is None:
+                log.warning(f'Killing process {proc.pid}')
+                proc.kill()
 
 
 def parse_args():
@@ -1,32 +1,167 @@
 import os
 import glob
 import collections
+import collections.abc
 import logging as log
 
+import numpy as np
+
 from mt_metrics_eval import data
 
+from .catalog import get_catalog
+from .store import open_store
+
 
 log.basicConfig(level=log.INFO)
 
+# seg scores dominate memory, so they are stored as float32. sys scores are few, and float32 rounding
+# could create artificial ties between systems in pairwise accuracy, so they are kept as float64
+LEVEL_DTYPES = collections.defaultdict(lambda: np.float32, sys=np.float64)
 
-def ReadScoreFile(filename, select=None):
-    scores = collections.defaultdict(list)  # sys -> [scores]
-    skips = set()
+
+class ScoreArray(collections.abc.MutableMapping):
+    """Map of sys -> [scores] backed by a contiguous [n_sys x n_items] array, with NaN for missing scores.
+
+    Lists (with None for missing scores) are created only when a system is accessed through the mapping
+    interface, which is what mt_metrics_eval uses. Use `row()` and `matrix()` for array access.
+    """
+
+    def __init__(self, sys_names, array):
+        assert len(sys_names) == len(array)
+        self._index = {name: i for i, name in enumerate(sys_names)}
+        self.array = array
+
+    def __getitem__(self, sysname):
+        return [None if x != x else x for x in self.array[self._index[sysname]].tolist()]  # NaN != NaN
+
+    def __setitem__(self, sysname, scores):
+        row = np.array([np.nan if x is None else x for x in scores], dtype=self.array.dtype)
+        if not self._index:
+            self.array = self.array.reshape(0, len(row))
+        if len(row) != self.array.shape[1]:
+            raise ValueError(f'Expected {self.array.shape[1]} scores for {sysname}, got {len(row)}')
+        if sysname in self._index:
+            self.array[self._index[sysname]] = row
+        else:
+            self._index[sysname] = len(self.array)
+            self.array = np.concatenate([self.array, row[None, :]])
+
+    def __delitem__(self, sysname):
+        i = self._index.pop(sysname)
+        self.array = np.delete(self.array, i, axis=0)
+        self._index = {name: j - (j > i) for name, j in self._index.items()}
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def row(self, sysname) -> np.ndarray:
+        return self.array[self._index[sysname]]
+
+    def matrix(self, sys_names) -> np.ndarray:
+        """Scores of the given systems as [len(sys_names) x n_items] float64 array; NaN rows for unknown systems"""
+        result = np.full((len(sys_names), self.array.shape[1]), np.nan)
+        for i, name in enumerate(sys_names):
+            if name in self._index:
+                result[i] = self.array[self._index[name]]
+        return result
+
+
+def ReadScoreFile(filename, select=None, dtype=np.float32):
+    """Read a `<sys> <score>` file into a ScoreArray of dtype, with NaN for None scores.
+
+    If systems have different number of scores, a dict of lists is returned (for mtme's CheckScores to report).
+    """
     with open(filename) as f:
-        for line in f:
-            sysname, score = line.split()
-            if select is not None and sysname not in select:
-                skips.add(sysname)
-                continue  # Skip systems not in select.
-            scores[sysname].append(float(score) if score != 'None' else None)
+        tokens = f.read().split()
+    assert len(tokens) % 2 == 0, f'{filename}: expected two columns'
+    names, values = tokens[0::2], tokens[1::2]
+    skips = set()
+    if select is not None:
+        skips = set(names) - set(select)
+        if skips:
+            keep = [name in select for name in names]
+            names = [n for n, k in zip(names, keep) if k]
+            values = [v for v, k in zip(values, keep) if k]
     if skips:
         log.info('%s : skipping %d systems not in select: %s',
                  filename, len(skips), skips)
-    return scores
+    values = np.array(['nan' if v == 'None' else v for v in values], dtype=dtype)
+    sys_names = list(dict.fromkeys(names))
+    rows = collections.defaultdict(list)
+    for i, name in enumerate(names):
+        rows[name].append(i)
+    lengths = {len(idx) for idx in rows.values()}
+    if len(lengths) > 1:
+        return {name: [None if np.isnan(x) else float(x) for x in values[idx]] for name, idx in rows.items()}
+    n_items = lengths.pop() if lengths else 0
+    array = values[np.array([rows[name] for name in sys_names], dtype=np.int64).reshape(len(sys_names), n_items)]
+    return ScoreArray(sys_names, array)
+
+
+def outlier_sys_names(name, lp):
+    """Outlier systems of a testset's language pair, from mt_metrics_eval's meta info, as `data.EvalSet` marks them."""
+    from mt_metrics_eval import meta_info
+    info = meta_info.DATA.get(name, {}).get(lp)
+    return set(getattr(info, 'outlier_systems', None) or ())
 
 
 class EvalSet(data.EvalSet):
-    """ Overrriding mtme.data.Evalset to skip erroneous systems"""
+    """ Overrriding mtme.data.Evalset to skip erroneous systems, and to read only the scores that are needed.
+
+    Args (in addition to mtme.data.EvalSet):
+      metrics: allow-list of metrics to read; either base names (e.g. `COMET-22`) or scorer names (e.g. `COMET-22-refA`).
+        None reads all stored metrics.
+      levels: allow-list of levels (`sys`, `seg`, `domain`) to read for metric and human scores. None reads all levels.
+      human_names: allow-list of human score names (e.g. `mqm`). None reads all human scores.
+        Names of other human scores are still registered, but their files are not read.
+    """
+
+    def __init__(self, *args, metrics=None, levels=None, human_names=None, **kwargs):
+        self._select_metrics = None if metrics is None else set(metrics)
+        self._select_levels = None if levels is None else set(levels)
+        self._select_humans = None if human_names is None else set(human_names)
+        super().__init__(*args, **kwargs)
+
+    def _IsSelectedLevel(self, level):
+        return self._select_levels is None or level in self._select_levels
+
+    def _MetricScoreFiles(self, catalog, lp):
+        """List metric score files of selected metrics and levels from catalog of a testset dir."""
+        if self._select_metrics is None:
+            filenames = catalog.metric_score_files(lp)
+        else:
+            filenames = set()
+            for metric in self._select_metrics:
+                filenames.update(catalog.metric_score_files(lp, f'{glob.escape(metric)}*.score'))
+        for filename in sorted(map(str, filenames)):
+            scorer, level = self.ParseMetricFilename(filename)
+            if not self._IsSelectedLevel(level):
+                continue
+            if self._select_metrics is not None and not (
+                    scorer in self._select_metrics or self.BaseMetric(scorer) in self._select_metrics):
+                continue
+            yield filename, scorer, level
+
+    def _StoredMetricScores(self, store, name, lp, select):
+        """Scores of selected metrics and levels from a score store, as (scorer, level, ScoreArray)."""
+        for _lp, metric, ref, level, _ in store.entries(name, lp):
+            scorer = f'{metric}-{ref}'
+            if not self._IsSelectedLevel(level):
+                continue
+            if self._select_metrics is not None and not (
+                    scorer in self._select_metrics or self.BaseMetric(scorer) in self._select_metrics):
+                continue
+            sys_names, array = store.get(name, lp, metric, ref, level)
+            keep = [sys_name in select for sys_name in sys_names]
+            if not all(keep):
+                log.info('%s %s %s : skipping %d systems not in select: %s', store.path, lp, scorer,
+                         keep.count(False), {n for n, k in zip(sys_names, keep) if not k})
+                sys_names = [n for n, k in zip(sys_names, keep) if k]
+                array = array[np.array(keep, dtype=bool)]
+            yield scorer, level, ScoreArray(sys_names, array.astype(LEVEL_DTYPES[level], copy=False))
 
     def _ReadDataset(self, name, lp, read_stored_metric_scores, path, strict):
         """Read data for given name and language pair."""
@@ -43,6 +178,7 @@ class EvalSet(data.EvalSet):
             metric_scores_paths = [path]
 
         d = os.path.join(path, name)
+        catalog = get_catalog(d)
         doc_lines = data._ReadTextFile(
             os.path.join(d, 'documents', '%s.docs' % lp))
         self._domains = data._MapPositions([d.split()[0] for d in doc_lines])
@@ -54,15 +190,15 @@ class EvalSet(data.EvalSet):
             os.path.join(d, 'sources', '%s.txt' % lp))
 
         self._all_refs = {}
-        for filename in glob.glob(os.path.join(d, 'references', '%s.*.txt' % lp)):
+        for filename in map(str, catalog.paths('references', '%s.*.txt' % lp)):
             refname = filename.split('.')[-2]
             if '-' in refname or refname in ['all', 'src']:
                 assert False, f'Invalid reference name: {refname}'
             self._all_refs[refname] = data._ReadTextFile(filename)
 
-        self._outlier_sys_names, self._human_sys_names = set(), set()
+        self._outlier_sys_names, self._human_sys_names = outlier_sys_names(name, lp), set()
         self._sys_outputs = {}
-        for filename in glob.glob(os.path.join(d, 'system-outputs', lp, '*.txt')):
+        for filename in map(str, catalog.paths(os.path.join('system-outputs', lp), '*.txt')):
             sysname = os.path.basename(filename)[:-len('.txt')]
             self._sys_outputs[sysname] = data._ReadTextFile(filename)
             if sysname in self._all_refs:
@@ -72,11 +208,13 @@ class EvalSet(data.EvalSet):
         self._scores = {}
         selected_sys_names = set(
             self._sys_outputs.keys())  # ones having outputs
-        for filename in glob.glob(
-                os.path.join(d, 'human-scores', '%s.*.score' % lp)):
+        for filename in map(str, catalog.human_score_files(lp)):
             lp, scorer, level = self.ParseHumanScoreFilename(
                 os.path.basename(filename))
             self._human_score_names.add(scorer)
+            if not self._IsSelectedLevel(level) or (
+                    self._select_humans is not None and scorer not in self._select_humans):
+                continue
             if level not in self._scores:
                 self._scores[level] = {}
             assert scorer not in self._scores[level], scorer
@@ -85,16 +223,35 @@ class EvalSet(data.EvalSet):
                     filename, self.domain_names)
             else:
                 self._scores[level][scorer] = ReadScoreFile(
-                    filename, select=selected_sys_names)
+                    filename, select=selected_sys_names, dtype=LEVEL_DTYPES[level])
 
         self._metric_names = set()
         self._metric_basenames = set()
         if read_stored_metric_scores:
+            # score stores come first: a metric that is also in score files (e.g. exported from a store,
+            # or split again without --store) is read from the store, and its files are skipped
+            stored = {}   # (level, scorer) -> store path
+            for md in metric_scores_paths:
+                store = open_store(md)
+                if store is None:
+                    continue
+                for scorer, level, scores in self._StoredMetricScores(store, name, lp, selected_sys_names):
+                    if level not in self._scores:
+                        self._scores[level] = {}
+                    assert scorer not in self._scores[level], f'{scorer} is in {stored[level, scorer]} and {store.path}'
+                    assert self.ReferencesUsed(scorer).issubset(self.ref_names)
+                    self._metric_names.add(scorer)
+                    self._metric_basenames.add(self.BaseMetric(scorer))
+                    self._scores[level][scorer] = scores
+                    stored[level, scorer] = store.path
+                store.close()
             for md in metric_scores_paths:
-                md = os.path.join(md, name)
-                for filename in glob.glob(
-                        os.path.join(md, 'metric-scores', lp, '*.score')):
-                    scorer, level = self.ParseMetricFilename(filename)
+                md_catalog = get_catalog(os.path.join(md, name))
+                for filename, scorer, level in self._MetricScoreFiles(md_catalog, lp):
+                    if (level, scorer) in stored:
+                        log.info('%s: skipping %s %s %s scores; they are read from %s',
+                                 filename, lp, scorer, level, stored[level, scorer])
+                        continue
                     if level not in self._scores:
                         self._scores[level] = {}
                     assert scorer not in self._scores[level]
@@ -106,7 +263,7 @@ class EvalSet(data.EvalSet):
                             filename, self.domain_names)
                     else:
                         self._scores[level][scorer] = ReadScoreFile(
-                            filename, select=selected_sys_names)
+                            filename, select=selected_sys_names, dtype=LEVEL_DTYPES[level])
 
         # Check contents
         for txt in self.all_refs.values():
@@ -0,0 +1,226 @@
+"""Run flatten -> score -> split -> evaluate for many metrics and testsets as one dependency graph.
+
+Manifest (JSON):
+    {
+      "testsets": ["wmt23"],                    # optional; default is --testset
+      "metrics": [
+        {"name": "my-model", "model": "/path/to/model-dir", "toolkit": "marian", "ref": false, "cpus": 4},
+        {"name": "chrfoid-redo", "command": "pymarian-evaluate --stdin -m chrfoid-wmt23", "cpus": 8},
+        {"name": "precomputed", "scores": "/path/to/{testset}.seg.score"}
+      ]
+    }
+Each metric has one of `model` (scored with `score_dataset`), `command` (shell command that reads `src<TAB>hyp` lines,
+or `src<TAB>hyp<TAB>ref` when `ref` is true, on stdin and writes one score per line), or `scores` (existing scores file).
+`cpus` is the share of the CPU budget a scoring node takes (default 1); give GPU scorers the whole budget to run them alone.
+
+Flat files are shared by all metrics of a testset, and each testset is evaluated once, after all of its metrics are split.
+Nodes whose `._OK` flags exist are skipped, so an interrupted run can be resumed; a testset is evaluated again
+when any of its metrics is scored or split again.
+"""
+import os
+import json
+import shlex
+import subprocess
+import concurrent.futures as cf
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from . import log
+from .locking import atomic_write, file_lock
+from .score import flat_file_paths
+from .trace import TRACER, span
+
+
+@dataclass
+class Node:
+    """A stage of the pipeline: fn(**kwargs) is run in a worker process once all deps are finished"""
+    key: str
+    fn: Callable
+    kwargs: dict
+    deps: List[str] = field(default_factory=list)
+    cpus: int = 1
+    flag: Path = None   # node is complete when this file exists
+
+    def is_done(self) -> bool:
+        return self.flag is not None and self.flag.exists()
+
+
+def score_with_command(data_file: Path, out_file: Path, command: str, reference_based=False):
+    """Score flat file rows with an external command; rows are written as src<TAB>hyp[<TAB>ref] to its stdin"""
+    flag_file = out_file.with_suffix('._OK')
+    if out_file.exists() and flag_file.exists():
+        log.info(f"Skip scoring {data_file.name} -> {out_file.name}")
+        return out_file
+    cols = [3, 5, 4] if reference_based else [3, 5]
+    with file_lock(out_file):
+        if out_file.exists() and flag_file.exists():   # scored by another job while this one waited for the lock
+            log.info(f"Skip scoring {data_file.name} -> {out_file.name}")
+            return out_file
+        log.info(f'Scoring {data_file.name} with: {command}')
+        with atomic_write(out_file) as tmp_file:
+            with span('score', toolkit='command', file=out_file.name), open(tmp_file, 'w') as out:
+                proc = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE, stdout=out, text=True, encoding='utf8')
+                with open(data_file) as inp:
+                    for line in inp:
+                        row = line.rstrip('\n').split('\t')
+                        proc.stdin.write('\t'.join(row[i] for i in cols) + '\n')
+                proc.stdin.close()
+                returncode = proc.wait()
+            if returncode != 0:
+                raise RuntimeError(f'{command} exited with code {returncode}')
+        flag_file.touch()
+    return out_file
+
+
+def _score(data_file: Path, out_file: Path, metric: dict):
+    from .score import score_dataset
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    if 'command' in metric:
+        return score_with_command(data_file, out_file, metric['command'], reference_based=metric.get('ref', False))
+    return score_dataset(data_file=data_file, out_file=out_file, model_path=Path(metric['model']),
+                         reference_based=metric.get('ref', False), toolkit=metric.get('toolkit', 'marian'))
+
+
+def _flatten(dataset_path: Path, reference_based: bool):
+    from .score import get_flat_file
+    return get_flat_file(dataset_path, reference_based=reference_based)
+
+
+def _split(data_file: Path, scores_file: Path, output_folder: Path, metric_name: str, use_store=False):
+    from .score import flat_to_splits
+    return flat_to_splits(data_file=data_file, scores_file=scores_file, output_folder=output_folder,
+                          metric_name=metric_name, use_store=use_store)
+
+
+def _evaluate(paths: List[Path], out_file: str, testset_name: str, k=0, use_cache=True, engine=None):
+    from .evaluate import main as eval_all
+    eval_all(paths=paths, out_file=out_file, testset_name=testset_name, k=k, use_cache=use_cache, engine=engine)
+    report_flag(out_file).touch()
+
+
+def report_flag(out_file) -> Path:
+    """Flag of an evaluate node; it is valid only while none of the node's dependencies rerun"""
+    out_file = Path(out_file)
+    return out_file.with_name(out_file.name + '._OK')
+
+
+def _run_node(key: str, fn: Callable, kwargs: dict, trace: bool, memory: bool):
+    """Run a node in a worker process within its own span.
+    :return: (result, trace) where trace is None, or (span records, t0, pid) of this node for `Tracer.add_spans`
+    """
+    if not trace:
+        return fn(**kwargs), None
+    if not TRACER.enabled:
+        TRACER.enable(memory=memory)
+    n_spans = len(TRACER.spans)   # workers are reused; earlier nodes' spans were already returned
+    with span(f"pipeline.{key.split(':')[0]}", node=key):
+        result = fn(**kwargs)
+    return result, (TRACER.spans[n_spans:], TRACER.t0, os.getpid())
+
+
+def read_manifest(path: Path, testsets: List[str] = None) -> dict:
+    manifest = json.loads(Path(path).read_text())
+    manifest.setdefault('testsets', testsets or [])
+    assert manifest['testsets'], f'No testsets given in {path} or command line'
+    names = [m['name'] for m in manifest.get('metrics', [])]
+    assert len(names) == len(set(names)), f'Duplicate metric names in {path}: {names}'
+    for metric in manifest.get('metrics', []):
+        sources = [key for key in ('model', 'command', 'scores') if key in metric]
+        assert len(sources) == 1, f"Metric {metric['name']} needs exactly one of model, command or scores; got {sources}"
+    return manifest
+
+
+def build_graph(manifest: dict, base_dir: Path, user_dir: Path, report_file='results.{testset}.csv',
+                bootstrap=0, use_cache=True, engine=None, use_store=False) -> Dict[str, Node]:
+    """Dependency graph of flatten -> score -> split -> evaluate nodes, keyed by node name.
+    use_store=True splits scores into the score store of user_dir instead of score files."""
+    nodes = {}
+    for testset in manifest['testsets']:
+        dataset_path = base_dir / testset
+        split_keys = []
+        for metric in manifest.get('metrics', []):
+            name, ref = metric['name'], bool(metric.get('ref', False))
+            data_file, data_ok = flat_file_paths(dataset_path, reference_based=ref)
+            flat_key = f'flatten:{testset}:{"wref" if ref else "noref"}'
+            if flat_key not in nodes:
+                nodes[flat_key] = Node(flat_key, _flatten, dict(dataset_path=dataset_path, reference_based=ref),
+                                       flag=data_ok)
+            deps = [flat_key]
+            if 'scores' in metric:
+                scores_file = Path(metric['scores'].format(testset=testset))
+            else:
+                scores_file = user_dir / f'{data_file.name}.{name}.seg.scores'   # as in `full` mode
+                score_key = f'score:{testset}:{name}'
+                nodes[score_key] = Node(score_key, _score, dict(data_file=data_file, out_file=scores_file, metric=metric),
+                                        deps=deps, cpus=int(metric.get('cpus', 1)), flag=scores_file.with_suffix('._OK'))
+                deps = [score_key]
+            out_folder = user_dir / testset
+            split_key = f'split:{testset}:{name}'
+            nodes[split_key] = Node(split_key, _split, dict(data_file=data_file, scores_file=scores_file,
+                                                            output_folder=out_folder, metric_name=name,
+                                                            use_store=use_store),
+                                    deps=deps, flag=out_folder / (scores_file.name + '._SPLIT_OK'))
+            split_keys.append(split_key)
+        eval_key = f'evaluate:{testset}'
+        nodes[eval_key] = Node(eval_key, _evaluate, dict(paths=[base_dir, user_dir],
+                                                         out_file=str(report_file).format(testset=testset),
+                                                         testset_name=testset, k=bootstrap, use_cache=use_cache,
+                                                         engine=engine),
+                               deps=split_keys, flag=report_flag(str(report_file).format(testset=testset)))
+    return nodes
+
+
+def run_graph(nodes: Dict[str, Node], cpus: int = None, dry_run=False) -> List[str]:
+    """Run nodes in worker processes, in dependency order, within a budget of cpus.
+
+    Completed nodes (whose flag exists, and whose dependencies are all complete) are skipped.
+    When a node fails, its dependents are not run but other branches continue.
+    :return: keys of failed nodes
+    """
+    cpus = cpus or os.cpu_count()
+    done = set()
+    for key, node in nodes.items():   # dependencies come first, as added by build_graph
+        if node.is_done() and all(dep in done for dep in node.deps):
+            done.add(key)
+    pending = [key for key in nodes if key not in done]
+    log.info(f'Pipeline: {len(nodes)} nodes; {len(done)} already complete; running {len(pending)} with {cpus} CPUs')
+    if dry_run:
+        for key in pending:
+            log.info(f"{key}\tcpus={nodes[key].cpus}\tdeps={','.join(nodes[key].deps)}")
+        return []
+
+    failed, running, used = [], {}, 0
+    with cf.ProcessPoolExecutor(max_workers=cpus) as pool:
+        while pending or running:
+            for key in list(pending):
+                node = nodes[key]
+                if any(dep in failed for dep in node.deps):
+                    log.error(f'Skip {key}: dependency failed')
+                    pending.remove(key)
+                    failed.append(key)
+                    continue
+                cost = min(node.cpus, cpus)
+                if not all(dep in done for dep in node.deps) or (running and used + cost > cpus):
+                    continue
+                log.info(f'Start {key}')
+                future = pool.submit(_run_node, key, node.fn, node.kwargs, trace=TRACER.enabled, memory=TRACER.memory)
+                running[future] = (key, cost)
+                pending.remove(key)
+                used += cost
+            if not running:
+                break
+            finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+            for future in finished:
+                key, cost = running.pop(future)
+                used -= cost
+                try:
+                    _, trace = future.result()
+                    if trace:
+                        TRACER.add_spans(*trace)
+                    done.add(key)
+                    log.info(f'Finished {key}')
+                except Exception:
+                    log.exception(f'Failed {key}')
+                    failed.append(key)
+    return failed
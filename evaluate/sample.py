@@ -0,0 +1,202 @@
+"""Approximate validation on a stratified sample of flat file rows, for fast screening of many checkpoints.
+
+System-level accuracy depends only on mean scores of systems, which can be estimated from a sample of segments.
+A sample takes up to n rows of each (lp, ref, sys) group of the flat file, in a seeded random order of the segments
+of each lp, so that it is deterministic, a sample of n rows is contained in the sample of n + step rows, and all systems
+of an lp are compared on the same segments.
+Only sampled rows are scored; system means and accuracy are estimated with paired bootstrap confidence intervals,
+i.e., all systems and candidates are evaluated on the same resamples of the sampled segments of each lp.
+
+With step > 0, rows are added to the sample in rounds until the ranking of candidates is unchanged
+for `stable_rounds` rounds, or all rows are scored. Full scoring can then be reserved for finalists.
+"""
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from . import log
+from .trace import span
+from .accuracy import global_accuracy, group_sys_scores, wanted_ref
+
+
+def segment_items(group_ids: np.ndarray, groups: Dict[Tuple[str, str, str], int]) -> Tuple[np.ndarray, np.ndarray]:
+    """Segment of each row, as an item id shared by the rows of all systems (and refs) of an lp.
+    The segment of a row is its position in its group, since rows of a group are in segment order.
+    :return: (item id per row, lp index per item)
+    """
+    lp_index = {}
+    group_lps = np.empty(len(groups), dtype=np.int64)
+    for (lp, _, _), idx in groups.items():
+        group_lps[idx] = lp_index.setdefault(lp, len(lp_index))
+    order = np.argsort(group_ids, kind='stable')
+    starts = np.searchsorted(group_ids[order], group_ids[order], side='left')
+    positions = np.empty(len(group_ids), dtype=np.int64)
+    positions[order] = np.arange(len(order)) - starts
+    stride = int(positions.max()) + 1 if len(positions) else 1
+    items, item_ids = np.unique(group_lps[group_ids] * stride + positions, return_inverse=True)
+    return item_ids.reshape(-1), items // stride
+
+
+def sample_ranks(group_ids: np.ndarray, item_ids: np.ndarray, seed=1) -> np.ndarray:
+    """Rank of each row within its group, in a seeded random order of items (segments; see `segment_items`).
+    Rows having rank < n are a sample of (up to) n rows per group; samples of increasing n are nested,
+    and groups having the same items are sampled on the same items.
+    """
+    key = np.random.default_rng(seed).random(int(item_ids.max()) + 1 if len(item_ids) else 0)[item_ids]
+    order = np.lexsort((key, group_ids))
+    sorted_groups = group_ids[order]
+    starts = np.searchsorted(sorted_groups, sorted_groups, side='left')
+    ranks = np.empty(len(group_ids), dtype=np.int64)
+    ranks[order] = np.arange(len(order)) - starts
+    return ranks
+
+
+def bootstrap_means(seg_scores: np.ndarray, group_ids: np.ndarray, n_groups: int, item_ids: np.ndarray,
+                    item_lps: np.ndarray, resamples=1000, seed=1, batch_size=100) -> np.ndarray:
+    """Group means of sampled rows and of resamples (with replacement) of the sampled items of each lp.
+    A resample draws items, not rows, so that all groups of an lp are averaged over the same draws.
+
+    :param seg_scores: scores of sampled rows, shape [n_rows, n_candidates]
+    :param group_ids: group of each sampled row; every group in range(n_groups) must have a row
+    :param item_ids, item_lps: item of each sampled row and lp of each item; see `segment_items`
+    :param resamples: number of bootstrap resamples; item draws are shared by all groups and candidates of an lp
+    :param batch_size: resamples per batch, to bound memory
+    :return: array of shape [1 + resamples, n_groups, n_candidates]; index 0 is the sample means
+    """
+    order = np.argsort(group_ids, kind='stable')
+    groups, scores = group_ids[order], seg_scores[order]
+    sizes = np.bincount(groups, minlength=n_groups)
+    assert sizes.all(), 'Every group must have a sampled row'
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    result = np.empty((1 + resamples, n_groups, scores.shape[1]))
+    result[0] = np.add.reduceat(scores, starts, axis=0) / sizes[:, None]
+    items, row_items = np.unique(item_ids[order], return_inverse=True)
+    row_items = row_items.reshape(-1)
+    strata = [np.flatnonzero(item_lps[items] == lp) for lp in np.unique(item_lps[items])]
+    rng = np.random.default_rng(seed)
+    for begin in range(0, resamples, batch_size):
+        n = min(batch_size, resamples - begin)
+        counts = np.zeros((n, len(items)))   # draws of each item in each resample
+        for members in strata:
+            draws = members[rng.integers(0, len(members), (n, len(members)))]
+            np.add.at(counts, (np.arange(n)[:, None], draws), 1)
+        weights = counts[:, row_items]
+        sums = np.add.reduceat(weights[:, :, None] * scores[None], starts, axis=1)
+        totals = np.add.reduceat(weights, starts, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[1 + begin: 1 + begin + n] = sums / totals[:, :, None]   # NaN for a group without drawn items
+    return result
+
+
+def sampled_accuracy(seg_scores: np.ndarray, group_ids: np.ndarray, groups: Dict[Tuple[str, str, str], int],
+                     item_ids: np.ndarray, item_lps: np.ndarray, eval_sets: Dict, gold_name: str, include_human: bool,
+                     ref_name=None, resamples=1000, confidence=0.95, seed=1) -> Tuple[np.ndarray, np.ndarray]:
+    """Estimate accuracy of candidates from scores of sampled rows.
+
+    :param seg_scores: scores of sampled rows, shape [n_rows, n_candidates]
+    :param group_ids: group of each sampled row
+    :param groups: (lp, ref_name, sys_name) -> group id of all groups that have sampled rows
+    :param item_ids, item_lps: item of each sampled row and lp of each item; see `segment_items`
+    :return: (accuracy, ci) of shapes [n_candidates] and [n_candidates, 2]
+    """
+    n_cands = seg_scores.shape[1]
+    means = bootstrap_means(seg_scores, group_ids, len(groups), item_ids, item_lps, resamples=resamples, seed=seed)
+    # resamples are evaluated as extra candidates, in a single pass
+    means = means.transpose(1, 0, 2).reshape(len(groups), -1)
+    sys_scores = group_sys_scores(groups, means, ref_name=ref_name)
+    accs = global_accuracy(sys_scores, eval_sets, gold_name=gold_name, include_human=include_human)
+    accs = accs.reshape(1 + resamples, n_cands)
+    alpha = (1 - confidence) / 2
+    ci = np.quantile(accs[1:], [alpha, 1 - alpha], axis=0).T if resamples else np.repeat(accs[:1].T, 2, axis=1)
+    return accs[0], ci
+
+
+class SampledValidation:
+    """Progressive sampled validation of candidates on the rows of a flat file.
+
+    :param names: candidate names
+    :param scorers: one function per candidate, mapping row indices to scores of those rows
+    :param group_ids, groups: `accuracy.flat_row_groups` of the flat file
+    :param eval_sets: lp -> EvalSet of the scenario
+    """
+
+    def __init__(self, names: List[str], scorers: List[Callable[[np.ndarray], np.ndarray]], group_ids: np.ndarray,
+                 groups: Dict[Tuple[str, str, str], int], eval_sets: Dict, gold_name: str, include_human: bool,
+                 ref_name=None, resamples=1000, confidence=0.95, seed=1):
+        assert len(names) == len(scorers)
+        self.names, self.scorers = names, scorers
+        self.eval_sets, self.gold_name, self.include_human = eval_sets, gold_name, include_human
+        self.ref_name, self.resamples, self.confidence, self.seed = ref_name, resamples, confidence, seed
+
+        # rows of groups that are not evaluated (other lps or refs) are never scored
+        keep_groups = {key: i for key, i in groups.items()
+                       if key[0] in eval_sets and key[1] == wanted_ref(key[0], ref_name)}
+        group_map = np.full(len(groups), -1)
+        for new_id, (key, old_id) in enumerate(keep_groups.items()):
+            group_map[old_id] = new_id
+        self.groups = {key: new_id for new_id, key in enumerate(keep_groups)}
+        self.group_ids = group_map[group_ids]
+        self.item_ids, self.item_lps = segment_items(group_ids, groups)
+        self.ranks = sample_ranks(group_ids, self.item_ids, seed=seed)
+        self.ranks[self.group_ids < 0] = np.iinfo(np.int64).max
+        self.max_rank = int(self.ranks[self.group_ids >= 0].max()) + 1 if self.groups else 0
+        self.scores = np.full((len(group_ids), len(names)), np.nan)
+        self.size = 0
+
+    def grow(self, size: int) -> int:
+        """Score rows of rank < size that are not yet scored; returns the number of newly scored rows"""
+        new_rows = np.flatnonzero((self.ranks >= self.size) & (self.ranks < size))
+        self.size = size
+        if len(new_rows):
+            for i, scorer in enumerate(self.scorers):
+                with span('validate.sample.score', candidate=self.names[i], rows=len(new_rows)):
+                    self.scores[new_rows, i] = scorer(new_rows)
+        return len(new_rows)
+
+    def estimate(self) -> Tuple[np.ndarray, np.ndarray, int]:
+        """(accuracy, ci, n_rows) from rows scored so far"""
+        rows = np.flatnonzero(self.ranks < self.size)
+        with span('validate.sample.bootstrap', rows=len(rows), resamples=self.resamples):
+            acc, ci = sampled_accuracy(self.scores[rows], self.group_ids[rows], self.groups, self.item_ids[rows],
+                                       self.item_lps, self.eval_sets, gold_name=self.gold_name, include_human=self.include_human,
+                                       ref_name=self.ref_name, resamples=self.resamples,
+                                       confidence=self.confidence, seed=self.seed)
+        return acc, ci, len(rows)
+
+    def run(self, size: int, step=0, max_size: int = None, stable_rounds=2) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Grow the sample from `size` rows per group by `step` rows per round until the ranking is
+        unchanged for `stable_rounds` rounds, `max_size` is reached or all rows are scored.
+        step=0 evaluates a single sample.
+        :return: (accuracy, ci, n_rows) of the last round
+        """
+        max_size = min(max_size or self.max_rank, self.max_rank)
+        ranking, n_stable = None, 0
+        while True:
+            self.grow(min(size, max_size))
+            acc, ci, n_rows = self.estimate()
+            new_ranking = list(np.argsort(-acc, kind='stable'))
+            n_stable = n_stable + 1 if new_ranking == ranking else 1
+            ranking = new_ranking
+            log.info(f'Sample of {self.size} rows per system ({n_rows:,} rows): ranking stable for {n_stable} rounds; '
+                     f'top: {self.names[ranking[0]]} {acc[ranking[0]]:.4f} [{ci[ranking[0], 0]:.4f}, {ci[ranking[0], 1]:.4f}]')
+            if not step or n_stable >= stable_rounds or self.size >= max_size:
+                return acc, ci, n_rows
+            size += step
+
+
+def file_scorer(scores: np.ndarray) -> Callable[[np.ndarray], np.ndarray]:
+    """Scorer of a candidate whose scores of all rows are given"""
+    return lambda rows: scores[rows]
+
+
+def model_scorer(model: Path, srcs: List[str], hyps: List[str], **kwargs) -> Callable[[np.ndarray], np.ndarray]:
+    """Scorer of a candidate model; rows are scored with marian (see `marian.marian_score` for kwargs)"""
+    from .marian import marian_score
+
+    def score(rows: np.ndarray) -> np.ndarray:
+        scores = [s[0] if isinstance(s, tuple) else s for s in
+                  marian_score(model, (srcs[i] for i in rows), (hyps[i] for i in rows), **kwargs)]
+        assert len(scores) == len(rows), f'Expected {len(rows)} scores from {model}; got {len(scores)}'
+        return np.array(scores)
+    return score
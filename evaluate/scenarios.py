@@ -0,0 +1,61 @@
+"""Evaluation scenarios, kept free of heavy imports so that the CLI can list them quickly."""
+
+all_scenarios = {
+    # comparable with Table 11
+    "wmt22.mqm_tab11": {
+        "testset": "wmt22",
+        "focus_lps": ['en-de', 'en-ru', 'zh-en'],
+        "gold_name": "mqm",
+        "use_humans": False
+    },
+    #"wmt22.dasqm_tab11": {"testset": "wmt22",
+    #                      "focus_lps": ['en-de', 'en-ru', 'zh-en'],
+    #                      "gold_name": "wmt-appraise",
+    #                      "use_humans": False},
+    # comparable with Table 8
+    "wmt22.da_sqm_tab8": {
+        "testset": "wmt22",
+        "focus_lps": ["en-de", "zh-en", "en-ru", 'cs-uk', 'en-hr', 'en-ja', 'en-liv', 'en-uk', 'en-zh', 'sah-ru', 'uk-cs', 'en-cs'],
+        "gold_name": "wmt-appraise",
+        "use_humans": True
+    },
+    "wmt23.mqm(de;he;zh)": {
+        "testset": "wmt23",
+        "focus_lps": ['en-de', 'he-en', 'zh-en'],
+        "gold_name": "mqm",
+        "use_humans": False
+    },
+    "wmt23.dasqm(de;zh)": {
+        "testset": "wmt23",
+        "focus_lps": ['en-de', 'zh-en'],
+        "gold_name": "da-sqm",
+        "use_humans": True
+    },
+    "wmt23.dasqm(all)": {
+        "testset": "wmt23",
+        "focus_lps": ["cs-uk", "de-en", "en-cs", "en-de", "en-ja", "en-zh", "ja-en", "zh-en"],
+        "gold_name": "da-sqm",
+        "use_humans": True
+    },
+    # segment-level Kendall tau, averaged over language pairs
+    "wmt23.seg.mqm(de;he;zh)": {
+        "testset": "wmt23",
+        "focus_lps": ['en-de', 'he-en', 'zh-en'],
+        "gold_name": "mqm",
+        "use_humans": False,
+        "level": "seg",
+        "average_by": "none",
+        "engine": "native"
+    },
+    "wmt23.seg-item.mqm(de;he;zh)": {
+        "testset": "wmt23",
+        "focus_lps": ['en-de', 'he-en', 'zh-en'],
+        "gold_name": "mqm",
+        "use_humans": False,
+        "level": "seg",
+        "average_by": "item",
+        "engine": "native"
+    }
+}
+all_scenarios = {k:v for k,v in all_scenarios.items() if v['testset'] == 'wmt23'}  # only wmt23 for now
+ENGINES = ['mtme', 'native']
@@ -1,16 +1,24 @@
 #!/usr/bin/env python
+import os
+import re
 import argparse
 from pathlib import Path
 import shutil
-from typing import List
+from typing import Dict, List, Set, Tuple
 import logging as log
 from collections import defaultdict
-from tqdm.auto import tqdm
 from . import Config
+from .trace import span
+from .catalog import get_catalog
+from .locking import atomic_write, file_lock, tmp_path
 
 
 log.basicConfig(level=log.INFO)
 
+# human score columns of table mode (`read_flat_rows_with_all_metrics`), after the 6 columns of flat rows
+# to get this ls  .../mt-metrics-eval-v2/wmt22/human-scores/*.seg.score | xargs -n1 basename | cut -f2 -d. | sort | uniq -c
+TABLE_HUMAN_NAMES = ['mqm', 'wmt', 'wmt-z', 'wmt-appraise', 'wmt-appraise-z']
+
 
 def read_lines(filename, remove_tabs=False):
     with open(filename, "r") as f:
@@ -45,19 +53,54 @@ def get_dataset_paths(data_folder: Path, eval_dataset=None) -> List[Path]:
     return paths
 
 
-def read_flat_rows(dataset_path: Path, reference_based=False):
+def catalog_metric_names(catalog, level='seg'):
+    """Names of metric score files (e.g. `COMET-22-refA`) of the given level, across language pairs"""
+    suffix = f'.{level}.score'
+    return set(name[:-len(suffix)] for lp in catalog.subdirs('metric-scores')
+               for name in catalog.names(f'metric-scores/{lp}', f'*{suffix}'))
+
+
+def scenario_scope(dataset_path: Path, scenario_name: str, reference_based=False) -> Dict[str, Tuple[Set[str], Set[str]]]:
+    """Language pairs, references and systems that can affect the accuracy of a scenario.
+
+    Mirrors the system selection of `accuracy.select_systems`: systems having gold scores at the scenario's level,
+    except the standard reference, outlier systems (scenarios exclude them), and human translations
+    unless the scenario uses humans.
+    :return: lp -> (ref_names, sys_names) where ref_names is {'src'} for reference-free, else {std_ref}
+    """
+    from mt_metrics_eval import meta_info
+    from .mtme_data import outlier_sys_names
+    from .scenarios import all_scenarios
+    scenario = all_scenarios[scenario_name]
+    assert scenario['testset'] == dataset_path.name, f"Scenario {scenario_name} is not for testset {dataset_path.name}"
+    catalog = get_catalog(dataset_path)
+    level = scenario.get('level', 'sys')
+    scope = {}
+    for lp in scenario['focus_lps']:
+        std_ref = meta_info.DATA[dataset_path.name][lp].std_ref
+        gold_file = f"human-scores/{lp}.{scenario['gold_name']}.{level}.score"
+        assert catalog.exists(gold_file), f'{dataset_path / gold_file} does not exist'
+        with open(dataset_path / gold_file) as f:
+            gold_sys = {row[0] for row in (line.split() for line in f) if len(row) == 2 and row[1] != 'None'}
+        sys_names = set(catalog.sys_names(lp)) & gold_sys - {std_ref} - outlier_sys_names(dataset_path.name, lp)
+        if not scenario['use_humans']:
+            sys_names -= set(catalog.ref_names(lp))
+        scope[lp] = ({std_ref} if reference_based else {'src'}, sys_names)
+    return scope
+
+
+def read_flat_rows(dataset_path: Path, reference_based=False, scope: Dict[str, Tuple[Set[str], Set[str]]]=None):
     """
     Reads all files in dir tree as flattened rows 
     yields 6-tuple :: `(lp, ref_name, sys_name, src_seg, ref_seg, hyp_seg)`
+    :param scope: lp -> (ref_names, sys_names) to read (see `scenario_scope`); None reads all
     """
-    lps = dataset_path.glob("sources/*.txt")
-    # remove full path from lps
-    lps = [lp.name.replace(".txt", "") for lp in lps]
-
-    for lp in lps:
+    catalog = get_catalog(dataset_path)
+    for lp in catalog.lps():
+        if scope is not None and lp not in scope:
+            continue
         src_segs = read_lines(dataset_path / f'sources/{lp}.txt', remove_tabs=True)
-        available_refs = dataset_path.glob(f'references/{lp}*.txt')
-        available_refs = [ref.name.split('.')[-2] for ref in available_refs]
+        available_refs = catalog.ref_names(lp)
         references = {}
         if not reference_based:
             # dummy references to make sure the metrics cannot see references due bug
@@ -65,13 +108,16 @@ def read_flat_rows(dataset_path: Path, reference_based=False):
         else:
             for ref_name in available_refs:
                 filename = dataset_path / f"references/{lp}.{ref_name}.txt"
-                if filename.exists():
+                if catalog.exists(f"references/{lp}.{ref_name}.txt"):
                     references[ref_name] = read_lines(filename, remove_tabs=True)
                 else:
                     log.warning(f"Reference {filename} does not exist")
 
         systems_outputs = {}
-        sys_names = [sys_path.name.replace(".txt", "") for sys_path in dataset_path.glob(f"system-outputs/{lp}/*.txt")]
+        sys_names = catalog.sys_names(lp)
+        if scope is not None:
+            sys_names = [name for name in sys_names if name in scope[lp][1]]
+            references = {name: segs for name, segs in references.items() if name in scope[lp][0]}
         for sys_name in sys_names:
             systems_outputs[sys_name] = read_lines(dataset_path / f"system-outputs/{lp}/{sys_name}.txt", remove_tabs=True)
 
@@ -91,15 +137,11 @@ def read_flat_rows_with_human(dataset_path: Path, reference_based=False, human_n
     Reads all files in dir tree as flattened rows and their human scores
     yields 7-tuple :: `(lp, ref_name, sys_name, src_seg, ref_seg, hyp_seg, human_score)`
     """
-    lps = dataset_path.glob("sources/*.txt")
-    # remove full path from lps
-    lps = [lp.name.replace(".txt", "") for lp in lps]
-
-    for lp in lps:
+    catalog = get_catalog(dataset_path)
+    for lp in catalog.lps():
         src_segs = read_lines(dataset_path / f'sources/{lp}.txt', remove_tabs=True)
-        available_refs = dataset_path.glob(f'references/{lp}*.txt')
         human_seg_scores_file = dataset_path / f'human-scores/{lp}.{human_name}.seg.score'
-        if not human_seg_scores_file.exists():
+        if not catalog.exists(f'human-scores/{lp}.{human_name}.seg.score'):
             log.warning(f"Human scores doesnt exist {human_seg_scores_file}; skipping....")
             continue
         with open(human_seg_scores_file, "r") as f:
@@ -109,7 +151,7 @@ def read_flat_rows_with_human(dataset_path: Path, reference_based=False, human_n
                 assert len(row) == 2
                 human_seg_scores[row[0]].append(row[1])
 
-        available_refs = [ref.name.split('.')[-2] for ref in available_refs]
+        available_refs = catalog.ref_names(lp)
         references = {}
         if not reference_based:
             # dummy references to make sure the metrics cannot see references due bug
@@ -117,13 +159,13 @@ def read_flat_rows_with_human(dataset_path: Path, reference_based=False, human_n
         else:
             for ref_name in available_refs:
                 filename = dataset_path / f"references/{lp}.{ref_name}.txt"
-                if filename.exists():
+                if catalog.exists(f"references/{lp}.{ref_name}.txt"):
                     references[ref_name] = read_lines(filename, remove_tabs=True)
                 else:
                     log.warning(f"Reference {filename} does not exist")
 
         systems_outputs = {}
-        sys_names = [sys_path.name.replace(".txt", "") for sys_path in dataset_path.glob(f"system-outputs/{lp}/*.txt")]
+        sys_names = catalog.sys_names(lp)
         for sys_name in sys_names:
             systems_outputs[sys_name] = read_lines(dataset_path / f"system-outputs/{lp}/{sys_name}.txt", remove_tabs=True)
 
@@ -161,28 +203,24 @@ def read_flat_rows_with_metric(dataset_path: Path, metric_name: str, reference_b
     Reads all files in dir tree as flattened rows and model score
     yields 7-tuple :: `(lp, ref_name, sys_name, src_seg, ref_seg, hyp_seg, model_score)`
     """
-    lps = dataset_path.glob("sources/*.txt")
-    # remove full path from lps
-    lps = [lp.name.replace(".txt", "") for lp in lps]
-
-    for lp in lps:
+    catalog = get_catalog(dataset_path)
+    for lp in catalog.lps():
         src_segs = read_lines(dataset_path / f'sources/{lp}.txt', remove_tabs=True)
         references = {}
         if not reference_based:
             # dummy references to make sure the metrics cannot see references due bug
             references['src'] = ['[NoRef]' for _ in src_segs]
         else:
-            available_refs = dataset_path.glob(f'references/{lp}*.txt')
-            available_refs = [ref.name.split('.')[-2] for ref in available_refs]
+            available_refs = catalog.ref_names(lp)
             for ref_name in available_refs:
                 filename = dataset_path / f"references/{lp}.{ref_name}.txt"
-                if filename.exists():
+                if catalog.exists(f"references/{lp}.{ref_name}.txt"):
                     references[ref_name] = read_lines(filename, remove_tabs=True)
                 else:
                     log.warning(f"Reference {filename} does not exist")
 
         systems_outputs = {}
-        sys_names = [sys_path.name.replace(".txt", "") for sys_path in dataset_path.glob(f"system-outputs/{lp}/*.txt")]
+        sys_names = catalog.sys_names(lp)
         for sys_name in sys_names:
             systems_outputs[sys_name] = read_lines(dataset_path / f"system-outputs/{lp}/{sys_name}.txt", remove_tabs=True)
 
@@ -190,7 +228,7 @@ def read_flat_rows_with_metric(dataset_path: Path, metric_name: str, reference_b
         metric_scores = defaultdict(list)
         for ref_name in references:
             filename = dataset_path / f"metric-scores/{lp}/{metric_name}-{ref_name}.seg.score"
-            if filename.exists():
+            if catalog.exists(f"metric-scores/{lp}/{metric_name}-{ref_name}.seg.score"):
                 rows = [x.split('\t') for x in read_lines(filename)]
                 for row in rows:
                     assert len(row) == 2, f"Invalid row: {row} in {filename}"
@@ -227,10 +265,10 @@ def read_flat_rows_with_all_metrics(dataset_path: Path, skip_self_ref=True):
     Reads all files in dir tree as flattened rows and model score
     yields tuple
     """
-    lps = dataset_path.glob("sources/*.txt")    # remove full path from lps
-    lps = [lp.name.replace(".txt", "") for lp in lps]
+    catalog = get_catalog(dataset_path)
+    lps = catalog.lps()
 
-    metric_names = set(x.name.replace('.seg.score', '') for x in dataset_path.glob(f"metric-scores/*/*.seg.score"))
+    metric_names = catalog_metric_names(catalog)
     metric_names = [x.split('-') for x in metric_names]
     metric_names = [('-'.join(mn), rn) for *mn, rn in metric_names]
     src_based_metrics = set(mn for mn, rn in metric_names if rn == 'src')
@@ -239,8 +277,7 @@ def read_flat_rows_with_all_metrics(dataset_path: Path, skip_self_ref=True):
     metric_names = list(sorted(set(metric_names)))
     metric_disp_names = [_metric_disp_names[mn] for mn in metric_names]
 
-    # to get this ls  .../mt-metrics-eval-v2/wmt22/human-scores/*.seg.score | xargs -n1 basename | cut -f2 -d. | sort | uniq -c
-    human_names = ['mqm', 'wmt', 'wmt-z', 'wmt-appraise', 'wmt-appraise-z']
+    human_names = TABLE_HUMAN_NAMES
 
     def clean_score(scores):
         """ replace scores that are neither float nor an explicit NA as NA"""
@@ -261,24 +298,23 @@ def read_flat_rows_with_all_metrics(dataset_path: Path, skip_self_ref=True):
     for lp in lps:
         src_segs = read_lines(dataset_path / f'sources/{lp}.txt', remove_tabs=True)
         ref_segs = {}
-        ref_names = dataset_path.glob(f'references/{lp}*.txt')
-        ref_names = [ref.name.split('.')[-2] for ref in ref_names]
+        ref_names = catalog.ref_names(lp)
         for ref_name in ref_names:
             filename = dataset_path / f"references/{lp}.{ref_name}.txt"
-            if filename.exists():
+            if catalog.exists(f"references/{lp}.{ref_name}.txt"):
                 ref_segs[ref_name] = read_lines(filename, remove_tabs=True)
             else:
                 log.warning(f"Reference {filename} does not exist")
 
         systems_outputs = {}
-        sys_names = [sys_path.name.replace(".txt", "") for sys_path in dataset_path.glob(f"system-outputs/{lp}/*.txt")]
+        sys_names = catalog.sys_names(lp)
         for sys_name in sys_names:
             systems_outputs[sys_name] = read_lines(dataset_path / f"system-outputs/{lp}/{sys_name}.txt", remove_tabs=True)
 
         human_scores = defaultdict(list)
         for human_name in human_names:
             filename = dataset_path / f"human-scores/{lp}.{human_name}.seg.score"
-            if filename.exists():
+            if catalog.exists(f"human-scores/{lp}.{human_name}.seg.score"):
                 for row in read_lines(filename):
                     row = row.split('\t')
                     assert len(row) == 2, f"Invalid row: {row} in {filename}"
@@ -292,9 +328,9 @@ def read_flat_rows_with_all_metrics(dataset_path: Path, skip_self_ref=True):
         for metric_name in metric_names:
             for ref_name in ref_names:
                 filename = dataset_path / f"metric-scores/{lp}/{metric_name}-{ref_name}.seg.score"
-                if not filename.exists() and metric_name in src_based_metrics:   # QE metric
+                if not catalog.exists(f"metric-scores/{lp}/{filename.name}") and metric_name in src_based_metrics:   # QE metric
                     filename = dataset_path / f"metric-scores/{lp}/{metric_name}-src.seg.score"
-                if not filename.exists():
+                if not catalog.exists(f"metric-scores/{lp}/{filename.name}"):
                     log.warning(f"Metric scores for {metric_name} not found in {dataset_path}/metric-scores/{lp}/*.txt. Skipped")
                     continue
 
@@ -326,27 +362,57 @@ def read_flat_rows_with_all_metrics(dataset_path: Path, skip_self_ref=True):
                     yield (*_id, *_row)
 
 
-def flat_to_splits(data_file:Path, scores_file: Path, output_folder: Path, metric_name:str):
+def flat_to_splits(data_file:Path, scores_file: Path, output_folder: Path, metric_name:str, use_store=False,
+                   dataset_path: Path=None, scope: Dict[str, Tuple[Set[str], Set[str]]]=None):
     """Split flat scores into segment and system scores
     Args:
         data_file (Path): path to flattened data
         scores_file (Path): path to flattened scores
         output_folder (Path): where to store the results
         metric_name (str): name of the metric
+        use_store (bool): write scores into the score store of output_folder's parent dir (see store.py)
+            instead of score files; output_folder's name is the testset name
+        dataset_path (Path): dataset of data_file, if it is pruned to a scenario (see `get_flat_file`).
+            Systems that are not in data_file get None scores, so that every system of a language pair has scores.
+            Such partial scores must not be mixed with complete ones; see `scope_dir`.
+        scope (dict): `scenario_scope` of data_file, with dataset_path; language pairs of the scope
+            that have no rows in data_file get None scores for all systems.
     """
     score_split_ok = output_folder / (scores_file.name + "._SPLIT_OK")
     if score_split_ok.exists():
         log.info(f"Skip {score_split_ok}; data is already split")
         return
+    with file_lock(score_split_ok):
+        if score_split_ok.exists():   # split by another job while this one waited for the lock
+            log.info(f"Skip {score_split_ok}; data is already split")
+            return
+        _flat_to_splits(data_file, scores_file, output_folder, metric_name, use_store=use_store,
+                        dataset_path=dataset_path, scope=scope)
+        output_folder.mkdir(parents=True, exist_ok=True)
+        score_split_ok.touch()
+
+
+def _flat_to_splits(data_file:Path, scores_file: Path, output_folder: Path, metric_name:str, use_store=False,
+                    dataset_path: Path=None, scope: Dict[str, Tuple[Set[str], Set[str]]]=None):
+    """Split flat scores, without the flag; score files are renamed into place when all of them are written"""
+    from tqdm.auto import tqdm
     log.info(f"Splitting {scores_file.name} into {metric_name} scores")
-    seg_scores = [float(x) for x in read_lines(scores_file)]
-    metas = list(r[:3] for r in read_tsv(data_file))
+    with span('split.read', file=scores_file.name) as sp:
+        seg_scores = [float(x) for x in read_lines(scores_file)]
+        metas = list(r[:3] for r in read_tsv(data_file))
+        sp.set_rows(len(metas))
     assert len(seg_scores) == len(metas), \
         f"Number of scores does not match number of rows. {len(seg_scores)} != {len(metas)}"
+    if dataset_path is not None:
+        metas, seg_scores = pad_pruned_rows(dataset_path, metas, seg_scores, scope=scope)
+    if use_store:
+        splits_to_store(metas, seg_scores, output_folder, metric_name)
+        return
 
     seg_out, sys_out = None, None
     prev_id = None
     sys_buffer = []
+    renames = []    # (tmp_file, score_file)
 
     def close_files():
         seg_out and seg_out.close()
@@ -359,7 +425,7 @@ def flat_to_splits(data_file:Path, scores_file: Path, output_folder: Path, metri
         assert sys_out
 
         _sys_name = prev_id[2]  # (lp, ref_name, sys_name)
-        _avg_score = sum(sys_buffer) / len(sys_buffer)    # mean
+        _avg_score = None if None in sys_buffer else sum(sys_buffer) / len(sys_buffer)    # mean; None for padded systems
         sys_out.write(f"{_sys_name}\t{_avg_score}\n")
         sys_buffer.clear()
 
@@ -368,43 +434,116 @@ def flat_to_splits(data_file:Path, scores_file: Path, output_folder: Path, metri
         sys_score_file = output_folder / f"metric-scores/{lp}/{metric_name}-{ref_name}.sys.score"
         seg_score_file.parent.mkdir(parents=True, exist_ok=True)
         log.debug(f"Writing to {seg_score_file}")
-        return open(seg_score_file, "w"), open(sys_score_file, "w")
-
-    with tqdm(zip(metas, seg_scores), desc=f"Split {scores_file.name}", total=len(metas),
-              mininterval=2, disable=not Config.PBAR_ENABLED) as pbar:
-        for this_id, seg_score in pbar:
-            (lp, ref_name, sys_name) = this_id
-            pbar.set_postfix_str(f'lp={lp}')
-
-            if prev_id is not None and prev_id != this_id:     # new system, write previous system
-                reset_sys_buffer()
-
-            if prev_id is None or prev_id[:2] != this_id[:2]:  # new language-pair or reference: open new files
-                close_files()
-                seg_out, sys_out = open_files(lp, ref_name)
-
-            seg_out.write(f"{sys_name}\t{seg_score}\n")
-            sys_buffer.append(seg_score)
+        renames.extend([(tmp_path(seg_score_file), seg_score_file), (tmp_path(sys_score_file), sys_score_file)])
+        return open(renames[-2][0], "w"), open(renames[-1][0], "w")
 
-            prev_id = this_id
+    try:
+        with span('split.write', rows=len(metas), file=scores_file.name), \
+             tqdm(zip(metas, seg_scores), desc=f"Split {scores_file.name}", total=len(metas),
+                  mininterval=2, disable=not Config.PBAR_ENABLED) as pbar:
+            for this_id, seg_score in pbar:
+                (lp, ref_name, sys_name) = this_id
+                pbar.set_postfix_str(f'lp={lp}')
 
-        # write last system
-        if prev_id and len(sys_buffer) > 0:
-            reset_sys_buffer()
+                if prev_id is not None and prev_id != this_id:     # new system, write previous system
+                    reset_sys_buffer()
 
-    close_files()
-    score_split_ok.touch()
+                if prev_id is None or prev_id[:2] != this_id[:2]:  # new language-pair or reference: open new files
+                    close_files()
+                    seg_out, sys_out = open_files(lp, ref_name)
 
+                seg_out.write(f"{sys_name}\t{seg_score}\n")
+                sys_buffer.append(seg_score)
 
-def get_flat_file(dataset_path:Path, reference_based: bool=False, human_name=None, metric_name=None, scores_only=False, table_mode=False):
-    """Flatten dataset into a single file
+                prev_id = this_id
 
-    :param dataset_path: dataset path (e.g., /path/to/wmt22)
-    :param reference_based: _description_, defaults to False
-    :return: _description_
+            # write last system
+            if prev_id and len(sys_buffer) > 0:
+                reset_sys_buffer()
+        close_files()
+    except BaseException:
+        close_files()
+        for tmp_file, _ in renames:
+            tmp_file.exists() and tmp_file.unlink()
+        raise
+    for tmp_file, score_file in renames:
+        os.replace(tmp_file, score_file)
+
+
+def pad_pruned_rows(dataset_path: Path, metas: List[List[str]], seg_scores: List[float],
+                    scope: Dict[str, Tuple[Set[str], Set[str]]]=None):
+    """Add rows with None scores for systems that are missing in (lp, ref_name) groups of pruned rows.
+    :param scope: `scenario_scope` of the rows; its (lp, ref_name) groups without rows (i.e., no system in scope)
+        are added with None scores for all systems, after the groups of rows
+    :return: (metas, seg_scores) with the added rows at the end of each group
+    """
+    catalog = get_catalog(dataset_path)
+    groups = {}   # (lp, ref_name) -> [row index]
+    for i, (lp, ref_name, _) in enumerate(metas):
+        groups.setdefault((lp, ref_name), []).append(i)
+    for lp, (ref_names, _) in (scope or {}).items():
+        for ref_name in sorted(ref_names):
+            groups.setdefault((lp, ref_name), [])
+    out_metas, out_scores, n_pad = [], [], 0
+    for (lp, ref_name), idx in groups.items():
+        out_metas.extend(metas[i] for i in idx)
+        out_scores.extend(seg_scores[i] for i in idx)
+        present = {metas[i][2] for i in idx}
+        n_segs = catalog.lines(f'sources/{lp}.txt')
+        for sys_name in catalog.sys_names(lp):
+            if sys_name in present or sys_name == ref_name:   # flat files have no self reference rows
+                continue
+            out_metas.extend([[lp, ref_name, sys_name]] * n_segs)
+            out_scores.extend([None] * n_segs)
+            n_pad += n_segs
+    log.info(f"Padded {n_pad:,} rows of systems out of scope with None scores")
+    return out_metas, out_scores
+
+
+def splits_to_store(metas, seg_scores, output_folder: Path, metric_name: str):
+    """Write seg and sys scores of flat rows into the score store; see `flat_to_splits`"""
+    import numpy as np
+    from .store import ScoreStore, STORE_FILE_NAME
+    testset = output_folder.name
+    groups = {}   # (lp, ref_name) -> sys_name -> [seg_score]
+    for (lp, ref_name, sys_name), seg_score in zip(metas, seg_scores):
+        groups.setdefault((lp, ref_name), {}).setdefault(sys_name, []).append(seg_score)
+    store = ScoreStore(output_folder.parent / STORE_FILE_NAME)
+    with span('split.write', rows=len(metas), file=store.path.name), store.transaction():
+        for (lp, ref_name), systems in groups.items():
+            sys_names = list(systems)
+            lengths = {len(scores) for scores in systems.values()}
+            assert len(lengths) == 1, f"Systems of {lp} {ref_name} have different number of segments: {lengths}"
+            seg_array = np.array([systems[name] for name in sys_names], dtype=np.float64)
+            sys_array = np.array([[None if None in scores else sum(scores) / len(scores)] for scores in systems.values()],
+                                 dtype=np.float64)
+            store.put(testset, lp, metric_name, ref_name, 'seg', sys_names, seg_array)
+            store.put(testset, lp, metric_name, ref_name, 'sys', sys_names, sys_array)
+    store.close()
+    log.info(f"Stored {metric_name} scores of {len(groups)} (lp, ref) pairs in {store.path}")
+
+
+def scenario_file_name(scenario: str) -> str:
+    """Scenario name as a file name, e.g. wmt23.mqm(de;he;zh) -> wmt23.mqm_de_he_zh"""
+    return re.sub(r'[^\w.-]+', '_', scenario).strip('_')
+
+
+def scope_dir(user_dir: Path, scenario: str) -> Path:
+    """User dir of scores of rows pruned to a scenario, e.g. <user_dir>/scope.wmt23.mqm_de_he_zh.
+    Padded systems of pruned scores have None scores, so they are kept apart from complete scores of user_dir,
+    which reports of other scenarios would otherwise evaluate as complete."""
+    return Path(user_dir) / f'scope.{scenario_file_name(scenario)}'
+
+
+def flat_file_paths(dataset_path:Path, reference_based: bool=False, human_name=None, metric_name=None, scores_only=False, table_mode=False,
+                    scenario=None):
+    """Paths of flat file and its ._OK flag, without creating them. See `get_flat_file` for args
+    :return: (out_path, file_ok)
     """
-
     suffix = reference_based and "wref" or "noref"
+    if scenario:
+        assert not (table_mode or human_name or metric_name), "scenario is supported for plain flat files only"
+        suffix += '.' + scenario_file_name(scenario)
     if table_mode:
         suffix += f'.allmetrics'
     elif human_name:
@@ -419,8 +558,28 @@ def get_flat_file(dataset_path:Path, reference_based: bool=False, human_name=Non
         assert not table_mode
         out_path = dataset_path.parent / f"{dataset_path.name}.{suffix}.score"
         file_ok = out_path.with_suffix(".score._OK")
+    return out_path, file_ok
+
+
+def get_flat_file(dataset_path:Path, reference_based: bool=False, human_name=None, metric_name=None, scores_only=False, table_mode=False,
+                  scenario=None):
+    """Flatten dataset into a single file
 
-    if not file_ok.exists():
+    :param dataset_path: dataset path (e.g., /path/to/wmt22)
+    :param reference_based: _description_, defaults to False
+    :param scenario: name of a scenario; if given, only rows that can affect its accuracy are kept
+        (see `scenario_scope`). Use `flat_to_splits(..., dataset_path=dataset_path, scope=scope)` to split scores
+        of such a file, into a user dir of the scenario (`scope_dir`).
+    :return: _description_
+    """
+    out_path, file_ok = flat_file_paths(dataset_path, reference_based=reference_based, human_name=human_name,
+                                        metric_name=metric_name, scores_only=scores_only, table_mode=table_mode,
+                                        scenario=scenario)
+    if file_ok.exists():
+        return out_path
+    with file_lock(out_path):
+        if file_ok.exists():   # built by another job while this one waited for the lock
+            return out_path
         log.info(f"Flattening {dataset_path.name} to {out_path}")
         if table_mode:
             rows = read_flat_rows_with_all_metrics(dataset_path, skip_self_ref=True)
@@ -432,21 +591,24 @@ def get_flat_file(dataset_path:Path, reference_based: bool=False, human_name=Non
         elif metric_name:
             rows = read_flat_rows_with_metric(dataset_path, metric_name=metric_name, reference_based=reference_based)
         else:
-            rows = read_flat_rows(dataset_path, reference_based=reference_based)
+            scope = scenario and scenario_scope(dataset_path, scenario, reference_based=reference_based)
+            rows = read_flat_rows(dataset_path, reference_based=reference_based, scope=scope)
 
         if scores_only and (human_name or metric_name):
             rows = ([x[-1]] for x in rows)
         i = 0
-        with open(out_path, "w") as f:
+        with span('flatten', file=out_path.name) as sp, atomic_write(out_path) as tmp_file, open(tmp_file, "w") as f:
             for row in rows:
                 f.write("\t".join(row) + "\n")
                 i += 1
+            sp.set_rows(i)
         if i > 0:
             file_ok.touch()
     return out_path
 
 
 def score_dataset(data_file: Path, out_file: Path, model_path: Path, reference_based: bool=False, toolkit="marian"):
+    from tqdm.auto import tqdm
     flag_file = out_file.with_suffix("._OK")
     if toolkit == "unbabel":
         from .unbabel import unbabel_score
@@ -457,8 +619,16 @@ def score_dataset(data_file: Path, out_file: Path, model_path: Path, reference_b
     else:
         raise ValueError(f"Unknown toolkit: {toolkit}")
 
-    if not out_file.exists() or not flag_file.exists():
-        rows = list(read_tsv(data_file))
+    if out_file.exists() and flag_file.exists():
+        log.info(f"Skip scoring {data_file.name} -> {out_file.name}")
+        return out_file
+    with file_lock(out_file):
+        if out_file.exists() and flag_file.exists():   # scored by another job while this one waited for the lock
+            log.info(f"Skip scoring {data_file.name} -> {out_file.name}")
+            return out_file
+        with span('score.read', file=data_file.name) as sp:
+            rows = list(read_tsv(data_file))
+            sp.set_rows(len(rows))
         #(lp, sys_name, ref_name, _src, _ref, _hyp)
         if not all(len(x) == 6 for x in rows):
             for i, r in enumerate(rows):
@@ -473,16 +643,15 @@ def score_dataset(data_file: Path, out_file: Path, model_path: Path, reference_b
         else:
             seg_scores = score_function(model_path, srcs, hyps)
         i = 0
-        with open(out_file, "w") as f:
-            for score in tqdm(seg_scores, desc="Scoring", total=len(rows), mininterval=2):
-                if isinstance(score, tuple):
-                    score = score[0]
-                f.write(f"{score}\n")
-                i += 1
-        assert i == len(rows), f"Number of scores does not match number of rows: {i} != {len(rows)}. See\n {data_file}\n {out_file}"
+        with atomic_write(out_file) as tmp_file:
+            with span('score', rows=len(rows), toolkit=toolkit, file=out_file.name), open(tmp_file, "w") as f:
+                for score in tqdm(seg_scores, desc="Scoring", total=len(rows), mininterval=2):
+                    if isinstance(score, tuple):
+                        score = score[0]
+                    f.write(f"{score}\n")
+                    i += 1
+            assert i == len(rows), f"Number of scores does not match number of rows: {i} != {len(rows)}. See\n {data_file}\n {out_file}"
         flag_file.touch()
-    else:
-        log.info(f"Skip scoring {data_file.name} -> {out_file.name}")
     return out_file
 
 
@@ -0,0 +1,194 @@
+"""Segment-level Kendall tau correlations in O(n log n), batched over metrics and groups.
+
+Kendall tau is computed as in scipy.stats.kendalltau (Knight's algorithm): items are sorted by (metric, gold),
+and discordant pairs are the inversions of gold in that order, counted with a bottom-up merge sort.
+Groups (e.g. items or systems, for `average_by`) and metrics are handled in one pass by prefixing
+sort keys with a group id, so that inversions never cross group boundaries.
+"""
+import warnings
+from typing import Tuple
+
+import numpy as np
+
+from .accuracy import metric_matrix, select_systems
+
+VARIANTS = ['b', 'c']
+AVERAGE_BY = ['none', 'sys', 'item']
+
+
+def _dense_rank(x: np.ndarray) -> np.ndarray:
+    """Dense ranks starting from 0; equal values get equal ranks"""
+    _, inverse = np.unique(x, return_inverse=True)
+    return inverse.reshape(-1)
+
+
+def count_inversions(seq: np.ndarray) -> np.ndarray:
+    """For each element, count the earlier elements that are strictly greater than it.
+
+    :param seq: non-negative integers
+    :return: inversion counts per element, aligned with seq
+    """
+    n = len(seq)
+    counts = np.zeros(n, dtype=np.int64)
+    vals = seq.astype(np.int64)
+    idx = np.arange(n)
+    pos = np.arange(n)
+    big = int(vals.max()) + 1 if n else 1
+    width = 1
+    while width < n:
+        # merge pairs of sorted blocks [left | right], each of size `width`
+        block = pos // (2 * width)
+        is_right = (pos % (2 * width)) >= width
+        keys = block * big + vals
+        left_keys, left_block = keys[~is_right], block[~is_right]
+        right_keys, right_block = keys[is_right], block[is_right]
+        left_end = np.searchsorted(left_block, right_block, side='right')
+        not_greater = np.searchsorted(left_keys, right_keys, side='right')
+        counts[idx[is_right]] += left_end - not_greater
+        order = np.argsort(keys, kind='stable')
+        vals, idx = vals[order], idx[order]
+        width *= 2
+    return counts
+
+
+def _tie_pairs(groups: np.ndarray, *cols: np.ndarray, n_groups: int) -> np.ndarray:
+    """Number of tied pairs per group, i.e., pairs that are equal in all of the given columns"""
+    keys = np.stack([groups, *cols], axis=1)
+    uniq, counts = np.unique(keys, axis=0, return_counts=True)
+    return np.bincount(uniq[:, 0], weights=counts * (counts - 1) / 2, minlength=n_groups)
+
+
+def _n_distinct(groups: np.ndarray, col: np.ndarray, n_groups: int) -> np.ndarray:
+    uniq = np.unique(np.stack([groups, col], axis=1), axis=0)
+    return np.bincount(uniq[:, 0], minlength=n_groups)
+
+
+def grouped_kendall(gold: np.ndarray, scores: np.ndarray, groups: np.ndarray = None, n_groups: int = None,
+                    variant: str = 'b') -> np.ndarray:
+    """Kendall tau between gold and each metric, within each group.
+
+    :param gold: gold scores, shape [n]; NaN for missing
+    :param scores: metric scores, shape [n_metrics, n]; NaN for missing
+    :param groups: group index of each item, shape [n], values in [0, n_groups). None for a single group
+    :param n_groups: number of groups; default is max(groups) + 1
+    :param variant: 'b' or 'c', as in scipy.stats.kendalltau
+    :return: tau of shape [n_metrics, n_groups]; NaN where undefined (e.g. fewer than two items, or constant scores)
+    """
+    assert variant in VARIANTS, f'Unknown variant {variant}; expected one of {VARIANTS}'
+    scores = np.atleast_2d(scores)
+    n_metrics, n = scores.shape
+    if groups is None:
+        groups = np.zeros(n, dtype=np.int64)
+    n_groups = int(groups.max()) + 1 if n_groups is None else n_groups
+    if n == 0 or n_metrics == 0:
+        return np.full((n_metrics, n_groups), np.nan)
+
+    # flatten metrics x groups into a single group axis, and drop missing values
+    all_groups = (np.arange(n_metrics)[:, None] * n_groups + groups[None, :]).reshape(-1)
+    all_gold = np.broadcast_to(gold, scores.shape).reshape(-1)
+    all_scores = scores.reshape(-1)
+    valid = ~np.isnan(all_gold) & ~np.isnan(all_scores)
+    if not valid.any():   # no item has both scores, e.g. no MQM scores for an lp or domain
+        return np.full((n_metrics, n_groups), np.nan)
+    g, x, y = all_groups[valid], _dense_rank(all_scores[valid]), _dense_rank(all_gold[valid])
+    total_groups = n_metrics * n_groups
+
+    size = np.bincount(g, minlength=total_groups).astype(np.float64)
+    n0 = size * (size - 1) / 2
+    x_ties = _tie_pairs(g, x, n_groups=total_groups)
+    y_ties = _tie_pairs(g, y, n_groups=total_groups)
+    xy_ties = _tie_pairs(g, x, y, n_groups=total_groups)
+
+    order = np.lexsort((y, x, g))
+    y_sorted = g[order] * (int(y.max()) + 1) + y[order]
+    discordant = np.bincount(g[order], weights=count_inversions(y_sorted), minlength=total_groups)
+    con_minus_dis = n0 - x_ties - y_ties + xy_ties - 2 * discordant
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        undefined = (x_ties == n0) | (y_ties == n0)
+        if variant == 'b':
+            tau = con_minus_dis / np.sqrt((n0 - x_ties) * (n0 - y_ties))
+        else:
+            min_classes = np.minimum(_n_distinct(g, x, total_groups), _n_distinct(g, y, total_groups))
+            tau = 2 * con_minus_dis / (size ** 2 * (min_classes - 1) / min_classes)
+    tau = np.where(undefined, np.nan, tau)
+    return tau.reshape(n_metrics, n_groups)
+
+
+def group_ids(n_sys: int, n_items: int, average_by: str) -> Tuple[np.ndarray, int]:
+    """Group index array for a flattened [n_sys x n_items] score matrix.
+
+    :param average_by: 'none' (single group), 'sys' (group by system) or 'item' (group by segment)
+    :return: (groups, n_groups)
+    """
+    assert average_by in AVERAGE_BY, f'Unknown average_by {average_by}; expected one of {AVERAGE_BY}'
+    if average_by == 'none':
+        return np.zeros(n_sys * n_items, dtype=np.int64), 1
+    if average_by == 'sys':
+        return np.repeat(np.arange(n_sys), n_items), n_sys
+    return np.tile(np.arange(n_items), n_sys), n_items
+
+
+def average_kendall(gold: np.ndarray, scores: np.ndarray, average_by='none', variant='b',
+                    replace_nans_with_zeros=False) -> np.ndarray:
+    """Kendall tau of many metrics over a [systems x items] matrix, averaged over groups.
+
+    :param gold: gold scores, shape [n_sys, n_items]; NaN for missing
+    :param scores: metric scores, shape [n_metrics, n_sys, n_items]; NaN for missing
+    :param average_by: 'none', 'sys' or 'item'; as in mt_metrics_eval
+    :param variant: Kendall variant; see `grouped_kendall`
+    :param replace_nans_with_zeros: count groups with undefined correlation as 0, instead of skipping them
+    :return: average correlation per metric, shape [n_metrics]
+    """
+    n_metrics, n_sys, n_items = scores.shape
+    groups, n_groups = group_ids(n_sys, n_items, average_by)
+    taus = grouped_kendall(gold.reshape(-1), scores.reshape(n_metrics, -1), groups, n_groups, variant=variant)
+    if replace_nans_with_zeros:
+        taus = np.nan_to_num(taus, nan=0.0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # mean of empty slice: no group has a defined correlation
+        return np.nanmean(taus, axis=1)
+
+
+def seg_inputs(evs, main_refs, close_refs, include_human: bool, include_outliers: bool, gold_name: str,
+               primary_metrics: bool) -> Tuple[list, np.ndarray, np.ndarray]:
+    """Segment-level score matrices of gold and metrics, to be shared by correlation functions, averaging modes and domains.
+
+    :return: (metric_names, gold, scores) where gold has shape [n_sys, n_segs] and scores [n_metrics, n_sys, n_segs]
+    """
+    gold = evs.StdHumanScoreName('seg') if gold_name == 'std' else gold_name
+    sys_names, gold_scores = select_systems(evs, gold_name=gold, include_human=include_human,
+                                            include_outliers=include_outliers, main_refs=main_refs,
+                                            close_refs=close_refs, level='seg')
+    names, scores = metric_matrix(evs, sys_names, main_refs=main_refs, primary_metrics=primary_metrics, level='seg')
+    return names, gold_scores, scores
+
+
+def seg_kendall_metrics(evs, inputs, average_by='none', variant='b', domain=None) -> Tuple[dict, np.ndarray]:
+    """Segment-level Kendall tau from `seg_inputs`, in the format of `mt_metrics_eval.data.CompareMetrics`.
+
+    :return: (metrics, sig_matrix) where metrics is an ordered map of display name -> (corr, rank), sorted by corr.
+      Since significance is not tested, sig_matrix has p-value 1 for every pair and all metrics share rank 1.
+    """
+    names, gold_scores, scores = inputs
+    if domain is not None:
+        cols = domain_columns(evs, domain)
+        gold_scores, scores = gold_scores[:, cols], scores[:, :, cols]
+    corrs = average_kendall(gold_scores, scores, average_by=average_by, variant=variant)
+    metrics = {evs.DisplayName(name): (float(corr), 1) for name, corr in zip(names, corrs)}
+    metrics = dict(sorted(metrics.items(), key=lambda x: x[1][0], reverse=True))
+    return metrics, np.ones((len(metrics), len(metrics)))
+
+
+def compare_metrics_seg_kendall(evs, main_refs, close_refs, include_human: bool, include_outliers: bool,
+                                gold_name: str, primary_metrics: bool, average_by='none', variant='b',
+                                domain=None) -> Tuple[dict, np.ndarray]:
+    """Segment-level Kendall tau for all metrics of an EvalSet; see `seg_inputs` and `seg_kendall_metrics`."""
+    inputs = seg_inputs(evs, main_refs=main_refs, close_refs=close_refs, include_human=include_human,
+                        include_outliers=include_outliers, gold_name=gold_name, primary_metrics=primary_metrics)
+    return seg_kendall_metrics(evs, inputs, average_by=average_by, variant=variant, domain=domain)
+
+
+def domain_columns(evs, domain: str) -> np.ndarray:
+    """Segment indices of a domain"""
+    return np.concatenate([np.arange(beg, end) for beg, end in evs.domains[domain]])
@@ -0,0 +1,214 @@
+"""Scoring of large flat files by workers on any number of hosts sharing a filesystem.
+
+    python -m evaluate shards init WORK_DIR --data FILE --model MODEL [--shard-size ROWS]
+    python -m evaluate shards work WORK_DIR [--devices 0 1] [-j WORKERS]    # on each host
+    python -m evaluate shards status WORK_DIR
+    python -m evaluate shards merge WORK_DIR
+
+`init` writes `WORK_DIR/manifest.json`: the data file (a flat file, or a merged TSV of dataprep) with its size,
+the model and marian options, and the row ranges (and byte offsets) of shards.
+A worker claims a shard by locking `shard-<i>.score.lock` without waiting (see `locking.py`), scores its rows with
+`marian.marian_score`, and commits it by renaming its scores into place and creating its `._OK` flag.
+A claim lasts as long as the worker holds the lock, so shards of a crashed worker are claimed again by other workers.
+`merge` verifies that every shard is committed and has one score per row, and writes the scores file with a
+`<score>._OK` flag, as dataprep/comet-wmtmetrics.sh expects; e.g. `export`, `flat_to_splits` and `full --scores` consume it.
+"""
+import os
+import json
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from . import log
+from .trace import span
+from .locking import atomic_write, file_lock, try_file_lock
+
+MANIFEST_NAME = 'manifest.json'
+FORMATS = ['flat', 'merged']
+COLUMNS = dict(flat=(3, 5), merged=(4, 6))   # (src, hyp) columns; see export.refless_row
+
+
+def manifest_path(work_dir: Path) -> Path:
+    return Path(work_dir) / MANIFEST_NAME
+
+
+def shard_path(work_dir: Path, i: int) -> Path:
+    return Path(work_dir) / f'shard-{i:05d}.score'
+
+
+def shard_flag(work_dir: Path, i: int) -> Path:
+    return shard_path(work_dir, i).with_suffix('._OK')
+
+
+def is_committed(work_dir: Path, i: int) -> bool:
+    return shard_path(work_dir, i).exists() and shard_flag(work_dir, i).exists()
+
+
+def is_claimed(work_dir: Path, i: int) -> bool:
+    """Whether a worker holds the lock of shard i"""
+    with try_file_lock(shard_path(work_dir, i)) as free:
+        return not free
+
+
+def default_out(data_file: Path, model: Path) -> Path:
+    """e.g. wmt22.tsv and .../wmt22-comet-da/model.npz -> wmt22.wmt22-comet-da.score"""
+    model = Path(model)
+    name = model.name if model.is_dir() else model.parent.name
+    stem = data_file.stem if data_file.suffix == '.tsv' else data_file.name
+    return data_file.with_name(f'{stem}.{name}.score')
+
+
+def make_shards(data_file: Path, shard_size: int) -> List[Dict[str, int]]:
+    """Row ranges of shards, with byte offset of their first row"""
+    shards = []
+    offset, row = 0, 0
+    with open(data_file, 'rb') as f:
+        while True:
+            lines = list(itertools.islice(f, shard_size))
+            if not lines:
+                break
+            shards.append(dict(start=row, end=row + len(lines), offset=offset))
+            row += len(lines)
+            offset += sum(map(len, lines))
+    return shards
+
+
+def init(work_dir: Path, data_file: Path, model: Path, shard_size=100_000, fmt='flat', out: Path = None,
+         vocab: Path = None, mini_batch=16, width=4) -> dict:
+    """Create the manifest of work_dir; an existing manifest is reused if it has the same data file and model"""
+    assert fmt in FORMATS, f'Unknown format {fmt}; expected one of {FORMATS}'
+    work_dir, data_file, model = Path(work_dir), Path(data_file).resolve(), Path(model).resolve()
+    path = manifest_path(work_dir)
+    with file_lock(path):
+        if path.exists():
+            manifest = load_manifest(work_dir)
+            if (manifest['data'], manifest['model']) != (str(data_file), str(model)):
+                raise ValueError(f'{path} is for {manifest["data"]} and {manifest["model"]}; use another work dir')
+            log.info(f'Reusing {path}: {len(manifest["shards"])} shards')
+            return manifest
+        with span('shards.init', file=data_file.name) as sp:
+            shards = make_shards(data_file, shard_size)
+            sp.set_rows(shards[-1]['end'] if shards else 0)
+        manifest = dict(data=str(data_file), data_size=data_file.stat().st_size, format=fmt, model=str(model),
+                        vocab=vocab and str(Path(vocab).resolve()), mini_batch=mini_batch, width=width,
+                        out=str(Path(out or default_out(data_file, model)).resolve()),
+                        rows=shards[-1]['end'] if shards else 0, shards=shards)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        with atomic_write(path) as tmp:
+            tmp.write_text(json.dumps(manifest, indent=1))
+    log.info(f'Created {path}: {manifest["rows"]:,} rows in {len(shards)} shards')
+    return manifest
+
+
+def load_manifest(work_dir: Path) -> dict:
+    with open(manifest_path(work_dir)) as f:
+        return json.load(f)
+
+
+def score_shard(work_dir: Path, manifest: dict, i: int, devices: List[int] = None):
+    """Score rows of shard i and commit them; the caller holds the claim"""
+    from .marian import marian_score
+    shard = manifest['shards'][i]
+    n_rows = shard['end'] - shard['start']
+    src_col, hyp_col = COLUMNS[manifest['format']]
+    with open(manifest['data'], 'rb') as f:
+        f.seek(shard['offset'])
+        rows = [line.decode('utf8').rstrip('\n').split('\t') for line in itertools.islice(f, n_rows)]
+    assert len(rows) == n_rows, f'Expected {n_rows} rows from {manifest["data"]} at offset {shard["offset"]}'
+    vocab = manifest['vocab'] and Path(manifest['vocab'])
+    scores = marian_score(Path(manifest['model']), (r[src_col] for r in rows), (r[hyp_col] for r in rows),
+                          vocab=vocab, devices=devices, width=manifest['width'], mini_batch=manifest['mini_batch'])
+    out = shard_path(work_dir, i)
+    n = 0
+    with span('shards.score', shard=i, rows=n_rows), atomic_write(out) as tmp:
+        with open(tmp, 'w') as f:
+            for score in scores:
+                f.write(f'{score[0] if isinstance(score, tuple) else score}\n')
+                n += 1
+        assert n == n_rows, f'Expected {n_rows} scores for shard {i}; got {n}'
+    shard_flag(work_dir, i).touch()
+
+
+def work(work_dir: Path, devices: List[int] = None, wait=False, poll=30.) -> int:
+    """Claim and score shards until none is left to claim.
+
+    :param devices: GPU devices for marian
+    :param wait: when the remaining shards are claimed by other workers, wait for them to be committed
+        (and claim those of workers that die) instead of returning
+    :return: number of shards scored by this worker
+    """
+    work_dir = Path(work_dir)
+    manifest = load_manifest(work_dir)
+    n_scored = 0
+    while True:
+        busy = []   # shards claimed by other workers
+        for i in range(len(manifest['shards'])):
+            if is_committed(work_dir, i):
+                continue
+            with try_file_lock(shard_path(work_dir, i)) as claimed:
+                if not claimed:
+                    busy.append(i)
+                    continue
+                if is_committed(work_dir, i):   # committed by another worker before this claim
+                    continue
+                log.info(f'Worker {os.getpid()}: scoring shard {i} of {len(manifest["shards"])}')
+                score_shard(work_dir, manifest, i, devices=devices)
+                n_scored += 1
+        busy = [i for i in busy if not is_committed(work_dir, i)]   # others may have committed them meanwhile
+        claimed = [i for i in busy if is_claimed(work_dir, i)]      # or released them without committing
+        if not busy or not wait:
+            log.info(f'Worker {os.getpid()}: scored {n_scored} shards; {len(claimed)} shards are claimed by other workers')
+            return n_scored
+        if len(claimed) == len(busy):   # else claim the released shards right away
+            time.sleep(poll)
+
+
+def work_parallel(work_dir: Path, workers: int, devices: List[int] = None, wait=False) -> int:
+    """Run workers in local processes; with devices, worker k uses devices[k % len(devices)]"""
+    if workers == 1:
+        return work(work_dir, devices=devices, wait=wait)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(work, work_dir, devices=devices and [devices[k % len(devices)]], wait=wait)
+                   for k in range(workers)]
+        return sum(f.result() for f in futures)
+
+
+def status(work_dir: Path) -> Dict[str, List[int]]:
+    """Shard ids by state: committed, claimed (being scored) and pending"""
+    manifest = load_manifest(work_dir)
+    states = dict(committed=[], claimed=[], pending=[])
+    for i in range(len(manifest['shards'])):
+        if is_committed(work_dir, i):
+            states['committed'].append(i)
+            continue
+        states['claimed' if is_claimed(work_dir, i) else 'pending'].append(i)
+    return states
+
+
+def merge(work_dir: Path, out: Path = None) -> Path:
+    """Verify that all shards are committed and cover all rows, and write the scores file and its `._OK` flag"""
+    work_dir = Path(work_dir)
+    manifest = load_manifest(work_dir)
+    out = Path(out or manifest['out'])
+    flag_file = out.with_name(out.name + '._OK')   # <score>._OK, as comet-wmtmetrics.sh expects
+    data_size = os.path.getsize(manifest['data'])
+    if data_size != manifest['data_size']:
+        raise ValueError(f'{manifest["data"]} has changed since {manifest_path(work_dir)} was created')
+    shards = manifest['shards']
+    assert [s['start'] for s in shards] == [0] + [s['end'] for s in shards[:-1]], 'Shards are not contiguous'
+    missing = [i for i in range(len(shards)) if not is_committed(work_dir, i)]
+    if missing:
+        raise RuntimeError(f'{len(missing)} of {len(shards)} shards are not committed: {missing[:10]}; run more workers')
+    with file_lock(out), span('shards.merge', rows=manifest['rows'], file=out.name), atomic_write(out) as tmp:
+        with open(tmp, 'wb') as f:
+            for i, shard in enumerate(shards):
+                data = shard_path(work_dir, i).read_bytes()
+                n_lines = data.count(b'\n')
+                if n_lines != shard['end'] - shard['start']:
+                    raise ValueError(f'{shard_path(work_dir, i)} has {n_lines} scores; expected {shard["end"] - shard["start"]}')
+                f.write(data)
+    flag_file.touch()
+    log.info(f'Merged {len(shards)} shards ({manifest["rows"]:,} rows) into {out}')
+    return out
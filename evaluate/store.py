@@ -0,0 +1,121 @@
+"""SQLite store of metric scores; an alternative to mt-metrics-eval's `metric-scores/<lp>/<scorer>.<level>.score` files.
+
+A store is a single file, `<root>/scores.sqlite`, in an mt-metrics-eval style root dir (e.g. --user-dir) next to
+its testset dirs. Scores of a (testset, lp, metric, ref, level) are one row: system names and a
+[n_systems x n_items] array (NaN for missing scores) as a blob, so that loading the scores of a language pair
+is a few indexed queries instead of listing and parsing two files per metric and reference.
+
+`flat_to_splits(..., use_store=True)` writes into the store (as float64, so exported files keep the scores as they
+were), and `mtme_data.EvalSet` reads it in addition to score files; a metric that is in both is read from the store.
+`ScoreStore.export` writes the files of a testset in the mt-metrics-eval layout.
+"""
+import json
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from . import log
+
+STORE_FILE_NAME = 'scores.sqlite'
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scores (
+    testset TEXT NOT NULL,
+    lp TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    level TEXT NOT NULL,
+    sys_names TEXT NOT NULL,   -- JSON list; one row of data per system
+    n_items INTEGER NOT NULL,
+    dtype TEXT NOT NULL,
+    data BLOB NOT NULL,
+    digest TEXT NOT NULL,      -- sha1 of sys_names and data, for the report cache
+    PRIMARY KEY (testset, lp, metric, ref, level)
+)
+"""
+
+
+def store_path(root: Path) -> Path:
+    return Path(root) / STORE_FILE_NAME
+
+
+def open_store(root: Path) -> Optional['ScoreStore']:
+    """Store of an mt-metrics-eval style root dir; None if it has none"""
+    path = store_path(root)
+    return ScoreStore(path) if path.exists() else None
+
+
+class ScoreStore:
+    """Metric scores of one root dir; see module doc"""
+
+    def __init__(self, path: Path, timeout=120):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=timeout, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')   # readers do not block the writer of another job
+        self.db.execute(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    @contextmanager
+    def transaction(self):
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+            self.db.execute('COMMIT')
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+
+    def put(self, testset: str, lp: str, metric: str, ref: str, level: str, sys_names: List[str], array: np.ndarray):
+        """Insert or replace scores; array is [len(sys_names) x n_items]"""
+        assert array.ndim == 2 and len(array) == len(sys_names), f'Expected {len(sys_names)} rows; got {array.shape}'
+        names = json.dumps(list(sys_names))
+        blob = np.ascontiguousarray(array).tobytes()
+        digest = hashlib.sha1(names.encode() + array.dtype.str.encode() + blob).hexdigest()
+        self.db.execute('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (testset, lp, metric, ref, level, names, array.shape[1], array.dtype.str, blob, digest))
+
+    def get(self, testset: str, lp: str, metric: str, ref: str, level: str) -> Tuple[List[str], np.ndarray]:
+        """System names and [n_systems x n_items] scores array; KeyError if missing"""
+        row = self.db.execute('SELECT sys_names, n_items, dtype, data FROM scores '
+                              'WHERE testset=? AND lp=? AND metric=? AND ref=? AND level=?',
+                              (testset, lp, metric, ref, level)).fetchone()
+        if row is None:
+            raise KeyError((testset, lp, metric, ref, level))
+        names, n_items, dtype, blob = row
+        names = json.loads(names)
+        array = np.frombuffer(blob, dtype=np.dtype(dtype)).reshape(len(names), n_items).copy()
+        return names, array
+
+    def entries(self, testset: str, lp: str = None, levels: List[str] = None) -> List[Tuple[str, str, str, str, str]]:
+        """(lp, metric, ref, level, digest) of stored scores of testset, in order"""
+        query = 'SELECT lp, metric, ref, level, digest FROM scores WHERE testset=?'
+        params = [testset]
+        if lp is not None:
+            query += ' AND lp=?'
+            params.append(lp)
+        if levels is not None:
+            query += f' AND level IN ({",".join("?" * len(levels))})'
+            params.extend(levels)
+        return self.db.execute(query + ' ORDER BY lp, metric, ref, level', params).fetchall()
+
+    def testsets(self) -> List[str]:
+        return [row[0] for row in self.db.execute('SELECT DISTINCT testset FROM scores ORDER BY testset')]
+
+    def export(self, testset: str, out_dir: Path) -> Iterator[Path]:
+        """Write scores of testset as `<out_dir>/<testset>/metric-scores/<lp>/<metric>-<ref>.<level>.score` files"""
+        for lp, metric, ref, level, _ in self.entries(testset):
+            names, array = self.get(testset, lp, metric, ref, level)
+            path = Path(out_dir) / testset / 'metric-scores' / lp / f'{metric}-{ref}.{level}.score'
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w') as out:
+                for name, row in zip(names, array.tolist()):
+                    for score in row:
+                        out.write(f'{name}\t{"None" if score != score else score}\n')   # NaN != NaN
+            log.debug(f'Wrote {path}')
+            yield path
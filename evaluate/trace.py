@@ -0,0 +1,155 @@
+"""Lightweight tracing of named spans, for profiling flatten, score, split and evaluate stages.
+
+Tracing is disabled by default, and then `span()` returns a shared no-op context manager.
+When enabled (e.g. `python -m evaluate --profile trace.json ...`), each span records wall time, CPU time
+(of this process and of finished child processes such as marian), rows/sec and peak RSS;
+optionally, peak Python memory from tracemalloc.
+Spans can be viewed in chrome://tracing or https://ui.perfetto.dev
+"""
+import os
+import json
+import time
+import resource
+import threading
+import tracemalloc
+from collections import defaultdict
+from pathlib import Path
+
+from . import log
+
+
+class _NoopSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set_rows(self, rows):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+
+    def __init__(self, tracer: 'Tracer', name: str, rows=None, **args):
+        self.tracer = tracer
+        self.name = name
+        self.rows = rows
+        self.args = args
+
+    def set_rows(self, rows):
+        self.rows = rows
+
+    def __enter__(self):
+        self.tid = threading.get_ident()
+        self.outermost = self.tracer._enter()
+        if self.tracer.memory and self.outermost:
+            tracemalloc.reset_peak()
+        times = os.times()
+        self.child_cpu = times.children_user + times.children_system
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        times = os.times()
+        child_cpu = times.children_user + times.children_system - self.child_cpu
+        record = dict(name=self.name, start=self.start - self.tracer.t0, wall=wall, cpu=cpu, child_cpu=child_cpu,
+                      rows=self.rows, peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                      tid=self.tid, args=self.args)
+        if self.tracer.memory:
+            record['py_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        self.tracer._exit(record)
+        return False
+
+
+class Tracer:
+
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.spans = []
+        self.t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, memory=False):
+        """Start recording spans. memory=True also tracks peak Python memory with tracemalloc (slow)."""
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def span(self, name: str, rows=None, **args):
+        """Context manager that records a span; no-op when tracing is disabled.
+
+        :param name: name of stage, e.g. `flatten`
+        :param rows: number of rows processed; can also be set later with `set_rows()`
+        :param args: extra details to store in trace, e.g. file names
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, name, rows=rows, **args)
+
+    def _enter(self) -> bool:
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        return depth == 0
+
+    def _exit(self, record):
+        self._local.depth -= 1
+        with self._lock:
+            self.spans.append(record)
+
+    def add_spans(self, records, t0: float, pid: int):
+        """Add span records of another process (e.g. a pipeline worker) whose tracer started at t0"""
+        with self._lock:
+            self.spans.extend(dict(record, start=record['start'] + t0 - self.t0, pid=pid) for record in records)
+
+    def chrome_trace(self) -> dict:
+        pid = os.getpid()
+        events = []
+        for span in self.spans:
+            args = {k: v for k, v in span.items()
+                    if k not in ('name', 'start', 'wall', 'pid', 'tid', 'args') and v is not None}
+            args.update({k: str(v) for k, v in span['args'].items()})
+            events.append(dict(name=span['name'], cat='evaluate', ph='X', pid=span.get('pid', pid), tid=span['tid'],
+                               ts=span['start'] * 1e6, dur=span['wall'] * 1e6, args=args))
+        return dict(traceEvents=events, displayTimeUnit='ms')
+
+    def summary(self) -> str:
+        """Table of spans aggregated by name"""
+        stats = defaultdict(lambda: dict(count=0, wall=0.0, cpu=0.0, child_cpu=0.0, rows=0, peak_rss_mb=0.0, py_peak_mb=0.0))
+        for span in self.spans:
+            stat = stats[span['name']]
+            stat['count'] += 1
+            for key in ('wall', 'cpu', 'child_cpu'):
+                stat[key] += span[key]
+            stat['rows'] += span['rows'] or 0
+            stat['peak_rss_mb'] = max(stat['peak_rss_mb'], span['peak_rss_mb'])
+            stat['py_peak_mb'] = max(stat['py_peak_mb'], span.get('py_peak_mb', 0.0))
+        header = f"{'span':<24} {'count':>6} {'wall_s':>9} {'cpu_s':>9} {'child_s':>9} {'rows':>11} {'rows/s':>11} {'rss_mb':>8}" + (f" {'py_mb':>8}" if self.memory else '')
+        lines = [header, '-' * len(header)]
+        for name, stat in sorted(stats.items(), key=lambda x: x[1]['wall'], reverse=True):
+            rate = stat['rows'] / stat['wall'] if stat['rows'] and stat['wall'] else 0
+            lines.append(f"{name:<24} {stat['count']:>6} {stat['wall']:>9.2f} {stat['cpu']:>9.2f} {stat['child_cpu']:>9.2f}"
+                         f" {stat['rows']:>11,} {rate:>11,.0f} {stat['peak_rss_mb']:>8.0f}"
+                         + (f" {stat['py_peak_mb']:>8.1f}" if self.memory else ''))
+        return '\n'.join(lines)
+
+    def save(self, path: Path):
+        """Write Chrome trace JSON to path, and log the summary table"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.chrome_trace()))
+        log.info(f"Wrote {len(self.spans)} spans to {path}\n{self.summary()}")
+
+
+TRACER = Tracer()
+span = TRACER.span
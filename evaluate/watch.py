@@ -0,0 +1,155 @@
+"""Watch a training run dir and evaluate each new checkpoint as soon as it is saved.
+
+The flat file (pruned to the rows of the scenario), its rows and the scenario's EvalSets (human scores only)
+are loaded once; for each checkpoint, only marian scoring is run, and seg scores are averaged and compared
+with gold in memory (see `accuracy.py`).
+Accuracies are appended to a TSV results table; checkpoints in the table are not evaluated again.
+When a newer checkpoint appears while one is being scored, the older one is cancelled (unless cancel=False)
+and skipped: it is added to the table with accuracy nan, so it is not scored again from scratch later.
+"""
+import os
+import time
+import fnmatch
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+from . import log
+from .trace import span
+
+RESULTS_HEADER = ['time', 'checkpoint', 'mtime', 'accuracy', 'score_secs']
+
+
+class Superseded(Exception):
+    """Scoring of a checkpoint was cancelled since a newer checkpoint was saved"""
+
+
+def list_checkpoints(run_dir: Path, pattern: str, settle: float) -> List[Tuple[int, str]]:
+    """(mtime_ns, name) of checkpoints in run_dir, oldest first; files modified in the last `settle` seconds
+    may still be being written, and are left for later."""
+    now = time.time_ns()
+    found = []
+    with os.scandir(run_dir) as it:
+        for item in it:
+            if item.is_file() and fnmatch.fnmatchcase(item.name, pattern):
+                mtime_ns = item.stat().st_mtime_ns
+                if now - mtime_ns >= settle * 1e9:
+                    found.append((mtime_ns, item.name))
+    return sorted(found)
+
+
+def read_results(path: Path) -> set:
+    """(checkpoint, mtime) of checkpoints in results table"""
+    done = set()
+    if path.exists():
+        with open(path) as f:
+            for line in f:
+                row = line.rstrip('\n').split('\t')
+                if row != RESULTS_HEADER:
+                    done.add((row[1], row[2]))
+    return done
+
+
+class Watcher:
+    """Scenario data, loaded once, and the state of a run dir being watched"""
+
+    def __init__(self, run_dir: Path, base_dir: Path, testset: str, scenario_name: str, results_file: Path,
+                 pattern='model.iter*.npz', vocab: Path = None, devices: List[int] = None, mini_batch=16,
+                 interval=30., settle=10., cancel=True, scores_dir: Path = None):
+        from .evaluate import load_eval_sets
+        from .scenarios import all_scenarios
+        from .score import get_flat_file, read_tsv
+        from .accuracy import flat_row_groups
+
+        self.run_dir, self.pattern, self.results_file = Path(run_dir), pattern, Path(results_file)
+        self.vocab = vocab or self.run_dir / 'vocab.spm'
+        self.devices, self.mini_batch = devices, mini_batch
+        self.interval, self.settle, self.cancel = interval, settle, cancel
+        self.scores_dir = scores_dir
+        self.scenario = all_scenarios[scenario_name]
+        assert self.scenario['testset'] == testset, f"Scenario {scenario_name} is not for testset {testset}"
+        assert self.scenario.get('level', 'sys') == 'sys', "Watch supports system-level scenarios only"
+
+        self.data_file = get_flat_file(Path(base_dir) / testset, reference_based=False, scenario=scenario_name)
+        with span('watch.load', file=self.data_file.name) as sp:
+            rows = list(read_tsv(self.data_file))
+            self.srcs = [row[3] for row in rows]
+            self.hyps = [row[5] for row in rows]
+            self.row_groups = flat_row_groups(rows)
+            del rows
+            self.eval_sets = load_eval_sets(paths=[base_dir], scenairo_name=scenario_name, read_metrics=False)
+            sp.set_rows(len(self.srcs))
+        self.done = read_results(self.results_file)
+        log.info(f'Watching {self.run_dir}/{pattern}: {len(self.srcs):,} rows of {self.data_file.name}; '
+                 f'{len(self.done)} checkpoints already in {self.results_file}')
+
+    def pending(self) -> List[Tuple[int, str]]:
+        return [(mtime_ns, name) for mtime_ns, name in list_checkpoints(self.run_dir, self.pattern, self.settle)
+                if (name, str(mtime_ns)) not in self.done]
+
+    def score(self, name: str, mtime_ns: int) -> np.ndarray:
+        """Seg scores of checkpoint; raises Superseded if a newer checkpoint appears meanwhile"""
+        from .marian import marian_score
+        scores = np.empty(len(self.srcs))
+        next_poll = time.monotonic() + self.interval
+        gen = marian_score(self.run_dir / name, iter(self.srcs), iter(self.hyps), vocab=self.vocab,
+                           devices=self.devices, mini_batch=self.mini_batch)
+        try:
+            i = 0
+            for i, score in enumerate(gen):
+                scores[i] = score[0] if isinstance(score, tuple) else score
+                if self.cancel and time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + self.interval
+                    newer = [n for m, n in self.pending() if m > mtime_ns]
+                    if newer:
+                        raise Superseded(f'{name} is superseded by {newer[-1]}')
+            assert i + 1 == len(scores), f'Expected {len(scores)} scores from {name}; got {i + 1}'
+        finally:
+            gen.close()   # kills marian if it is still running
+        return scores
+
+    def evaluate(self, name: str, mtime_ns: int) -> float:
+        """Accuracy of checkpoint, added to results table; nan if it is superseded while being scored"""
+        from .accuracy import flat_sys_scores, global_accuracy
+        start = time.monotonic()
+        try:
+            with span('watch.score', checkpoint=name, rows=len(self.srcs)):
+                scores = self.score(name, mtime_ns)
+        except Superseded as e:
+            log.info(f'Skipped: {e}')
+            self.add_result(name, mtime_ns, float('nan'), time.monotonic() - start)
+            return float('nan')
+        secs = time.monotonic() - start
+        if self.scores_dir:
+            self.scores_dir.mkdir(parents=True, exist_ok=True)
+            np.savetxt(self.scores_dir / f'{name}.{self.data_file.name}.seg.scores', scores, fmt='%g')
+        with span('compare.accuracy', engine='native', checkpoint=name):
+            sys_scores = flat_sys_scores(self.data_file, scores[:, None], row_groups=self.row_groups)
+            acc = float(global_accuracy(sys_scores, self.eval_sets, gold_name=self.scenario['gold_name'],
+                                        include_human=self.scenario['use_humans'])[0])
+        self.add_result(name, mtime_ns, acc, secs)
+        return acc
+
+    def add_result(self, name: str, mtime_ns: int, acc: float, secs: float):
+        row = [time.strftime('%Y-%m-%dT%H:%M:%S'), name, str(mtime_ns), f'{acc:.6f}', f'{secs:.1f}']
+        new_file = not self.results_file.exists()
+        with open(self.results_file, 'a') as out:
+            if new_file:
+                out.write('\t'.join(RESULTS_HEADER) + '\n')
+            out.write('\t'.join(row) + '\n')
+        self.done.add((name, str(mtime_ns)))
+        print('\t'.join(row), flush=True)
+
+    def run(self, once=False):
+        """Evaluate pending checkpoints, newest first if cancel=True (else oldest first), then wait for more.
+        once=True returns when there are no pending checkpoints."""
+        while True:
+            pending = self.pending()
+            if not pending:
+                if once:
+                    return
+                time.sleep(self.interval)
+                continue
+            mtime_ns, name = pending[-1] if self.cancel else pending[0]
+            self.evaluate(name, mtime_ns)
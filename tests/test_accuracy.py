@@ -0,0 +1,108 @@
+"""Native engine against brute-force references: pairwise agreement, system selection and global accuracy.
+
+    python -m pytest tests
+"""
+import itertools
+
+import numpy as np
+import pytest
+
+from evaluate.accuracy import global_accuracy, pairwise_agreement, select_systems
+from evaluate.segcorr import grouped_kendall
+
+nan = np.nan
+
+
+def brute_agreement(gold, scores):
+    """Pairwise agreement as in mt_metrics_eval.stats.Agreement: pairs with a missing score are skipped,
+    and a pair agrees when the signs of both differences are equal (so ties agree only with ties)"""
+    agree, num_pairs = 0, 0
+    for a, b in itertools.combinations(range(len(gold)), 2):
+        if any(np.isnan(x) for x in (gold[a], gold[b], scores[a], scores[b])):
+            continue
+        agree += np.sign(gold[a] - gold[b]) == np.sign(scores[a] - scores[b])
+        num_pairs += 1
+    return agree, num_pairs
+
+
+class FakeEvalSet:
+    """The parts of an EvalSet that select_systems uses"""
+
+    def __init__(self, lp, gold, std_ref='refA', human_sys_names=(), outlier_sys_names=()):
+        self.lp, self.gold, self.std_ref = lp, gold, std_ref
+        self.human_sys_names, self.outlier_sys_names = set(human_sys_names), set(outlier_sys_names)
+
+    def Scores(self, level, name):
+        return {sys_name: [score] for sys_name, score in self.gold.items()} if name == 'mqm' else None
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pairwise_agreement_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    # few distinct values make ties common, in gold and in metrics
+    gold = rng.integers(0, 4, size=9).astype(float)
+    gold[rng.random(9) < 0.2] = nan
+    scores = rng.integers(0, 4, size=(6, 9)).astype(float)
+    scores[rng.random((6, 9)) < 0.2] = nan
+    scores[0] = 1.0   # constant metric: agrees only on gold ties
+    agree, num_pairs = pairwise_agreement(gold, scores)
+    for i in range(len(scores)):
+        assert (agree[i], num_pairs[i]) == brute_agreement(gold, scores[i])
+
+
+def test_pairwise_agreement_ties_and_missing():
+    gold = np.array([1.0, 1.0, 2.0, nan])
+    agree, num_pairs = pairwise_agreement(gold, np.array([[5.0, 5.0, 6.0, 7.0], [5.0, 6.0, 4.0, 7.0]]))
+    # pairs (0,1) tie in gold; pairs with system 3 have no gold
+    assert agree.tolist() == [3, 0] and num_pairs.tolist() == [3, 3]
+
+
+def test_select_systems():
+    evs = FakeEvalSet('en-de', dict(sysA=1.0, sysB=None, sysC=2.0, refA=3.0, refB=4.0, outlier=0.5),
+                      human_sys_names={'refA', 'refB'}, outlier_sys_names={'outlier'})
+    names, gold = select_systems(evs, 'mqm', include_human=False)
+    assert names == ['sysA', 'sysC'] and gold.tolist() == [1.0, 2.0]
+    names, gold = select_systems(evs, 'mqm', include_human=True, include_outliers=True)
+    assert names == ['outlier', 'refB', 'sysA', 'sysC'] and gold.tolist() == [0.5, 4.0, 1.0, 2.0]
+    with pytest.raises(ValueError):
+        select_systems(evs, 'da', include_human=False)
+
+
+def test_global_accuracy_matches_brute_force():
+    rng = np.random.default_rng(7)
+    eval_sets, sys_scores = {}, {}
+    total_agree, total_pairs = np.zeros(4), np.zeros(4)
+    for lp in ['en-de', 'zh-en']:
+        sys_names = [f'sys{i}' for i in range(7)]
+        gold = dict(zip(sys_names, rng.integers(0, 3, size=7).astype(float)))
+        eval_sets[lp] = FakeEvalSet(lp, gold)
+        scores = rng.integers(0, 3, size=(7, 4)).astype(float)
+        scores[2, 1] = nan
+        sys_scores[lp] = dict(zip(sys_names[:-1], scores[:-1]))   # last system has no metric scores
+        for i in range(4):
+            a, n = brute_agreement(np.array(list(gold.values())), np.append(scores[:-1, i], nan))
+            total_agree[i] += a
+            total_pairs[i] += n
+    accs = global_accuracy(sys_scores, eval_sets, gold_name='mqm', include_human=False)
+    assert np.allclose(accs, total_agree / total_pairs)
+
+
+def test_grouped_kendall_without_valid_items():
+    tau = grouped_kendall(np.array([nan, 1.0]), np.array([[1.0, nan]]))
+    assert tau.shape == (1, 1) and np.isnan(tau).all()
+    tau = grouped_kendall(np.array([nan, nan, 1.0, 2.0]), np.array([[1.0, 2.0, 3.0, 4.0]]),
+                          groups=np.array([0, 0, 1, 1]))
+    assert np.isnan(tau[0, 0]) and tau[0, 1] == 1.0
+
+
+def test_global_accuracy_excludes_outliers():
+    gold = dict(sysA=1.0, sysB=2.0, sysC=3.0, outlier=4.0)
+    eval_sets = {'en-de': FakeEvalSet('en-de', gold, outlier_sys_names={'outlier'})}
+    # candidate 0 ranks the non-outliers right and the outlier wrong; candidate 1 the other way round
+    sys_scores = {'en-de': dict(sysA=np.array([1.0, 3.0]), sysB=np.array([2.0, 2.0]),
+                                sysC=np.array([3.0, 1.0]), outlier=np.array([0.0, 4.0]))}
+    accs = global_accuracy(sys_scores, eval_sets, gold_name='mqm', include_human=False)
+    assert accs.tolist() == [1.0, 0.0]
+    eval_sets['en-de'].outlier_sys_names = set()
+    accs = global_accuracy(sys_scores, eval_sets, gold_name='mqm', include_human=False)
+    assert accs.tolist() == [0.5, 0.5]
@@ -0,0 +1,33 @@
+"""Ensemble search against accuracies of single metrics computed with global_accuracy.
+
+    python -m pytest tests
+"""
+import numpy as np
+
+from evaluate.accuracy import global_accuracy
+from evaluate.ensemble import EnsembleSearch
+from test_accuracy import FakeEvalSet
+
+nan = np.nan
+
+
+def test_incomplete_feature_is_skipped():
+    gold = dict(sysA=1.0, sysB=2.0, sysC=3.0, sysD=4.0)
+    eval_sets = {'en-de': FakeEvalSet('en-de', gold)}
+    groups = {('en-de', 'refA', name): i for i, name in enumerate(gold)}
+    # 'partial' ranks the three systems it scores right, but lacks sysD; 'full' scores all systems, with one error.
+    # On their own pairs, 'partial' (3/3) would beat 'full' (5/6)
+    features = np.array([[1.0, 1.0], [3.0, 2.0], [2.0, 3.0], [4.0, nan]])
+    search = EnsembleSearch(['full', 'partial'], features, groups, eval_sets, gold_name='mqm', include_human=False,
+                            ref_name={'en-de': 'refA'}, normalize='none')
+    assert search.names == ['full']
+    sys_scores = {'en-de': {name: features[i, :1] for (_, _, name), i in groups.items()}}
+    expected = global_accuracy(sys_scores, eval_sets, gold_name='mqm', include_human=False)
+    assert np.allclose(search.accuracy(np.eye(1)), expected)
+    assert np.allclose(expected, 5 / 6)
+    # a system that global accuracy does not use (the std_ref) may lack features
+    groups[('en-de', 'refA', 'refA')] = len(groups)
+    features = np.vstack([features[:, :1], [[nan]]])
+    search = EnsembleSearch(['full'], features, groups, eval_sets, gold_name='mqm', include_human=False,
+                            ref_name={'en-de': 'refA'}, normalize='none')
+    assert search.names == ['full']